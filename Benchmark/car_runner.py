@@ -0,0 +1,91 @@
+# Runs CarBrain (main_with_placeholder_video.py) headless for the benchmark: fake actuator backend,
+# synthetic test pattern video. On SIGTERM it shuts down and writes the recorded actuator writes and
+# stats as JSON. With --control-process the actuators are driven from CarBrain's control process, which
+# writes its fake backend's writes to a file next to the results.
+# Usage: python car_runner.py <signaling url> <token> <car id> <results path> [--metrics-port N] [--jitter-buffer] [--dashcam]
+#        [--control-process]
+
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import types
+
+CARBRAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CarBrain")
+
+async def run(car):
+    task = asyncio.ensure_future(car.main())
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def main():
+    signaling_url, token, car_id, results_path = sys.argv[1:5]
+
+    # CarBrain reads its settings from a config module that is not part of the repo
+    config = types.ModuleType("config")
+    config.SIGNALING_SERVER_URL = signaling_url
+    config.SIGNALING_SERVER_TOKEN = token
+    sys.modules["config"] = config
+
+    sys.path.insert(0, CARBRAIN_DIR)
+    os.chdir(CARBRAIN_DIR)
+    import main_with_placeholder_video as car
+    from actuator_bus import FakeBackend
+    from failsafe import scheduler
+    from profiling import profiler
+    from dashcam import dashcam
+
+    backend = FakeBackend()
+    car.ACTUATOR_BACKEND = backend
+    car.PLACEHOLDER_MODE = "pattern"
+    car.CAR_ID = car_id
+    options = sys.argv[5:]
+    profiler.directory = os.path.dirname(os.path.abspath(results_path))
+    car.JITTER_BUFFER = "--jitter-buffer" in options
+    # Recorded next to the results, only when asked for
+    car.DASHCAM_DIR = os.path.join(profiler.directory, "dashcam") if "--dashcam" in options else None
+    control_results_path = None
+    if "--control-process" in options:
+        car.CONTROL_PROCESS = True
+        car.ACTUATOR_BACKEND = "fake"
+        control_results_path = os.path.abspath(results_path) + ".control"
+        car.CONTROL_RESULTS_PATH = control_results_path
+    if "--metrics-port" in options:
+        car.METRICS_PORT = int(options[options.index("--metrics-port") + 1])
+
+    asyncio.run(run(car))
+
+    writes, batches, failsafe = backend.writes, backend.batches, scheduler.stats()
+    control = None
+    if control_results_path:
+        # The monotonic clock is system-wide, so the control process's write times compare as is
+        with open(control_results_path) as f:
+            control = json.load(f)
+        os.remove(control_results_path)
+        writes, batches, failsafe = control.pop("writes"), control.pop("batches"), control["failsafe"]
+
+    setup_timeline = car.signaling.setup_timeline if car.signaling else None
+    # Actuator write times converted from monotonic to epoch seconds so the driver can match them
+    clock_offset = time.time() - time.monotonic()
+    with open(results_path, "w") as f:
+        json.dump({
+            "writes": [(t + clock_offset, pin, pw) for t, pin, pw in writes],
+            "batches": batches,
+            "actuation": car.actuation.stats() if car.actuation else None,
+            "failsafe": failsafe,
+            "control_process": control,
+            "startup": car.profile.durations(),
+            "setup": setup_timeline.durations() if setup_timeline else None,
+            "peers": car.signaling.peers.stats() if car.signaling and car.signaling.peers else None,
+            "profile": profiler.last_result,
+            "dashcam": dashcam.stats() if car.DASHCAM_DIR else None,
+            "reconnect_ms": setup_timeline.reconnect_time * 1000 if setup_timeline and setup_timeline.reconnect_time else None,
+        }, f)
+
+if __name__ == "__main__":
+    main()
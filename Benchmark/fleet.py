@@ -0,0 +1,357 @@
+# Fleet load generator for the signaling server: many simulated cars and drivers exchanging offers,
+# answers and trickle ICE candidates through one SignalingServer/main.py, in stages of growing size
+# until it starts failing.
+# - the server runs in a subprocess on a local port (--async-mode picks its serving mode), or --url
+#   points at a running one
+# - simulated clients are python-socketio coroutines spread over --processes worker processes. They only
+#   speak signaling: offers and answers are a JSON stamp padded to --sdp-bytes, like a real SDP
+# - --real-cars N also runs N real CarBrain processes (car_runner.py, synthetic test pattern) with headless
+#   aiortc drivers (main.Controller), so real connection setups are measured under the signaling load
+# Each stage reports connect throughput and latency, relay latency percentiles per event, errors, and the
+# server's CPU and memory. The first stage over --max-error-rate or --max-relay-p99-ms is the failing point.
+# Usage: python fleet.py [--stages 25,50,100,200,400] [--stage-duration 20] [--offer-interval 2] [--candidates 4]
+#        [--connect-rate 50] [--processes 4] [--async-mode gevent|threading] [--real-cars 0] [--output fleet_results.json]
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import socketio
+
+from main import Controller, Component, percentiles, wait_for_port, ROOT_DIR, BENCHMARK_DIR, SIGNALING_TOKEN, STARTUP_TIMEOUT
+
+FLEET_PORT = 8091
+CONNECT_TIMEOUT = 10 # Seconds for a client's Socket.IO connection, counted as failed after that
+ANSWER_TIMEOUT = 5 # Seconds from an offer to its answer, counted as failed after that
+STATS_INTERVAL = 1.0 # Seconds between samples of the server's memory
+CANDIDATE = "candidate:1 1 udp 2122260223 192.168.1.20 50000 typ host generation 0"
+
+logger = logging.getLogger("fleet")
+
+class Stats:
+    """What one worker process measured, merged by the orchestrator."""
+    def __init__(self):
+        self.connects = [] # Seconds per successful connect
+        self.connected_at = [] # Epoch seconds
+        self.relays = {} # event -> seconds from emit to delivery
+        self.setups = [] # Seconds from offer to answer
+        self.errors = {} # reason -> count
+        self.attempts = 0 # Connects and negotiations
+
+    def relay(self, event, seconds):
+        self.relays.setdefault(event, []).append(seconds)
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+class SimulatedClient:
+    def __init__(self, url, car_id, role, stats, transports):
+        self.url = f"{url}/?token={SIGNALING_TOKEN}&car_id={car_id}&role={role}"
+        self.role = role
+        self.stats = stats
+        self.transports = transports
+        self.sio = socketio.AsyncClient(reconnection=False)
+
+    async def connect(self):
+        self.stats.attempts += 1
+        start = time.monotonic()
+        try:
+            await self.sio.connect(self.url, transports=self.transports, wait_timeout=CONNECT_TIMEOUT)
+        except Exception as e:
+            self.stats.error(f"{self.role}_connect: {type(e).__name__}")
+            return False
+        self.stats.connects.append(time.monotonic() - start)
+        self.stats.connected_at.append(time.time())
+        return True
+
+    async def close(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+class SimulatedCar(SimulatedClient):
+    """Answers every offer at once, followed by its own ICE candidates, as main.py does."""
+    def __init__(self, url, car_id, stats, transports, candidates):
+        super().__init__(url, car_id, "car", stats, transports)
+
+        @self.sio.on("offer")
+        async def on_offer(data, peer_id=None, role=None):
+            stamp = json.loads(data)
+            stats.relay("offer", time.time() - stamp["sent"])
+            await self.sio.emit("answer", (json.dumps({"seq": stamp["seq"], "sent": time.time(), "sdp": stamp["sdp"]}), peer_id))
+            for _ in range(candidates):
+                await self.sio.emit("ice_candidate", (json.dumps({"sent": time.time(), "candidate": CANDIDATE}), peer_id))
+
+        @self.sio.on("ice_candidate")
+        async def on_ice_candidate(data, peer_id=None, role=None):
+            stats.relay("ice_candidate_to_car", time.time() - json.loads(data)["sent"])
+
+class SimulatedDriver(SimulatedClient):
+    """Negotiates every offer_interval: an offer followed by trickled ICE candidates, then waits for the answer."""
+    def __init__(self, url, car_id, stats, transports, candidates, sdp_bytes):
+        super().__init__(url, car_id, "driver", stats, transports)
+        self.candidates = candidates
+        self.sdp = "v=0" + "a" * max(0, sdp_bytes - 3)
+        self._answers = {}
+
+        @self.sio.on("answer")
+        async def on_answer(data):
+            stamp = json.loads(data)
+            stats.relay("answer", time.time() - stamp["sent"])
+            answer = self._answers.pop(stamp["seq"], None)
+            if answer is not None and not answer.done():
+                answer.set_result(None)
+
+        @self.sio.on("ice_candidate")
+        async def on_ice_candidate(data):
+            stats.relay("ice_candidate_to_driver", time.time() - json.loads(data)["sent"])
+
+    async def negotiate(self, seq):
+        self.stats.attempts += 1
+        answer = self._answers[seq] = asyncio.get_running_loop().create_future()
+        sent = time.time()
+        try:
+            await self.sio.emit("offer", json.dumps({"seq": seq, "sent": sent, "sdp": self.sdp}))
+            for _ in range(self.candidates):
+                await self.sio.emit("ice_candidate", json.dumps({"sent": time.time(), "candidate": CANDIDATE}))
+            await asyncio.wait_for(answer, ANSWER_TIMEOUT)
+            self.stats.setups.append(time.time() - sent)
+        except asyncio.TimeoutError:
+            self._answers.pop(seq, None)
+            self.stats.error("answer_timeout")
+        except Exception as e:
+            self._answers.pop(seq, None)
+            self.stats.error(f"negotiate: {type(e).__name__}")
+
+    async def run(self, until, interval):
+        seq = 0
+        # Spread the offers of all drivers over the interval
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.time() < until and self.sio.connected:
+            started = time.monotonic()
+            await self.negotiate(seq)
+            seq += 1
+            await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+
+async def _run_pair(params, index, start_at, until, stats):
+    transports = params["transports"]
+    car_id = f"fleet-{params['stage']}-{index}"
+    await asyncio.sleep(max(0, start_at - time.time()))
+    car = SimulatedCar(params["url"], car_id, stats, transports, params["candidates"])
+    driver = SimulatedDriver(params["url"], car_id, stats, transports, params["candidates"], params["sdp_bytes"])
+    try:
+        if await car.connect() and await driver.connect():
+            await driver.run(until, params["offer_interval"])
+    finally:
+        await asyncio.gather(driver.close(), car.close(), return_exceptions=True)
+
+async def _worker(params):
+    stats = Stats()
+    # Open loop: pairs connect on schedule whether or not the earlier ones are through yet
+    start = params["start"]
+    until = start + len(params["pairs"]) * params["connect_interval"] + params["duration"]
+    await asyncio.gather(*[_run_pair(params, index, start + i * params["connect_interval"], until, stats)
+                           for i, index in enumerate(params["pairs"])])
+    return vars(stats)
+
+def run_worker(params):
+    return asyncio.run(_worker(params))
+
+async def run_real_drivers(url, car_ids, duration):
+    # Real aiortc connections to the real cars, under the stage's signaling load
+    results = []
+    async def drive(car_id):
+        controller = Controller(20, 0, 0, car_id=car_id)
+        try:
+            await controller.connect(url)
+            frames = len(controller.frame_times)
+            await controller.drive(duration)
+            results.append({"setup_ms": controller.timings, "fps": (len(controller.frame_times) - frames) / duration})
+        except Exception as e:
+            results.append({"error": f"{type(e).__name__}: {e}"})
+        finally:
+            if controller.peer_connection is not None:
+                await controller.close()
+            else:
+                await controller.sio.disconnect()
+    await asyncio.gather(*[drive(car_id) for car_id in car_ids])
+    return results
+
+def server_stats(url):
+    with urllib.request.urlopen(f"{url}/stats", timeout=CONNECT_TIMEOUT) as response:
+        return json.load(response)
+
+def merge(results):
+    merged = Stats()
+    for result in results:
+        merged.connects += result["connects"]
+        merged.connected_at += result["connected_at"]
+        merged.setups += result["setups"]
+        merged.attempts += result["attempts"]
+        for event, values in result["relays"].items():
+            merged.relays.setdefault(event, []).extend(values)
+        for reason, count in result["errors"].items():
+            merged.errors[reason] = merged.errors.get(reason, 0) + count
+    return merged
+
+def run_stage(args, pool, url, pairs, real_cars):
+    ms = lambda values: percentiles([v * 1000 for v in values])
+    processes = min(args.processes, pairs)
+    start = time.time() + 1 # Time for the workers to start
+    params = [{
+        "url": url, "stage": pairs, "pairs": list(range(pairs))[worker::processes], "start": start,
+        # Each worker's share of the connect rate
+        "connect_interval": processes / args.connect_rate, "duration": args.stage_duration,
+        "offer_interval": args.offer_interval, "candidates": args.candidates, "sdp_bytes": args.sdp_bytes,
+        "transports": args.transports.split(",") if args.transports else None,
+    } for worker in range(processes)]
+
+    before = server_stats(url)
+    rss = [before.get("rss_bytes") or 0]
+    sampling = threading.Event()
+    def sample_memory():
+        while not sampling.wait(STATS_INTERVAL):
+            try:
+                rss.append(server_stats(url).get("rss_bytes") or 0)
+            except OSError:
+                pass
+    threading.Thread(target=sample_memory, name="server-memory", daemon=True).start()
+
+    wall_start = time.monotonic()
+    futures = [pool.submit(run_worker, p) for p in params]
+    real = asyncio.run(run_real_drivers(url, real_cars, args.stage_duration)) if real_cars else []
+    merged = merge(future.result() for future in futures)
+    wall = time.monotonic() - wall_start
+    sampling.set()
+    after = server_stats(url)
+
+    relays = [v for values in merged.relays.values() for v in values]
+    errors = sum(merged.errors.values())
+    connected = sorted(merged.connected_at)
+    stage = {
+        "pairs": pairs,
+        "clients": 2 * pairs,
+        "connected": len(connected),
+        "connect_throughput_per_s": (len(connected) - 1) / (connected[-1] - start) if len(connected) > 1 and connected[-1] > start else None,
+        "connect_ms": ms(merged.connects),
+        "relay_ms": ms(relays),
+        "relay_ms_by_event": {event: ms(values) for event, values in sorted(merged.relays.items())},
+        "offer_to_answer_ms": ms(merged.setups),
+        "negotiations": len(merged.setups),
+        "errors": merged.errors,
+        "error_rate": errors / merged.attempts if merged.attempts else None,
+        "server_cpu_percent": (after["cpu_seconds"] - before["cpu_seconds"]) / wall * 100,
+        "server_rss_mb_max": max(rss) / 1e6 if any(rss) else None,
+        "server_clients_after": after["clients"],
+        "real_cars": real,
+    }
+    stage["failing"] = bool(
+        (stage["error_rate"] or 0) > args.max_error_rate
+        or stage["relay_ms"] is None
+        or stage["relay_ms"]["p99"] > args.max_relay_p99_ms
+    )
+    return stage
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated fleet load generator for the signaling server")
+    parser.add_argument("--stages", default="25,50,100,200,400", help="car+driver pairs per stage, comma separated")
+    parser.add_argument("--stage-duration", type=float, default=20, help="seconds of negotiating per stage, after the connect ramp")
+    parser.add_argument("--offer-interval", type=float, default=2, help="seconds between each driver's offers")
+    parser.add_argument("--candidates", type=int, default=4, help="trickled ICE candidates per offer and per answer")
+    parser.add_argument("--sdp-bytes", type=int, default=3000, help="size of the offers and answers")
+    parser.add_argument("--connect-rate", type=float, default=50, help="new pairs per second")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1), help="worker processes for the simulated clients")
+    parser.add_argument("--transports", default=None, help="Socket.IO transports, e.g. websocket (default: polling, then upgrade, as browsers)")
+    parser.add_argument("--async-mode", default=None, help="serving mode of the local server (gevent, threading), default as the server picks")
+    parser.add_argument("--url", default=None, help="load an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=FLEET_PORT, help="local signaling server port")
+    parser.add_argument("--real-cars", type=int, default=0, help="real CarBrain processes with aiortc drivers alongside the simulated fleet")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="a stage with more errors per connect or negotiation fails")
+    parser.add_argument("--max-relay-p99-ms", type=float, default=500, help="a stage with a slower relay p99 fails")
+    parser.add_argument("--keep-going", action="store_true", help="run the remaining stages after a failing one")
+    parser.add_argument("--output", default="fleet_results.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Every client is a socket, in the workers and (inherited) the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    url = args.url or f"http://127.0.0.1:{args.port}"
+    stages = []
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "config.py"), "w") as f:
+            f.write(f"SIGNALING_SERVER_URL = '{url}'\nSIGNALING_SERVER_TOKEN = '{SIGNALING_TOKEN}'\n")
+        env = dict(os.environ, PYTHONPATH=tmp, PYTHONUNBUFFERED="1")
+        if args.async_mode:
+            env["SIGNALING_ASYNC_MODE"] = args.async_mode
+
+        components = []
+        try:
+            if args.url is None:
+                # The server's own __main__ refuses Werkzeug outside development, so run its app directly
+                server = f"import main; main.socketio.run(main.app, host='127.0.0.1', port={args.port}, allow_unsafe_werkzeug=True)"
+                components.append(Component("signaling", [sys.executable, "-c", server], os.path.join(ROOT_DIR, "SignalingServer"), env))
+                if not wait_for_port(args.port, STARTUP_TIMEOUT):
+                    raise RuntimeError(f"Signaling server did not start:\n{components[0].tail()}")
+            async_mode = server_stats(url).get("async_mode")
+            logger.info("Signaling server at %s (%s)", url, async_mode)
+
+            real_cars = [f"fleet-real-{i}" for i in range(args.real_cars)]
+            for car_id in real_cars:
+                car = Component(car_id, [sys.executable, os.path.join(BENCHMARK_DIR, "car_runner.py"), url, SIGNALING_TOKEN, car_id,
+                                         os.path.join(tmp, f"{car_id}.json"), "--metrics-port", "0"],
+                                BENCHMARK_DIR, env, ready_line="Connected to the signaling server")
+                components.append(car)
+                if not car.ready.wait(STARTUP_TIMEOUT):
+                    raise RuntimeError(f"CarBrain {car_id} did not connect to the signaling server:\n{car.tail()}")
+
+            # Forked: a spawned worker would import main.py again, by then CarBrain's is first on the path
+            with concurrent.futures.ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("fork")) as pool:
+                for pairs in (int(p) for p in args.stages.split(",")):
+                    stage = run_stage(args, pool, url, pairs, real_cars)
+                    stages.append(stage)
+                    logger.info("%d pairs: %s connected, %s/s, connect p99 %s ms, relay p50/p99 %s/%s ms, errors %s, server CPU %.0f%%, RSS %s MB%s",
+                                pairs, stage["connected"],
+                                round(stage["connect_throughput_per_s"], 1) if stage["connect_throughput_per_s"] else None,
+                                round(stage["connect_ms"]["p99"]) if stage["connect_ms"] else None,
+                                round(stage["relay_ms"]["p50"], 1) if stage["relay_ms"] else None,
+                                round(stage["relay_ms"]["p99"], 1) if stage["relay_ms"] else None,
+                                stage["errors"], stage["server_cpu_percent"],
+                                round(stage["server_rss_mb_max"]) if stage["server_rss_mb_max"] else None,
+                                ", FAILING" if stage["failing"] else "")
+                    if stage["real_cars"]:
+                        logger.info("Real cars: %s", stage["real_cars"])
+                    if stage["failing"] and not args.keep_going:
+                        break
+        finally:
+            for component in reversed(components):
+                component.stop()
+
+    failing = next((stage["pairs"] for stage in stages if stage["failing"]), None)
+    with open(args.output, "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "parameters": vars(args),
+            "async_mode": async_mode,
+            "failing_at_pairs": failing,
+            "stages": stages,
+        }, f, indent=2)
+    if failing is not None:
+        logger.info("Failing from %d pairs (%d clients) on", failing, 2 * failing)
+    else:
+        logger.info("No stage failed")
+    logger.info("Results written to %s", args.output)
+
+if __name__ == "__main__":
+    main()
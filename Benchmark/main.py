@@ -0,0 +1,521 @@
+# Headless loopback benchmark: signaling server, CarBrain and a controller peer on one Linux box.
+# - SignalingServer/main.py is run in a subprocess on a local port
+# - CarBrain runs main_with_placeholder_video.py's offer handling in a subprocess (car_runner.py)
+#   with the fake actuator backend and the synthetic test pattern
+# - this process is the controller: a headless aiortc peer doing what webrtc.js / main.js do, sending
+#   binary control packets at a configurable rate with in-process jitter and loss, plus --viewers
+#   peers that only watch the (shared) video
+# Results are written as JSON (see --output). For kernel-level impairment of the video as well, run it
+# under netem instead, e.g. `tc qdisc add dev lo root netem delay 20ms 5ms loss 1%`.
+# Usage: python main.py [--port 8090] [--rate 40] [--duration 20] [--jitter-ms 0] [--loss 0] [--reconnect] [--viewers 0] [--jitter-buffer] [--dashcam]
+#        [--signaling compact|trickle] [--signaling-delay-ms 0] [--control-process] [--output benchmark_results.json]
+
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+
+import socketio
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "CarBrain"))
+
+from protocol import encode_packet, decode_telemetry, PACKET_CONTROL, PACKET_PING, AXIS_SCALE
+from GPIO import SERVO_PIN
+from engine import SERVO_NO_INPUT_STOP_DELAY
+from calibration import calibration
+from telemetry import METRICS
+
+SIGNALING_PORT = 8090
+METRICS_PORT = 9108
+SIGNALING_TOKEN = "benchmark"
+CAR_ID = "benchmark"
+STARTUP_TIMEOUT = 15 # Seconds to wait for the server and the car to come up
+CONNECT_TIMEOUT = 15 # Seconds to wait for the data channel and the first video frame
+SWEEP_STEPS = 100 # Distinct steering values cycled through, so every PWM write maps back to its input
+FAILSAFE_TRIALS = 3
+FAILSAFE_BURST = 5 # Packets sent before each failsafe trial's silence
+FAILSAFE_WAIT = 0.6 # Seconds of silence per failsafe trial
+PING_INTERVAL = 1.0 # As main.js
+CALIBRATION_PATH = os.path.join(ROOT_DIR, "CarBrain", "calibration.json") # The car's calibration, the expected pulse widths are looked up in it as well
+HISTOGRAM_BUCKET_MS = 1.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+logger = logging.getLogger("benchmark")
+
+def sweep_value(i):
+    # Never inside the steering deadband: a centred servo can't be told apart from the failsafe reset
+    deadband = calibration.curve("steering").deadband
+    step = i % SWEEP_STEPS - (SWEEP_STEPS - 1) / 2
+    magnitude = deadband + (abs(step) + 0.5) / (SWEEP_STEPS / 2) * (0.9 - deadband)
+    return magnitude if step > 0 else -magnitude
+
+def servo_pulse_width(sterring):
+    # Same quantisation and mapping as protocol.py and engine.handle_controller_input
+    return calibration.pulse("steering", round(sterring * AXIS_SCALE) / AXIS_SCALE)
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return {"count": len(ordered), "min": ordered[0], "p50": pick(50), "p95": pick(95), "p99": pick(99), "max": ordered[-1]}
+
+def histogram(values, bucket=HISTOGRAM_BUCKET_MS):
+    # {bucket lower bound in ms: count}
+    counts = {}
+    for value in values:
+        lower = int(value // bucket) * bucket
+        counts[lower] = counts.get(lower, 0) + 1
+    return {"bucket_ms": bucket, "counts": {str(k): counts[k] for k in sorted(counts)}}
+
+def process_cpu_seconds(pid):
+    # utime + stime from /proc/<pid>/stat (fields after the command name)
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+class Component:
+    """A benchmarked subprocess. Output is kept in memory and checked for a readiness line."""
+    def __init__(self, name, args, cwd, env, ready_line=None):
+        self.name = name
+        self.ready = threading.Event()
+        self.output = []
+        self._ready_line = ready_line
+        self.process = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        threading.Thread(target=self._read_output, name=f"{name}-output", daemon=True).start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            self.output.append(line.rstrip())
+            if self._ready_line is not None and self._ready_line in line:
+                self.ready.set()
+
+    def cpu_seconds(self):
+        return process_cpu_seconds(self.process.pid)
+
+    def stop(self, timeout=10):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def tail(self, lines=20):
+        return "\n".join(self.output[-lines:])
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class Controller:
+    """Headless stand-in for the browser controller (webrtc.js / main.js), as the driver or a viewer."""
+    def __init__(self, rate, jitter, loss, role="driver", car_id=CAR_ID, signaling="compact", signaling_delay=0):
+        self.role = role
+        self.car_id = car_id
+        self.rate = rate
+        self.jitter = jitter
+        self.loss = loss
+        self.signaling = signaling # "compact" (one deflated offer with the candidates) or "trickle", as webrtc.js
+        self.signaling_delay = signaling_delay # Emulated one-way delay of each signaling message, seconds
+        self.signaling_bytes = 0 # Sent
+        self.sio = socketio.AsyncClient()
+        self.peer_connection = None
+        self.channel = None
+        self.channel_open = None
+        self.first_frame = None
+        self.restart_requested = asyncio.Event()
+        self.seq = 0
+        self.sends = [] # [input time, channel send time or None if lost, servo pulse width], epoch seconds
+        self.frame_times = []
+        self.ping_rtts = []
+        self.telemetry = [] # (receive time, {metric: value})
+        self.timings = {}
+        self._answered = None
+        self._latest_ping = None
+
+    async def connect(self, url):
+        @self.sio.on("answer")
+        async def on_answer(answer_json):
+            await asyncio.sleep(self.signaling_delay)
+            answer = json.loads(zlib.decompress(answer_json) if isinstance(answer_json, bytes) else answer_json)
+            await self.peer_connection.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+            self._answered.set()
+
+        # The car detected a stalled connection, as webrtc.js
+        @self.sio.on("restart")
+        async def on_restart(data=None):
+            self.restart_requested.set()
+
+        start = time.monotonic()
+        await self.sio.connect(f"{url}/?token={SIGNALING_TOKEN}&car_id={self.car_id}&role={self.role}")
+        self.timings["signaling_ms"] = (time.monotonic() - start) * 1000
+        self.timings.update(await self.negotiate(start))
+
+    async def negotiate(self, start):
+        # New peer connection and offer, returns the setup phases in ms since start
+        timings = {}
+        if self.peer_connection is not None:
+            await self.peer_connection.close()
+        self.peer_connection = RTCPeerConnection()
+        self._answered = asyncio.Event()
+        self.channel_open = asyncio.Event()
+        self.first_frame = asyncio.Event()
+
+        @self.peer_connection.on("track")
+        def on_track(track):
+            asyncio.ensure_future(self._receive_video(track))
+
+        self.channel = self.peer_connection.createDataChannel("controllerInput")
+        self.channel.on("open", self.channel_open.set)
+        self.channel.on("message", self._on_message)
+        telemetry = self.peer_connection.createDataChannel("telemetry", ordered=False, maxRetransmits=0)
+        telemetry.on("message", self._on_telemetry)
+        self.peer_connection.addTransceiver("video", direction="recvonly")
+
+        # aiortc gathers all candidates before setLocalDescription returns, so the offer carries them
+        await self.peer_connection.setLocalDescription(await self.peer_connection.createOffer())
+        timings["offer_ms"] = (time.monotonic() - start) * 1000
+        sdp = self.peer_connection.localDescription.sdp
+        if self.signaling == "compact":
+            await self._emit("offer", zlib.compress(json.dumps({"sdp": sdp, "type": "offer"}).encode(), 9))
+        else:
+            # As a browser trickling: the offer without candidates, then one message per candidate
+            lines = sdp.splitlines()
+            candidates = [line[2:] for line in lines if line.startswith("a=candidate:")]
+            offer = "\r\n".join(line for line in lines if not line.startswith(("a=candidate:", "a=end-of-candidates"))) + "\r\n"
+            await self._emit("offer", json.dumps({"sdp": offer, "type": "offer"}))
+            # Bundled, so the first media section's candidates are all the candidates
+            mid = next(line[6:] for line in lines if line.startswith("a=mid:"))
+            for candidate in dict.fromkeys(candidates):
+                await self._emit("ice_candidate", json.dumps({"candidate": candidate, "sdpMid": mid, "sdpMLineIndex": 0}))
+        timings["offer_sent_ms"] = (time.monotonic() - start) * 1000
+
+        await asyncio.wait_for(self._answered.wait(), CONNECT_TIMEOUT)
+        timings["answer_ms"] = (time.monotonic() - start) * 1000
+        await asyncio.wait_for(self.channel_open.wait(), CONNECT_TIMEOUT)
+        timings["data_channel_open_ms"] = (time.monotonic() - start) * 1000
+        await asyncio.wait_for(self.first_frame.wait(), CONNECT_TIMEOUT)
+        timings["first_frame_ms"] = (time.monotonic() - start) * 1000
+        return timings
+
+    async def _emit(self, event, data):
+        # Delayed in flight rather than here, so messages sent back to back stay back to back
+        self.signaling_bytes += len(data)
+        if self.signaling_delay:
+            asyncio.get_running_loop().call_later(self.signaling_delay, asyncio.ensure_future, self.sio.emit(event, data))
+        else:
+            await self.sio.emit(event, data)
+
+    async def reconnect_trial(self):
+        # Go silent as on a network change, wait for the car to detect the stall and ask for a reconnect,
+        # then reconnect and drive again. Returns the phases in ms since the silence started
+        start = time.monotonic()
+        self.restart_requested.clear()
+        await asyncio.wait_for(self.restart_requested.wait(), CONNECT_TIMEOUT)
+        timings = {"restart_requested_ms": (time.monotonic() - start) * 1000}
+        timings.update(await self.negotiate(start))
+        self.send_control(0.2, 0.5)
+        return timings
+
+    async def _receive_video(self, track):
+        while True:
+            try:
+                await track.recv()
+            except MediaStreamError:
+                return
+            self.frame_times.append(time.monotonic())
+            self.first_frame.set()
+
+    def _on_telemetry(self, message):
+        snapshot = decode_telemetry(message)
+        if snapshot is not None:
+            values = {name: None if math.isnan(value) else value for (name, _, _), value in zip(METRICS, snapshot.values)}
+            self.telemetry.append((time.monotonic(), values))
+
+    def _on_message(self, message):
+        # Pong from the car, as main.js
+        if self._latest_ping is not None and isinstance(message, str):
+            self.ping_rtts.append(time.time() * 1000 - self._latest_ping)
+            self._latest_ping = None
+
+    def _transmit(self, data, record):
+        if self.channel.readyState == "open":
+            self.channel.send(data)
+            record[1] = time.time()
+
+    def send_control(self, throttle, sterring):
+        # Input time is when the controller produced the packet, before emulated network delay and loss
+        now = time.time()
+        data = encode_packet(PACKET_CONTROL, self.seq, now * 1000, throttle, sterring)
+        self.seq += 1
+        record = [now, None, servo_pulse_width(sterring)]
+        self.sends.append(record)
+        if random.random() < self.loss:
+            return
+        delay = random.uniform(0, self.jitter) if self.jitter else 0
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._transmit, data, record)
+        else:
+            self._transmit(data, record)
+
+    async def drive(self, duration, throttle=0.2, profile=False):
+        # Steering sweep at a fixed rate, plus a ping every PING_INTERVAL. With profile, the car profiles the whole drive
+        interval = 1 / self.rate
+        if profile:
+            self.channel.send(f"profile {duration + 1} sample")
+        start = time.monotonic()
+        next_ping = start
+        i = 0
+        while time.monotonic() - start < duration:
+            self.send_control(throttle, sweep_value(i))
+            i += 1
+            if time.monotonic() >= next_ping:
+                self._latest_ping = time.time() * 1000
+                self.channel.send(encode_packet(PACKET_PING, 0, self._latest_ping))
+                next_ping += PING_INTERVAL
+            await asyncio.sleep(max(0, start + i * interval - time.monotonic()))
+        if profile:
+            self.channel.send("profile stop")
+
+    async def watch(self, duration):
+        # Viewer: only the pings, which keep the car's stall detection quiet
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            self.channel.send(encode_packet(PACKET_PING, 0, time.time() * 1000))
+            await asyncio.sleep(PING_INTERVAL)
+
+    async def failsafe_trials(self, trials):
+        # Short bursts followed by silence; returns the time of the last transmitted packet of each trial
+        last_sends = []
+        for trial in range(trials):
+            first = len(self.sends)
+            for i in range(FAILSAFE_BURST):
+                self.send_control(0.2, 0.5 + trial * 0.1)
+                await asyncio.sleep(1 / self.rate)
+            await asyncio.sleep(self.jitter)
+            sent = [r[1] for r in self.sends[first:] if r[1] is not None]
+            await asyncio.sleep(FAILSAFE_WAIT)
+            last_sends.append(max(sent) if sent else None)
+        return last_sends
+
+    async def close(self):
+        await self.peer_connection.close()
+        await self.sio.disconnect()
+
+def input_to_pwm_latencies(sends, writes, until):
+    # Each servo write is matched to the latest input with the same pulse width produced before it
+    by_pulse_width = {}
+    for input_time, sent, pulse_width in sends:
+        if sent is not None and input_time < until:
+            by_pulse_width.setdefault(pulse_width, []).append(input_time)
+    latencies = []
+    for write_time, pin, pulse_width in writes:
+        if pin != SERVO_PIN or write_time >= until + 1 or pulse_width not in by_pulse_width:
+            continue
+        times = by_pulse_width[pulse_width]
+        index = bisect.bisect_right(times, write_time)
+        if index:
+            latencies.append((write_time - times[index - 1]) * 1000)
+    return latencies
+
+def failsafe_reactions(last_sends, writes):
+    # Time from the last transmitted packet to the servo being centred, and how late that was after the timeout
+    reactions = []
+    for last_send in last_sends:
+        if last_send is None:
+            continue
+        resets = [t for t, pin, pw in writes if pin == SERVO_PIN and pw == calibration.neutral("steering") and t > last_send]
+        if resets:
+            reactions.append((min(resets) - last_send) * 1000)
+    return reactions
+
+async def run_controller(args, components, signaling_url):
+    controller = Controller(args.rate, args.jitter_ms / 1000, args.loss, signaling=args.signaling, signaling_delay=args.signaling_delay_ms / 1000)
+    viewers = [Controller(args.rate, 0, 0, role="viewer", signaling=args.signaling, signaling_delay=args.signaling_delay_ms / 1000)
+               for _ in range(args.viewers)]
+    try:
+        await controller.connect(signaling_url)
+        for viewer in viewers:
+            await viewer.connect(signaling_url)
+
+        cpu_start = {name: c.cpu_seconds() for name, c in components.items()}
+        cpu_start["controller"] = time.process_time()
+        drive_start = time.monotonic()
+        frames_before = [len(peer.frame_times) for peer in [controller] + viewers]
+        await asyncio.gather(controller.drive(args.duration, profile=args.profile), *[viewer.watch(args.duration) for viewer in viewers])
+        drive_time = time.monotonic() - drive_start
+        frames, *viewer_frames = [len(peer.frame_times) - before for peer, before in zip([controller] + viewers, frames_before)]
+        cpu = {name: (c.cpu_seconds() - cpu_start[name]) / drive_time * 100 for name, c in components.items()}
+        cpu["controller"] = (time.process_time() - cpu_start["controller"]) / drive_time * 100
+        drive_end = time.time()
+
+        last_sends = await controller.failsafe_trials(args.failsafe_trials)
+        reconnect = await controller.reconnect_trial() if args.reconnect else None
+        # Let the car see the first control packet on the new connection
+        await asyncio.sleep(0.5)
+    finally:
+        for viewer in viewers:
+            if viewer.peer_connection is not None:
+                await viewer.close()
+        await controller.close()
+    return controller, drive_end, frames / drive_time, [f / drive_time for f in viewer_frames], cpu, last_sends, reconnect
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless loopback benchmark of signaling, CarBrain and a controller peer")
+    parser.add_argument("--rate", type=float, default=40, help="control packets per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of driving")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="uniform random delay added to each control packet")
+    parser.add_argument("--loss", type=float, default=0, help="probability of dropping a control packet")
+    parser.add_argument("--port", type=int, default=SIGNALING_PORT, help="local signaling server port")
+    parser.add_argument("--failsafe-trials", type=int, default=FAILSAFE_TRIALS)
+    parser.add_argument("--reconnect", action="store_true", help="also measure a stall-triggered reconnect")
+    parser.add_argument("--jitter-buffer", action="store_true", help="enable the car's control input jitter buffer")
+    parser.add_argument("--dashcam", action="store_true", help="record the car's dashcam while driving")
+    parser.add_argument("--control-process", action="store_true", help="drive the actuators from the car's separate control process")
+    parser.add_argument("--viewers", type=int, default=0, help="peers that only watch the video alongside the driver")
+    parser.add_argument("--profile", action="store_true", help="run the car's profiling mode (with the sampling profiler) while driving")
+    parser.add_argument("--signaling", choices=("compact", "trickle"), default="compact",
+                        help="offer with every candidate in one deflated message, or trickled candidates")
+    parser.add_argument("--signaling-delay-ms", type=float, default=0, help="emulated one-way delay of each signaling message")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="port of the car's Prometheus endpoint")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    calibration.load(CALIBRATION_PATH)
+
+    signaling_url = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        # Both the server and CarBrain import settings from a config module that is not in the repo
+        with open(os.path.join(tmp, "config.py"), "w") as f:
+            f.write(f"SIGNALING_SERVER_URL = '{signaling_url}'\nSIGNALING_SERVER_TOKEN = '{SIGNALING_TOKEN}'\n")
+        env = dict(os.environ, PYTHONPATH=tmp, PYTHONUNBUFFERED="1")
+        car_results = os.path.join(tmp, "car_results.json")
+
+        components = {}
+        try:
+            startup = time.monotonic()
+            # The server's own __main__ refuses Werkzeug outside development, so run its app directly
+            server = f"import main; main.socketio.run(main.app, host='127.0.0.1', port={args.port}, allow_unsafe_werkzeug=True)"
+            components["signaling"] = Component("signaling", [sys.executable, "-c", server], os.path.join(ROOT_DIR, "SignalingServer"), env)
+            if not wait_for_port(args.port, STARTUP_TIMEOUT):
+                raise RuntimeError(f"Signaling server did not start:\n{components['signaling'].tail()}")
+            components["car"] = Component(
+                "car", [sys.executable, os.path.join(BENCHMARK_DIR, "car_runner.py"), signaling_url, SIGNALING_TOKEN, CAR_ID, car_results]
+                + ["--metrics-port", str(args.metrics_port)] + (["--jitter-buffer"] if args.jitter_buffer else []) + (["--dashcam"] if args.dashcam else [])
+                + (["--control-process"] if args.control_process else []),
+                BENCHMARK_DIR, env, ready_line="Connected to the signaling server")
+            if not components["car"].ready.wait(STARTUP_TIMEOUT):
+                raise RuntimeError(f"CarBrain did not connect to the signaling server:\n{components['car'].tail()}")
+            startup_ms = (time.monotonic() - startup) * 1000
+            logger.info("Server and car up in %.0f ms, connecting controller", startup_ms)
+
+            controller, drive_end, fps, viewer_fps, cpu, last_sends, reconnect = asyncio.run(run_controller(args, components, signaling_url))
+            with urllib.request.urlopen(f"{signaling_url}/stats") as response:
+                signaling_stats = json.load(response)
+            with urllib.request.urlopen(f"http://127.0.0.1:{args.metrics_port}/metrics") as response:
+                metrics = response.read().decode()
+        finally:
+            for component in reversed(list(components.values())):
+                component.stop()
+
+        with open(car_results) as f:
+            car = json.load(f)
+
+    latencies = input_to_pwm_latencies(controller.sends, car["writes"], drive_end)
+    reactions = failsafe_reactions(last_sends, car["writes"])
+    transmitted = sum(1 for r in controller.sends if r[1] is not None)
+    snapshots = controller.telemetry
+    telemetry = {
+        "snapshots": len(snapshots),
+        "rate_hz": (len(snapshots) - 1) / (snapshots[-1][0] - snapshots[0][0]) if len(snapshots) > 1 else None,
+        "last": snapshots[-1][1] if snapshots else None,
+        "metrics_endpoint_samples": sum(1 for line in metrics.splitlines() if line and not line.startswith("#")),
+    }
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": vars(args),
+        "startup_ms": startup_ms,
+        "car_startup_ms": car["startup"],
+        "connection_setup_ms": controller.timings,
+        "signaling_bytes_sent": controller.signaling_bytes,
+        "car_setup_ms": car["setup"],
+        "reconnect_ms": reconnect,
+        "car_reconnect_ms": car["reconnect_ms"],
+        "signaling": signaling_stats,
+        "input_to_pwm_ms": percentiles(latencies),
+        "input_to_pwm_histogram": histogram(latencies),
+        "inputs": {"sent": len(controller.sends), "transmitted": transmitted, "applied": len(latencies)},
+        "failsafe_reaction_ms": percentiles(reactions),
+        "failsafe_late_ms": percentiles([r - SERVO_NO_INPUT_STOP_DELAY * 1000 for r in reactions]),
+        "failsafe_scheduler": car["failsafe"],
+        "delivered_fps": fps,
+        "viewer_fps": viewer_fps,
+        "peers": car["peers"],
+        "ping_rtt_ms": percentiles(controller.ping_rtts),
+        "cpu_percent": cpu,
+        "actuation": car["actuation"],
+        "actuator_batches": car["batches"],
+        "telemetry": telemetry,
+        "profile": car["profile"],
+        "dashcam": car["dashcam"],
+        "control_process": car["control_process"],
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    logger.info("Car startup (ms since process start): %s", car["startup"])
+    logger.info("Connection setup (%s signaling, %d bytes sent): %s, car phases: %s", args.signaling, controller.signaling_bytes,
+                {k: round(v) for k, v in controller.timings.items()}, car["setup"])
+    logger.info("Input to PWM (ms): %s", results["input_to_pwm_ms"])
+    logger.info("Failsafe reaction (ms): %s", results["failsafe_reaction_ms"])
+    if car["control_process"]:
+        logger.info("Control process: %s", car["control_process"])
+    if car["dashcam"]:
+        logger.info("Dashcam: %s", car["dashcam"])
+    if car["actuation"] and "jitter_buffer" in car["actuation"]:
+        logger.info("Jitter buffer: %s", car["actuation"]["jitter_buffer"])
+    if reconnect is not None:
+        logger.info("Reconnect: %s, car measured %s ms from stall to first control", {k: round(v) for k, v in reconnect.items()}, car["reconnect_ms"])
+    if viewer_fps:
+        logger.info("Viewers received %s fps, car peers: %s", [round(f, 1) for f in viewer_fps], car["peers"])
+    if car["profile"]:
+        logger.info("Car profile p50/p99 ms: %s", {stage: (round(s["p50_ms"], 2), round(s["p99_ms"], 2)) for stage, s in car["profile"]["stages"].items() if s["count"]})
+        logger.info("Car profile top functions: %s", [(leaf, round(share, 3)) for leaf, share in car["profile"].get("sampling", {}).get("top", [])[:8]])
+    logger.info("Telemetry: %s snapshots at %s Hz, last %s, %d samples on the metrics endpoint",
+                telemetry["snapshots"], telemetry["rate_hz"], telemetry["last"], telemetry["metrics_endpoint_samples"])
+    logger.info("Delivered %.1f fps, CPU %%: %s", fps, {k: round(v, 1) for k, v in cpu.items()})
+    logger.info("Results written to %s", args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# Deterministic replay of recorded control sessions through CarBrain's control path, to compare engine
+# versions or tunings (SERVO_NO_INPUT_STOP_DELAY, STERRING_RANGE, pantilt.RESET_DELAY, calibration, jitter
+# buffer...) on identical traffic.
+# - the input is the driver's data channel messages as the dashcam recorded them (arrival time, payload),
+#   from segment files or a dashcam directory (see CarBrain/dashcam.py)
+# - each message goes through the car's on_message path: protocol.decode_packet, actuation.ControlInput,
+#   ActuationLoop, engine.handle_controller_input and PanTilt, with the failsafe scheduler, against the fake
+#   actuator backend
+# - by default on a virtual clock, as fast as possible: arrivals, actuation ticks and failsafe deadlines are
+#   stepped in time order, so a capture always gives the same timeline. --realtime replays at the recorded
+#   spacing on the car's own threads instead
+# Results are written as JSON: the pulse width timeline (seconds since the first message, pin, pulse width),
+# input to PWM latency, failsafe firings and the actuation stats. --compare <previous results> reports the
+# differences and where the two timelines first diverge.
+# Usage: python replay.py <segment files or dashcam directory> [--realtime] [--jitter-buffer] [--calibration file]
+#        [--rate-hz 100] [--from S] [--to S] [--output replay_results.json] [--compare previous.json]
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+
+from main import input_to_pwm_latencies, percentiles, git_commit, CALIBRATION_PATH
+
+from protocol import decode_packet, PACKET_CONTROL
+from actuation import ActuationLoop, ControlInput, ACTUATION_RATE_HZ
+from actuator_bus import FakeBackend
+from jitter import JitterBuffer
+from failsafe import scheduler
+from pantilt import PanTilt
+from calibration import calibration
+from dashcam import read_segment, segment_order, RECORD_MESSAGE, SEGMENT_EXTENSION
+from GPIO import bus, PAN_PIN, TILT_PIN
+
+TAIL_SECONDS = 1.0 # Replayed after the last message, so the failsafes fire
+
+logger = logging.getLogger("replay")
+
+class VirtualClock:
+    """Monotonic clock of a replay, moved by the replay loop only."""
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def load_messages(paths, start=None, end=None):
+    """(arrival time, message) of every recorded data channel message, in order. start/end in seconds since the first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path), key=segment_order) if name.endswith(SEGMENT_EXTENSION))
+        else:
+            files.append(path)
+    messages = [(t, payload) for path in files for kind, t, flags, payload in read_segment(path) if kind == RECORD_MESSAGE]
+    messages.sort(key=lambda item: item[0])
+    if messages and (start is not None or end is not None):
+        first = messages[0][0]
+        messages = [(t, m) for t, m in messages if (start is None or t - first >= start) and (end is None or t - first <= end)]
+    return messages
+
+class Replay:
+    """The car's control path on the fake backend, as CarBrain/main.py sets it up."""
+    def __init__(self, clock, rate_hz, jitter_buffer, manual):
+        self.clock = clock
+        self.backend = FakeBackend(clock=clock, max_writes=None) # The whole timeline, the capture bounds it
+        bus.set_backend(self.backend)
+        scheduler.clock = clock
+        scheduler.manual = manual
+        self.pantilt = PanTilt(
+            pan_pin=PAN_PIN,
+            tilt_pin=TILT_PIN,
+            invert_pan=True,
+            invert_tilt=False,
+            pan_min_norm=-1, pan_max_norm=1, pan_default_norm=0,
+            tilt_min_norm=-1, tilt_max_norm=1, tilt_default_norm=0
+        )
+        self.actuation = ActuationLoop(pantilt=self.pantilt, rate_hz=rate_hz, jitter_buffer=JitterBuffer() if jitter_buffer else None, clock=clock)
+        self.control = ControlInput(self.actuation)
+        self.sends = [] # As Controller.sends: [arrival, arrival, servo pulse width] of every applied control packet
+        self.malformed = 0
+        self.ignored = 0 # Pings, profiling commands and frame reports
+
+    def deliver(self, message):
+        # What on_message does with the driver's messages, minus the replies
+        packet = decode_packet(message)
+        if packet is None:
+            self.malformed += 1
+        elif packet.type != PACKET_CONTROL:
+            self.ignored += 1
+        elif self.control.apply(packet):
+            now = self.clock()
+            self.sends.append([now, now, calibration.pulse("steering", packet.sterring)])
+
+def run_virtual(messages, args):
+    start = messages[0][0]
+    clock = VirtualClock(start)
+    replay = Replay(clock, args.rate_hz, args.jitter_buffer, manual=True)
+    period = 1 / args.rate_hz
+    end = messages[-1][0] + TAIL_SECONDS
+    ticks = 0
+    index = 0
+    while True:
+        next_tick = start + ticks * period
+        next_message = messages[index][0] if index < len(messages) else None
+        now = min(t for t in (next_tick, next_message, scheduler.next_deadline()) if t is not None)
+        if now > end:
+            break
+        clock.now = now
+        # Same order at equal times every run: failsafes that are due, arrivals, then the tick
+        scheduler.run_due()
+        while index < len(messages) and messages[index][0] <= now:
+            replay.deliver(messages[index][1])
+            index += 1
+        if next_tick <= now:
+            replay.actuation.tick()
+            ticks += 1
+    return replay, start
+
+def run_realtime(messages, args):
+    offset = time.monotonic() - messages[0][0]
+    replay = Replay(time.monotonic, args.rate_hz, args.jitter_buffer, manual=False)
+    replay.actuation.start()
+    try:
+        for t, message in messages:
+            delay = t + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            replay.deliver(message)
+        time.sleep(TAIL_SECONDS)
+    finally:
+        replay.actuation.stop()
+    return replay, messages[0][0] + offset
+
+def compare(results, previous):
+    before, after = previous["input_to_pwm_ms"] or {}, results["input_to_pwm_ms"] or {}
+    logger.info("Input to PWM p50 %s -> %s ms, p99 %s -> %s ms", before.get("p50"), after.get("p50"), before.get("p99"), after.get("p99"))
+    logger.info("Failsafe firings %s -> %s, writes %s -> %s",
+                previous["failsafe"]["fired"], results["failsafe"]["fired"], len(previous["timeline"]), len(results["timeline"]))
+    if previous["messages"] != results["messages"]:
+        logger.warning("The results are of different captures (%d and %d messages)", previous["messages"], results["messages"])
+    if previous["timeline_sha256"] == results["timeline_sha256"]:
+        logger.info("Identical pulse width timelines")
+        return
+    diverged = next((i for i, (a, b) in enumerate(zip(previous["timeline"], results["timeline"])) if a != b),
+                    min(len(previous["timeline"]), len(results["timeline"])))
+    if diverged < len(results["timeline"]):
+        logger.info("Timelines diverge at %.3f s: %s -> %s", results["timeline"][diverged][0],
+                    previous["timeline"][diverged] if diverged < len(previous["timeline"]) else None, results["timeline"][diverged])
+    else:
+        logger.info("Timelines diverge at %.3f s: %s -> end", previous["timeline"][diverged][0], previous["timeline"][diverged])
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded control sessions through CarBrain's control path")
+    parser.add_argument("paths", nargs="+", help="dashcam segment files or directories")
+    parser.add_argument("--realtime", action="store_true", help="replay at the recorded spacing on the car's threads instead of a virtual clock")
+    parser.add_argument("--jitter-buffer", action="store_true", help="enable the control input jitter buffer")
+    parser.add_argument("--calibration", default=CALIBRATION_PATH, help="calibration file (see CarBrain/calibration.py)")
+    parser.add_argument("--rate-hz", type=float, default=ACTUATION_RATE_HZ, help="actuation tick rate")
+    parser.add_argument("--from", dest="start", type=float, default=None, help="seconds into the capture to start at")
+    parser.add_argument("--to", dest="end", type=float, default=None, help="seconds into the capture to stop at")
+    parser.add_argument("--output", default="replay_results.json")
+    parser.add_argument("--compare", default=None, help="results of an earlier replay of the same capture")
+    parser.add_argument("--verbose", action="store_true", help="log every failsafe firing and reset")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not args.verbose:
+        for name in ("failsafe", "GPIO"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    calibration.load(args.calibration)
+
+    messages = load_messages(args.paths, args.start, args.end)
+    if not messages:
+        raise SystemExit("No recorded data channel messages (is the capture from a dashcam with message records?)")
+    duration = messages[-1][0] - messages[0][0]
+    logger.info("Replaying %d messages (%.1f s) %s", len(messages), duration, "in real time" if args.realtime else "on a virtual clock")
+    started = time.monotonic()
+    replay, start = (run_realtime if args.realtime else run_virtual)(messages, args)
+    elapsed = time.monotonic() - started
+
+    timeline = [[round(t - start, 6), pin, pulse_width] for t, pin, pulse_width in replay.backend.writes]
+    latencies = input_to_pwm_latencies(replay.sends, replay.backend.writes, messages[-1][0] - messages[0][0] + start)
+    writes_per_pin = {}
+    for _, pin, _ in timeline:
+        writes_per_pin[str(pin)] = writes_per_pin.get(str(pin), 0) + 1
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": vars(args),
+        "mode": "realtime" if args.realtime else "virtual",
+        "messages": len(messages),
+        "duration_s": duration,
+        "replay_s": elapsed,
+        "inputs": {
+            "applied": len(replay.sends),
+            "stale_dropped": replay.control.sequence_filter.dropped,
+            "malformed": replay.malformed,
+            "other": replay.ignored,
+        },
+        "input_to_pwm_ms": percentiles(latencies),
+        "failsafe": scheduler.stats(),
+        "actuation": replay.actuation.stats(),
+        "writes_per_pin": writes_per_pin,
+        "timeline_sha256": hashlib.sha256(json.dumps(timeline).encode()).hexdigest(),
+        "timeline": timeline,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f)
+
+    logger.info("Replayed in %.2f s: %s", elapsed, results["inputs"])
+    logger.info("Input to PWM (ms): %s", results["input_to_pwm_ms"])
+    logger.info("Failsafe: %s, writes per pin: %s", results["failsafe"], writes_per_pin)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    logger.info("Results written to %s", args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,49 @@
 # Configure GPIO pins and pulse width constants here
 
-import pigpio # pigpio instead of RPi.GPIO for hardware PWM (must run as service)
+import logging
+
+from actuator_bus import ActuatorBus # Single pigpio connection (pigpio instead of RPi.GPIO for hardware PWM, must run as service)
+
+logger = logging.getLogger(__name__)
 
 # BCM numbering scheme
 SERVO_PIN = 12
 MOTOR_PIN = 13
+PAN_PIN = 6
+TILT_PIN = 5
 # Default pulse width for servo and motor
 SERVO_CENTERED_PW = 1500
 MOTOR_STOPPED_PW = 1500
 
-# Initialize pigpio library and GPIO pin
-pi = pigpio.pi()
-
-# Fake pigpio pi object for testing on non-Raspberry Pi devices
-# class fake_pi:
-#     def __init__(self):
-#         self.connected = True
-#         self.set_servo_pulsewidth = lambda pin, pw: None
-#         self.set_servo_pulsewidth = lambda pin, pw: None
-#         self.stop = lambda: print("Stopping pigpio")
-# pi = fake_pi()
-
-if not pi.connected:
-    print("Failed to connect to pigpio")
-    #exit()
+# Shared actuator bus owning all channels. The backend (pigpio, fake or null) is connected by bus.set_backend()
+# at startup (else on first flush), so importing this module no longer needs a pigpio daemon
+bus = ActuatorBus([SERVO_PIN, MOTOR_PIN, PAN_PIN, TILT_PIN])
 
-# Functions to set servo/motor pulse width
+# Functions to set servo/motor pulse width (staged, written on the next bus.flush())
 def set_servo_pulsewidth(pulse_width):
     # Validate pulse width
     if pulse_width < 500 or pulse_width > 2500:
-        print("Invalid pulse width")
+        logger.warning("Invalid servo pulse width %s", pulse_width)
 
     # Set pulse width
-    pi.set_servo_pulsewidth(SERVO_PIN, pulse_width)
-    print(f"Servo pulse width set to {pulse_width}")
+    bus.set(SERVO_PIN, pulse_width)
+    logger.debug("Servo pulse width set to %s", pulse_width)
 
 def set_motor_pulsewidth(pulse_width):
     if pulse_width < 500 or pulse_width > 2500:
-        print("Invalid pulse width")
-
-    pi.set_servo_pulsewidth(MOTOR_PIN, pulse_width)
-    print(f"Motor pulse width set to {pulse_width}")
-
-# Functions to reset pulse width of servo/motor (centered/stopped)
-def reset_servo_pulsewidth():
-    set_servo_pulsewidth(SERVO_CENTERED_PW)
-    print(f"Servo position reset to default: {SERVO_CENTERED_PW}")
-
-def reset_motor_pulsewidth():
-    set_motor_pulsewidth(MOTOR_STOPPED_PW)
-    print(f"Motor position reset to default: {MOTOR_STOPPED_PW}")
-
-#pi.stop()
\ No newline at end of file
+        logger.warning("Invalid motor pulse width %s", pulse_width)
+
+    bus.set(MOTOR_PIN, pulse_width)
+    logger.debug("Motor pulse width set to %s", pulse_width)
+
+# Functions to reset pulse width of servo/motor (centered/stopped, or the calibrated neutral), written immediately
+# on their own pin only, so half of a steering/throttle pair staged for the next tick never goes out alone
+def reset_servo_pulsewidth(pulse_width=SERVO_CENTERED_PW):
+    set_servo_pulsewidth(pulse_width)
+    bus.flush((SERVO_PIN,))
+    logger.info("Servo position reset to default: %s", pulse_width)
+
+def reset_motor_pulsewidth(pulse_width=MOTOR_STOPPED_PW):
+    set_motor_pulsewidth(pulse_width)
+    bus.flush((MOTOR_PIN,))
+    logger.info("Motor position reset to default: %s", pulse_width)
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+import GPIO
+from engine import handle_controller_input
+from profiling import profiler
+from protocol import SequenceFilter
+from log import flight_recorder
+from dashcam import dashcam
+
+logger = logging.getLogger(__name__)
+
+# Default actuation tick rate
+ACTUATION_RATE_HZ = 100
+
+class ActuationLoop:
+    """
+    Fixed-rate actuation stage. Data channel messages only update the latest desired state via submit(),
+    a separate thread applies it at a fixed tick rate (latest wins), writing only the channels that changed.
+    Keeps the blocking pigpio writes off the asyncio event loop and stops bursts of queued commands piling up.
+    With a jitter_buffer (jitter.JitterBuffer), timestamped inputs are replayed at their original spacing
+    instead, and short gaps are bridged before the failsafe takes over.
+    A replay on a virtual clock passes it as clock and calls tick() itself instead of start().
+    """
+    def __init__(self, pantilt=None, rate_hz=ACTUATION_RATE_HZ, bus=None, jitter_buffer=None, clock=time.monotonic):
+        self.pantilt = pantilt
+        self.bus = bus if bus is not None else GPIO.bus
+        self.jitter_buffer = jitter_buffer
+        self.clock = clock
+        self.period = 1.0 / rate_hz
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        # Latest desired state
+        self._throttle = 0.0
+        self._sterring = 0.0
+        self._pan = None
+        self._tilt = None
+        self._inputs_since_tick = 0
+        self._received = None # Arrival of the oldest input not applied yet, only while profiling
+        # Stats
+        self.ticks_applied = 0
+        self.inputs_total = 0
+        self.inputs_coalesced = 0
+        self.max_inputs_per_tick = 0
+        self.last_apply_time = None
+
+    def submit(self, throttle, sterring, pan=None, tilt=None, timestamp=None):
+        # timestamp: sender time in ms, inputs without one (legacy CSV) bypass the jitter buffer
+        with self._lock:
+            if profiler.enabled and self._received is None:
+                self._received = time.monotonic()
+            if self.jitter_buffer is not None and timestamp is not None:
+                self.jitter_buffer.push(timestamp / 1000, (throttle, sterring, pan, tilt), self.clock())
+                return
+            self._throttle = throttle
+            self._sterring = sterring
+            if pan is not None:
+                self._pan = pan
+                self._tilt = tilt
+            self._inputs_since_tick += 1
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="actuation", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def stats(self):
+        stats = {
+            "ticks_applied": self.ticks_applied,
+            "inputs_total": self.inputs_total,
+            "inputs_coalesced": self.inputs_coalesced,
+            "max_inputs_per_tick": self.max_inputs_per_tick,
+        }
+        if self.jitter_buffer is not None:
+            with self._lock:
+                stats["jitter_buffer"] = self.jitter_buffer.stats()
+        return stats
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while self._running:
+            self.tick()
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind (e.g. slow pigpio write), don't try to catch up with a burst of ticks
+                next_tick = time.monotonic()
+
+    def tick(self):
+        with self._lock:
+            if self.jitter_buffer is not None:
+                buffered = self.jitter_buffer.sample(self.clock())
+                if buffered is not None:
+                    self._throttle, self._sterring = buffered[0], buffered[1]
+                    if buffered[2] is not None:
+                        self._pan, self._tilt = buffered[2], buffered[3]
+                    self._inputs_since_tick += 1
+            inputs = self._inputs_since_tick
+            if inputs == 0:
+                return
+            self._inputs_since_tick = 0
+            throttle, sterring, pan, tilt = self._throttle, self._sterring, self._pan, self._tilt
+            received, self._received = self._received, None
+
+        self.ticks_applied += 1
+        self.inputs_total += inputs
+        self.inputs_coalesced += inputs - 1
+        self.max_inputs_per_tick = max(self.max_inputs_per_tick, inputs)
+        self.last_apply_time = self.clock()
+
+        # Stages pulse widths and always re-arms the no-input failsafes
+        handle_controller_input(throttle, sterring)
+
+        if self.pantilt is not None and pan is not None:
+            try:
+                if pan != self.pantilt.pan_norm or tilt != self.pantilt.tilt_norm:
+                    self.pantilt.set_angles(pan, tilt, flush=False)
+                else:
+                    self.pantilt.keep_alive()
+            except Exception:
+                logger.exception("Error setting pantilt angles")
+
+        # One batched write of every channel that changed this tick
+        try:
+            if profiler.enabled:
+                start = time.monotonic()
+                self.bus.flush()
+                now = time.monotonic()
+                profiler.record("actuator_flush", now - start)
+                if received is not None:
+                    profiler.record("control_to_pwm", now - received)
+            else:
+                self.bus.flush()
+        except Exception:
+            logger.exception("Error writing actuator bus")
+
+class ControlInput:
+    """
+    The driver's control packets from one data channel, as on_message hands them over: stale and
+    out-of-order packets are dropped, the rest recorded and submitted to the actuation loop.
+    Benchmark/replay.py feeds recorded sessions through here as well.
+    """
+    def __init__(self, actuation):
+        self.actuation = actuation
+        self.sequence_filter = SequenceFilter()
+
+    def apply(self, packet):
+        """Returns whether the packet was applied."""
+        # Drop stale or out-of-order packets so a delayed one can't override a newer command
+        if not self.sequence_filter.accept(packet.seq):
+            return False
+        flight_recorder.record_control(packet.throttle, packet.sterring, packet.pan, packet.tilt)
+        dashcam.record_control(packet.throttle, packet.sterring, packet.pan, packet.tilt)
+        # Only update the desired state, the actuation loop applies it at a fixed rate (pan/tilt in -1 to 1 range directly)
+        self.actuation.submit(packet.throttle, packet.sterring, packet.pan, packet.tilt, packet.timestamp)
+        return True
@@ -0,0 +1,154 @@
+import collections
+import logging
+import threading
+import time
+
+from log import flight_recorder
+from dashcam import dashcam
+
+logger = logging.getLogger(__name__)
+
+FAKE_MAX_WRITES = 1000000 # Writes a FakeBackend keeps, the oldest are dropped beyond this (~40 minutes of every channel changing at 100 Hz)
+
+class PigpioBackend:
+    """
+    Real hardware backend: one pigpio daemon connection shared by every channel.
+    Batched writes run a stored daemon script that sets all channels in a single socket
+    round trip, falling back to one set_servo_pulsewidth call per channel if scripts are unavailable.
+    """
+    def __init__(self, pins, host="localhost", port=8888):
+        import pigpio # Imported here so the bus can be used on machines without pigpio
+        self._pigpio = pigpio
+        self.pi = pigpio.pi(host, port)
+        if not self.pi.connected:
+            raise RuntimeError("Could not connect to pigpio daemon. Is it running?")
+        self.pins = list(pins)
+        self._script_id = None
+        try:
+            script = " ".join(f"s {pin} p{i}" for i, pin in enumerate(self.pins))
+            self._script_id = self.pi.store_script(script.encode())
+            # Wait for the daemon to finish compiling the script
+            while self.pi.script_status(self._script_id)[0] == pigpio.PI_SCRIPT_INITING:
+                time.sleep(0.001)
+        except Exception as e:
+            logger.warning("pigpio scripts unavailable, using one write per channel: %s", e)
+            self._script_id = None
+
+    def write(self, changed, pulses):
+        # changed: {pin: pulse width} written this batch, pulses: current pulse width of every channel
+        if self._script_id is not None and len(changed) > 1:
+            self.pi.run_script(self._script_id, [pulses[pin] for pin in self.pins])
+        else:
+            for pin, pulse_width in changed.items():
+                self.pi.set_servo_pulsewidth(pin, pulse_width)
+
+    def close(self):
+        if self._script_id is not None:
+            self.pi.delete_script(self._script_id)
+        self.pi.stop()
+
+class FakeBackend:
+    """
+    In-process backend that records the last max_writes writes as (monotonic time, pin, pulse width), for
+    benchmarks on a dev box. max_writes=None keeps all of them.
+    """
+    def __init__(self, pins=None, clock=time.monotonic, max_writes=FAKE_MAX_WRITES):
+        self.clock = clock # A replay's virtual clock instead
+        self.writes = collections.deque(maxlen=max_writes)
+        self.batches = 0
+
+    def write(self, changed, pulses):
+        now = self.clock()
+        self.batches += 1
+        self.writes.extend((now, pin, pulse_width) for pin, pulse_width in changed.items())
+
+    def close(self):
+        pass
+
+class NullBackend:
+    """Discards all writes."""
+    def __init__(self, pins=None):
+        pass
+
+    def write(self, changed, pulses):
+        pass
+
+    def close(self):
+        pass
+
+BACKENDS = {"pigpio": PigpioBackend, "fake": FakeBackend, "null": NullBackend}
+
+class ActuatorBus:
+    """
+    Owns all actuator channels (servo, motor, pan, tilt). set() only stages a pulse width,
+    flush() pushes every changed channel to the backend in one batched write.
+    The actuation loop flushes once per tick; failsafe resets flush their own pins immediately, leaving
+    what the actuation loop staged for its tick.
+    """
+    def __init__(self, pins, backend=None):
+        self.pins = list(pins)
+        self._pulses = {pin: 0 for pin in self.pins}
+        self._written = dict(self._pulses)
+        self._lock = threading.Lock()
+        self._backend = backend
+        # Stats
+        self.flushes = 0
+        self.channel_writes = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            # Nobody called set_backend() at startup
+            self._backend = self._connect("pigpio")
+        return self._backend
+
+    def _connect(self, name):
+        try:
+            return BACKENDS[name](self.pins)
+        except Exception as e:
+            # Once, instead of on every tick and failsafe reset
+            logger.error("Could not connect the %s actuator backend, discarding all actuator writes: %s", name, e)
+            return NullBackend(self.pins)
+
+    def set_backend(self, backend):
+        # backend: name from BACKENDS or a backend instance. Connects now, so a missing pigpio daemon shows at startup
+        if isinstance(backend, str):
+            backend = self._connect(backend)
+        with self._lock:
+            if self._backend is not None:
+                self._backend.close()
+            self._backend = backend
+            self._written = {pin: 0 for pin in self.pins}
+
+    def set(self, pin, pulse_width):
+        with self._lock:
+            self._pulses[pin] = int(pulse_width)
+
+    def get(self, pin):
+        return self._pulses[pin]
+
+    def flush(self, pins=None):
+        # pins: only write these, the other channels keep their staged pulse widths for the next flush
+        with self._lock:
+            changed = {pin: self._pulses[pin] for pin in (self.pins if pins is None else pins) if self._pulses[pin] != self._written[pin]}
+            if not changed:
+                return 0
+            self.backend.write(changed, {**self._written, **changed})
+            self._written.update(changed)
+            self.flushes += 1
+            self.channel_writes += len(changed)
+        for pin, pulse_width in changed.items():
+            flight_recorder.record_actuation(pin, pulse_width)
+            dashcam.record_actuation(pin, pulse_width)
+        return len(changed)
+
+    def write(self, pin, pulse_width):
+        # Stage and flush in one call, for writes that must not wait for the next tick
+        self.set(pin, pulse_width)
+        return self.flush((pin,))
+
+    def close(self):
+        with self._lock:
+            if self._backend is not None:
+                self._backend.close()
+                self._backend = None
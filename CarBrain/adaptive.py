@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from collections import deque, namedtuple
+
+from rtp_sender import get_private, ENCODER
+
+logger = logging.getLogger(__name__)
+
+# One step of the adaptation ladder: encoder target bitrate (bps), capture size and frame rate, and the
+# layer of a simulcast encoder to send (None: the one for size, see SharedEncoder.layer_for). None leaves it as is
+Rung = namedtuple("Rung", "bitrate size fps layer", defaults=(None,))
+
+# Lowest to highest. Note aiortc clamps the encoder target bitrate (H264: 0.5-3 Mbps, VP8: 0.25-1.5 Mbps)
+DEFAULT_LADDER = [
+    Rung(300_000, (320, 240), 15),
+    Rung(500_000, (320, 240), 30),
+    Rung(800_000, (640, 480), 20),
+    Rung(1_200_000, (640, 480), 30),
+    Rung(2_000_000, (640, 480), 30),
+]
+DEFAULT_START_RUNG = 3
+
+# A viewer only picks which layer of the simulcast encoder it receives (fanout.LAYER_LORES and LAYER_MAIN,
+# not imported as fanout loads PyAV), the encoder follows the driver's link
+LAYER_LADDER = [
+    Rung(None, None, None, "lores"),
+    Rung(None, None, None, "main"),
+]
+
+ABR_INTERVAL = 1.0 # Seconds between decisions
+LOSS_HIGH = 0.05 # Fraction lost (from RTCP receiver reports) that steps down one rung
+LOSS_SEVERE = 0.15 # Fraction lost that steps down two rungs
+LOSS_LOW = 0.01 # Fraction lost below which the link counts as clean
+RTT_QUEUE_THRESHOLD = 0.15 # Seconds of RTT above the recent minimum that means packets are queueing
+RTT_WINDOW = 30 # RTT samples kept for the recent minimum
+UP_AFTER_INTERVALS = 5 # Clean intervals needed before stepping up
+HOLD_AFTER_DOWN_INTERVALS = 3 # Intervals to wait after stepping down before stepping up again
+
+class AdaptiveVideoController:
+    """
+    Steps the video encoder bitrate, capture resolution and frame rate through a ladder based on
+    the RTCP receiver reports (loss, RTT) and sender stats of one RTCRtpSender. With encoded fan-out,
+    encoder is the shared encoder whose bitrate is adapted instead of the sender's own. If it is a simulcast
+    encoder, rungs at the low-resolution layer's size move track (the sender's FanoutTrack) to that layer
+    and set its bitrate, instead of restarting the camera at a smaller size.
+    Steps down immediately on loss or queueing delay and only climbs back after a clean period:
+    lower resolution and fewer frames are preferred over frames queueing up on a congested link.
+    """
+    def __init__(self, sender, capture_worker=None, ladder=DEFAULT_LADDER, start_rung=DEFAULT_START_RUNG, interval=ABR_INTERVAL, encoder=None, track=None):
+        self.sender = sender
+        self.capture_worker = capture_worker
+        self.encoder = encoder
+        self.track = track
+        self.ladder = ladder
+        self.rung = min(start_rung, len(ladder) - 1)
+        self.interval = interval
+        self._task = None
+        self._rtts = deque(maxlen=RTT_WINDOW)
+        self._clean_intervals = 0
+        self._hold = 0
+        self._last_bytes_sent = None
+        self._last_report_time = None
+        self._bitrate_applied = False
+        self.decisions = deque(maxlen=100)
+
+    def start(self):
+        if self._task is None:
+            self._apply(self.ladder[self.rung])
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._step()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error in adaptive video controller")
+
+    async def _read_stats(self):
+        loss, rtt, jitter, send_rate = 0.0, None, None, None
+        for stats in (await self.sender.getStats()).values():
+            if stats.type == "remote-inbound-rtp":
+                # Only act on a receiver report once
+                if stats.timestamp == self._last_report_time:
+                    continue
+                self._last_report_time = stats.timestamp
+                loss = (stats.fractionLost or 0) / 256 # 8-bit fixed point in the receiver report
+                rtt = stats.roundTripTime
+                jitter = stats.jitter
+            elif stats.type == "outbound-rtp":
+                if self._last_bytes_sent is not None:
+                    send_rate = (stats.bytesSent - self._last_bytes_sent) * 8 / self.interval
+                self._last_bytes_sent = stats.bytesSent
+        return loss, rtt, jitter, send_rate
+
+    async def _step(self):
+        if not self._bitrate_applied:
+            self._apply_bitrate(self.ladder[self.rung])
+        loss, rtt, jitter, send_rate = await self._read_stats()
+        queueing = 0.0
+        if rtt is not None:
+            self._rtts.append(rtt)
+            queueing = rtt - min(self._rtts)
+
+        if self._hold > 0:
+            self._hold -= 1
+        target = self.rung
+        clean = loss < LOSS_LOW and queueing <= RTT_QUEUE_THRESHOLD
+        self._clean_intervals = self._clean_intervals + 1 if clean else 0
+        if loss > LOSS_SEVERE:
+            target, reason = self.rung - 2, "severe loss"
+        elif loss > LOSS_HIGH:
+            target, reason = self.rung - 1, "loss"
+        elif queueing > RTT_QUEUE_THRESHOLD:
+            target, reason = self.rung - 1, "queueing delay"
+        elif clean:
+            reason = "clean"
+            if self._clean_intervals >= UP_AFTER_INTERVALS and self._hold == 0:
+                target, reason = self.rung + 1, "clean period"
+        else:
+            reason = "moderate loss"
+        target = max(0, min(len(self.ladder) - 1, target))
+
+        decision = {
+            "rung": self.rung, "target": target, "reason": reason, "loss": loss, "rtt": rtt,
+            "queueing": queueing, "jitter": jitter, "send_rate": send_rate, "layer": self._layer(self.ladder[target]),
+        }
+        self.decisions.append(decision)
+
+        if target == self.rung:
+            logger.info("ABR hold rung %d (%s) loss=%.3f rtt=%s queueing=%.0fms send_rate=%s",
+                        self.rung, reason, loss, rtt, queueing * 1000, send_rate)
+            return
+
+        logger.info("ABR rung %d -> %d %s (%s) loss=%.3f rtt=%s queueing=%.0fms send_rate=%s",
+                    self.rung, target, self.ladder[target], reason, loss, rtt, queueing * 1000, send_rate)
+        if target < self.rung:
+            self._hold = HOLD_AFTER_DOWN_INTERVALS
+        self._clean_intervals = 0
+        self.rung = target
+        self._apply(self.ladder[target])
+
+    def _layer(self, rung):
+        if rung.layer is not None or rung.size is None or not getattr(self.encoder, "simulcast", False):
+            return rung.layer
+        return self.encoder.layer_for(rung.size)
+
+    def _apply_bitrate(self, rung):
+        if rung.bitrate is None:
+            self._bitrate_applied = True
+            return
+        # The encoder is created by aiortc on the first frame, until then the bitrate is retried every interval
+        encoder = self.encoder or get_private(self.sender, ENCODER)
+        layer = self._layer(rung)
+        if encoder is not None and layer is not None:
+            encoder = encoder.layers[layer]
+        self._bitrate_applied = encoder is not None and hasattr(encoder, "target_bitrate")
+        if self._bitrate_applied:
+            encoder.target_bitrate = rung.bitrate
+
+    def _apply(self, rung):
+        self._apply_bitrate(rung)
+        layer = self._layer(rung)
+        if self.track is not None and layer is not None:
+            self.track.select(layer)
+        if self.capture_worker is not None and rung.size is not None:
+            # The low-resolution layer is of the same capture, only its frame rate changes
+            size = rung.size if layer in (None, "main") else (self.capture_worker.width, self.capture_worker.height)
+            self.capture_worker.reconfigure(size, rung.fps)
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Inputs arrive quantised to int16 (see protocol.py), every curve is compiled over that whole domain
+AXIS_SCALE = 32767
+LUT_SIZE = 2 * AXIS_SCALE + 1
+RELOAD_CHECK_INTERVAL = 1.0 # Seconds between checks of the calibration file for changes
+CURVE_FIELDS = ("center", "min", "max", "deadband", "expo", "trim", "invert", "limits")
+
+class Curve:
+    """
+    Input (-1..1) to pulse width mapping of one channel:
+    - invert flips the input
+    - deadband (0..1) around the centre maps to center, the rest of the stick travel is rescaled so there is no jump
+    - expo (0..1) blends linear and cubic response for finer control around the centre
+    - min / max are the pulse widths at full negative / positive input, so forward and reverse can differ
+    - trim (µs) shifts the whole curve, the result is clamped to limits (default: min..max)
+    """
+    def __init__(self, center=1500, min=1000, max=2000, deadband=0.0, expo=0.0, trim=0, invert=False, limits=None):
+        self.center = center
+        self.min = min
+        self.max = max
+        self.deadband = deadband
+        self.expo = expo
+        self.trim = trim
+        self.invert = invert
+        self.limits = tuple(limits) if limits is not None else None
+        if not 0 <= deadband < 1 or not 0 <= expo <= 1:
+            raise ValueError(f"deadband must be in 0..1 and expo in 0..1, got {deadband} and {expo}")
+
+    @classmethod
+    def from_normalized(cls, min_norm, max_norm, hw_min, hw_max, **kwargs):
+        # The PanTilt calibration: min_norm..max_norm stretched over hw_min..hw_max, clamped outside
+        slope = (hw_max - hw_min) / (max_norm - min_norm) if max_norm != min_norm else 0
+        center = hw_min - min_norm * slope if slope else (hw_min + hw_max) / 2
+        return cls(center=center, min=center - slope, max=center + slope, limits=(hw_min, hw_max), **kwargs)
+
+    def updated(self, fields):
+        """Copy with some fields replaced, e.g. from a calibration file."""
+        unknown = set(fields) - set(CURVE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown calibration fields: {sorted(unknown)}")
+        values = {field: getattr(self, field) for field in CURVE_FIELDS}
+        values.update(fields)
+        return Curve(**values)
+
+    def values(self, x):
+        """Pulse widths (float array) for an array of inputs in -1..1."""
+        x = -x if self.invert else x
+        y = np.clip((np.abs(x) - self.deadband) / (1 - self.deadband), 0, None)
+        y = (1 - self.expo) * y + self.expo * y ** 3
+        pulse = self.center + self.trim + np.where(x > 0, y * (self.max - self.center), y * (self.min - self.center))
+        low, high = self.limits if self.limits is not None else sorted((self.min, self.max))
+        return np.clip(pulse, low, high)
+
+    def compile(self):
+        """Lookup table of integer pulse widths, indexed by the quantised input + AXIS_SCALE."""
+        # A list rather than the array, indexing it returns plain ints and is faster
+        inputs = (np.arange(LUT_SIZE) - AXIS_SCALE) / AXIS_SCALE
+        return np.rint(self.values(inputs)).astype(int).tolist()
+
+class Calibration:
+    """
+    Per-channel curves (steering, throttle, pan, tilt) compiled to lookup tables, so mapping an input
+    is one list index. Modules register their defaults with set_defaults(), a JSON file
+    ({"steering": {"expo": 0.3, ...}, ...}) overrides any fields of them. watch() reloads the file when
+    it changes. A reload compiles new tables and swaps them in at once, a file with errors is ignored.
+    """
+    def __init__(self):
+        self.path = None
+        self._defaults = {}
+        self._overrides = {}
+        self._curves = {}
+        self._luts = {}
+        self._mtime = None
+        self._watching = False
+        self._thread = None
+        self.reloads = 0
+
+    def set_defaults(self, **curves):
+        self._defaults.update(curves)
+        self._compile(self._overrides)
+
+    def curve(self, channel):
+        return self._curves[channel]
+
+    def pulse(self, channel, value):
+        """Pulse width for an input in -1..1 (clamped)."""
+        index = int(round(value * AXIS_SCALE)) + AXIS_SCALE
+        return self._luts[channel][0 if index < 0 else LUT_SIZE - 1 if index >= LUT_SIZE else index]
+
+    def neutral(self, channel):
+        return self._luts[channel][AXIS_SCALE]
+
+    def _compile(self, overrides):
+        curves = {}
+        for channel, curve in self._defaults.items():
+            curves[channel] = curve.updated(overrides[channel]) if channel in overrides else curve
+        luts = {channel: curve.compile() for channel, curve in curves.items()}
+        # Swapped in together, readers on other threads see either the old or the new tables
+        self._curves, self._luts, self._overrides = curves, luts, overrides
+
+    def load(self, path):
+        """Load overrides from path (missing file: defaults only), raises on an invalid file."""
+        self.path = path
+        try:
+            self._mtime = os.path.getmtime(path)
+        except OSError:
+            self._mtime = None
+            self._compile({})
+            logger.info("No calibration file at %s, using defaults", path)
+            return
+        with open(path) as f:
+            overrides = json.load(f)
+        if not isinstance(overrides, dict) or not all(isinstance(fields, dict) for fields in overrides.values()):
+            raise ValueError("Calibration file must map channel names to objects of curve fields")
+        self._compile(overrides)
+        self.reloads += 1
+        logger.info("Loaded calibration from %s: %s", path, {channel: fields for channel, fields in overrides.items()})
+
+    def reload_if_changed(self):
+        if self.path is None:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        try:
+            self.load(self.path)
+        except (OSError, ValueError, TypeError) as e:
+            # Keep driving on the previous calibration, retried when the file changes again
+            self._mtime = mtime
+            logger.error("Invalid calibration file %s, keeping the previous calibration: %s", self.path, e)
+            return False
+        return True
+
+    def watch(self, path, interval=RELOAD_CHECK_INTERVAL):
+        """Load path now (if it exists) and reload it whenever it changes, checked on a background thread."""
+        if self._watching:
+            return
+        self.path = path
+        self._mtime = None
+        if not self.reload_if_changed():
+            logger.info("Using default calibration, watching %s for changes", path)
+        self._watching = True
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.reload_if_changed()
+        self._stop = stop
+        self._thread = threading.Thread(target=run, name="calibration", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._watching:
+            self._watching = False
+            self._stop.set()
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def stats(self):
+        return {"path": self.path, "reloads": self.reloads, "curves": {channel: vars(curve) for channel, curve in self._curves.items()}}
+
+# Shared instance
+calibration = Calibration()
@@ -0,0 +1,257 @@
+import asyncio
+import fractions
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from aiortc import VideoStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import VideoFrame
+from picamera2 import MappedArray
+
+from latency import FrameTimeline
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+FRAME_POOL_SIZE = 3 # Newest frame + frame being encoded + one being written
+
+# capture_time: sensor timestamp converted to time.monotonic(), published_time: when the worker handed it over,
+# copy_time: seconds spent copying it out of the camera buffer, lores: the same capture from the camera's
+# low-resolution output (None without one)
+CapturedFrame = namedtuple("CapturedFrame", "frame capture_time published_time copy_time lores")
+
+def _sensor_clock_offset():
+    # libcamera's SensorTimestamp is on CLOCK_BOOTTIME, convert it to the time.monotonic() domain
+    if hasattr(time, "CLOCK_BOOTTIME"):
+        return time.monotonic() - time.clock_gettime(time.CLOCK_BOOTTIME)
+    return 0.0
+
+class CaptureWorker:
+    """
+    Captures camera frames on a dedicated thread, off the asyncio event loop.
+    Each frame is copied straight from the camera's mapped buffer into one of a small pool of
+    preallocated yuv420p VideoFrames. Only the newest completed frame is handed over, a frame
+    that was not picked up before the next one completes is dropped instead of queued.
+    With lores_size the camera is configured with its low-resolution output as well (see
+    video_configuration), copied alongside from the same request, so no extra sensor readout.
+    """
+    def __init__(self, camera, size, pool_size=FRAME_POOL_SIZE, lores_size=None):
+        self.camera = camera
+        self.width, self.height = size
+        self.lores_size = tuple(lores_size) if lores_size else None
+        self._pool = self._allocate_pool(pool_size)
+        self._pool_index = 0
+        self._lock = threading.Lock()
+        self._latest = None
+        self._in_use = None
+        self._loop = None
+        self._event = None
+        self._running = False
+        self._thread = None
+        self._pending_config = None
+        self.fps = None
+        self._clock_offset = _sensor_clock_offset()
+        self._ready = threading.Event()
+        # Stats
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_delivered = 0
+        self.copy_time_total = 0.0
+        self.copy_time_max = 0.0
+        self.handoff_latency_total = 0.0
+        self.handoff_latency_max = 0.0
+
+    def _allocate_frame(self, width, height):
+        frame = VideoFrame(width, height, "yuv420p")
+        # Writable numpy views of the Y, U and V planes, reused for every copy
+        views = []
+        for plane, (w, h) in zip(frame.planes, ((width, height), (width // 2, height // 2), (width // 2, height // 2))):
+            views.append(np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:h, :w])
+        return frame, views
+
+    def _allocate_pool(self, pool_size):
+        # (main (frame, views), lores (frame, views) or None) per entry
+        return [(self._allocate_frame(self.width, self.height), self._allocate_frame(*self.lores_size) if self.lores_size else None)
+                for _ in range(pool_size)]
+
+    def video_configuration(self, size, fps=None):
+        """Picamera2 configuration with the main output at size and the low-resolution one, if any."""
+        streams = {"main": {"size": size, "format": "YUV420"}}
+        if self.lores_size:
+            streams["lores"] = {"size": self.lores_size, "format": "YUV420"}
+        return self.camera.create_video_configuration(**streams, controls={"FrameRate": fps} if fps else {})
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+
+    def wait_ready(self, timeout):
+        """Block until the camera delivers settled frames (auto exposure locked, where reported), False on timeout."""
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def stats(self):
+        delivered = self.frames_delivered or 1
+        captured = self.frames_captured or 1
+        return {
+            "frames_captured": self.frames_captured,
+            "frames_dropped": self.frames_dropped,
+            "frames_delivered": self.frames_delivered,
+            "copy_ms_avg": self.copy_time_total / captured * 1000,
+            "copy_ms_max": self.copy_time_max * 1000,
+            "handoff_ms_avg": self.handoff_latency_total / delivered * 1000,
+            "handoff_ms_max": self.handoff_latency_max * 1000,
+        }
+
+    def reconfigure(self, size, fps):
+        """Change capture size and frame rate. Applied on the capture thread between two frames."""
+        with self._lock:
+            self._pending_config = (tuple(size), fps)
+
+    def _apply_config(self, size, fps):
+        if size != (self.width, self.height):
+            # A new size needs the camera restarted, frame rate alone is a control change
+            self.camera.stop()
+            self.camera.configure(self.video_configuration(size, fps))
+            self.camera.start()
+            self.width, self.height = size
+            self._pool = self._allocate_pool(len(self._pool))
+            self._pool_index = 0
+            with self._lock:
+                self._latest = None
+        elif fps != self.fps:
+            self.camera.set_controls({"FrameRate": fps})
+        self.fps = fps
+        logger.info("Capture reconfigured to %sx%s at %s fps", size[0], size[1], fps)
+
+    def _next_free_frame(self):
+        with self._lock:
+            busy = {id(self._in_use)}
+            if self._latest is not None:
+                busy.add(id(self._latest.frame))
+        for _ in range(len(self._pool)):
+            entry = self._pool[self._pool_index]
+            self._pool_index = (self._pool_index + 1) % len(self._pool)
+            if id(entry[0][0]) not in busy:
+                return entry
+        raise RuntimeError("No free frame in capture pool")
+
+    def _copy_into(self, request, views, stream, width, height):
+        # YUV420 buffer from the camera: Y plane then U and V planes, each row `stride` bytes (chroma rows stride / 2)
+        with MappedArray(request, stream) as mapped:
+            flat = mapped.array.reshape(-1)
+            stride = mapped.array.shape[1]
+            y_size = stride * height
+            uv_stride = stride // 2
+            uv_size = uv_stride * (height // 2)
+            np.copyto(views[0], flat[:y_size].reshape(height, stride)[:, :width])
+            np.copyto(views[1], flat[y_size:y_size + uv_size].reshape(height // 2, uv_stride)[:, :width // 2])
+            np.copyto(views[2], flat[y_size + uv_size:y_size + 2 * uv_size].reshape(height // 2, uv_stride)[:, :width // 2])
+
+    def _run(self):
+        while self._running:
+            try:
+                with self._lock:
+                    config, self._pending_config = self._pending_config, None
+                if config is not None:
+                    self._apply_config(*config)
+                (frame, views), lores = self._next_free_frame()
+                wait_start = time.monotonic()
+                request = self.camera.capture_request()
+                if profiler.enabled:
+                    profiler.record("capture_wait", time.monotonic() - wait_start)
+                try:
+                    copy_start = time.monotonic()
+                    self._copy_into(request, views, "main", self.width, self.height)
+                    if lores is not None:
+                        self._copy_into(request, lores[1], "lores", *self.lores_size)
+                    copy_time = time.monotonic() - copy_start
+                    metadata = request.get_metadata()
+                    sensor_timestamp = metadata.get("SensorTimestamp")
+                finally:
+                    request.release()
+            except Exception as e:
+                logger.error("Error capturing frame: %s", e)
+                time.sleep(0.1)
+                continue
+
+            capture_time = sensor_timestamp / 1e9 + self._clock_offset if sensor_timestamp else copy_start
+            if not self._ready.is_set() and metadata.get("AeLocked", True):
+                self._ready.set()
+            self.frames_captured += 1
+            self.copy_time_total += copy_time
+            self.copy_time_max = max(self.copy_time_max, copy_time)
+            if profiler.enabled:
+                profiler.record("capture_copy", copy_time)
+            with self._lock:
+                if self._latest is not None:
+                    self.frames_dropped += 1  # Stale, never picked up
+                self._latest = CapturedFrame(frame, capture_time, time.monotonic(), copy_time, lores[0] if lores else None)
+                loop, event = self._loop, self._event
+            if loop is not None:
+                loop.call_soon_threadsafe(event.set)
+
+    async def next_frame(self):
+        """Wait for and return the newest CapturedFrame not handed over yet."""
+        if self._event is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+        while self._running:
+            self._event.clear()
+            with self._lock:
+                captured, self._latest = self._latest, None
+                if captured is not None:
+                    self._in_use = captured.frame
+            if captured is not None:
+                latency = time.monotonic() - captured.published_time
+                self.frames_delivered += 1
+                self.handoff_latency_total += latency
+                self.handoff_latency_max = max(self.handoff_latency_max, latency)
+                return captured
+            await self._event.wait()
+        raise MediaStreamError
+
+# Custom VideoStreamTrack class that hands the newest captured frame to aiortc, emits "frame" for each one
+class Picamera2Track(VideoStreamTrack):
+    def __init__(self, capture_worker):
+        super().__init__()
+        self.capture_worker = capture_worker
+        self._start_time = None
+        self.last_capture_time = None
+        self.last_lores_frame = None # Of the frame recv() returned last, read by a simulcast SharedEncoder
+        # Per-frame timestamps so outgoing frames can be mapped back to their capture time (glass-to-glass latency)
+        self.timeline = FrameTimeline()
+
+    async def recv(self):
+        self.timeline.on_recv(time.monotonic())
+        captured = await self.capture_worker.next_frame()
+
+        # Timestamps follow the sensor capture time instead of a fixed frame clock
+        if self._start_time is None:
+            self._start_time = captured.capture_time
+        frame = captured.frame
+        frame.pts = int((captured.capture_time - self._start_time) * VIDEO_CLOCK_RATE)
+        frame.time_base = VIDEO_TIME_BASE
+
+        self.last_capture_time = captured.capture_time
+        self.last_lores_frame = captured.lores
+        self.timeline.on_frame(frame.pts, captured.capture_time, captured.published_time, captured.copy_time, time.monotonic())
+        self.emit("frame")
+        return frame
+
+    @property
+    def kind(self):
+        return "video"
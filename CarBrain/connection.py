@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+PREWARM_MAX_AGE = 30 # Seconds before a spare connection is rebuilt, so its STUN (NAT) mapping is still fresh
+PREWARM_DELAY = 2 # Seconds after a spare was taken before the next one is built, so it doesn't compete with the connection setup
+STALL_TIMEOUT = 2.5 # Seconds without any data channel message (the browser pings every second) before the connection counts as stalled
+STALL_CHECK_INTERVAL = 0.5
+COMPRESSION_LEVEL = 9 # Descriptions are a few kB, compressing them costs well under a millisecond
+SETUP_PHASES = ("offer_received", "remote_description_set", "answer_sent", "ice_connected", "first_frame", "first_control")
+
+class SetupTimeline:
+    """
+    Timestamps of one connection setup, from the offer arriving to the first control packet (time-to-drive).
+    For a reconnect, stalled_at is when the previous connection was detected as stalled, and the reconnect
+    time runs from there to the first control packet on the new connection.
+    """
+    def __init__(self, stalled_at=None):
+        self.start = time.monotonic()
+        self.stalled_at = stalled_at
+        self.marks = {}
+        self.reconnect_time = None
+
+    def mark(self, phase):
+        if phase in self.marks:
+            return
+        self.marks[phase] = time.monotonic()
+        logger.info("Setup phase %s at +%.0f ms", phase, (self.marks[phase] - self.start) * 1000)
+        if phase == "first_control" and self.stalled_at is not None:
+            self.reconnect_time = self.marks[phase] - self.stalled_at
+            logger.info("Reconnected %.0f ms after the stall was detected", self.reconnect_time * 1000)
+        if len(self.marks) == len(SETUP_PHASES):
+            logger.info("Time-to-drive %.0f ms: %s", (self.marks["first_control"] - self.start) * 1000, self.durations())
+
+    def durations(self):
+        """{phase: ms since the offer was received} for the phases reached so far."""
+        return {phase: round((self.marks[phase] - self.start) * 1000, 1) for phase in SETUP_PHASES if phase in self.marks}
+
+class PrewarmedPeerConnection:
+    """
+    Keeps one peer connection (with its video track and gathered ICE candidates) built ahead of the
+    next offer, so the offer handler only has to set the descriptions.
+    factory is an async callable returning (peer_connection, video_sender). A spare that was not
+    taken within max_age is replaced.
+    """
+    def __init__(self, factory, max_age=PREWARM_MAX_AGE):
+        self.factory = factory
+        self.max_age = max_age
+        self._spare = None
+        self._closed = False
+
+    def prepare(self):
+        if self._spare is None and not self._closed:
+            self._spare = asyncio.ensure_future(self._build())
+
+    async def _build(self):
+        start = time.monotonic()
+        result = await self.factory()
+        logger.debug("Prewarmed peer connection in %.0f ms", (time.monotonic() - start) * 1000)
+        asyncio.get_running_loop().call_later(self.max_age, self._refresh, asyncio.current_task())
+        return result
+
+    def _refresh(self, spare):
+        # Only if this spare is still waiting for an offer
+        if self._spare is not spare:
+            return
+        self._spare = None
+        self.prepare()
+        asyncio.ensure_future(self._discard(spare))
+
+    async def _discard(self, spare):
+        try:
+            peer_connection, _ = await spare
+            await peer_connection.close()
+        except Exception as e:
+            logger.error("Error discarding spare peer connection: %s", e)
+
+    async def ready(self):
+        """Wait until the spare is built, e.g. to report startup as complete."""
+        if self._spare is not None:
+            await asyncio.shield(self._spare)
+
+    async def take(self, track=None):
+        """
+        Return the spare (peer_connection, video_sender) and start building the next one.
+        If track is given it replaces the spare's own video track, so a running track (and the capture
+        pipeline behind it) moves to the new connection as is.
+        """
+        self.prepare()
+        spare, self._spare = self._spare, None
+        peer_connection, video_sender = await spare
+        if track is not None:
+            spare_track = video_sender.track
+            video_sender.replaceTrack(track)
+            spare_track.stop()
+        asyncio.get_running_loop().call_later(PREWARM_DELAY, self.prepare)
+        return peer_connection, video_sender
+
+    async def close(self):
+        self._closed = True
+        if self._spare is not None:
+            spare, self._spare = self._spare, None
+            await self._discard(spare)
+
+class StallDetector:
+    """
+    Calls on_stall once when nothing arrived on the data channel for timeout seconds, or ICE failed.
+    Armed by the first message, so a connection that is still being set up is never flagged.
+    """
+    def __init__(self, peer_connection, on_stall, timeout=STALL_TIMEOUT):
+        self.peer_connection = peer_connection
+        self.on_stall = on_stall
+        self.timeout = timeout
+        self.last_activity = None
+        self.stalled_at = None
+        self._task = None
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(STALL_CHECK_INTERVAL)
+            now = time.monotonic()
+            silent = self.last_activity is not None and now - self.last_activity > self.timeout
+            if silent or self.peer_connection.iceConnectionState == "failed":
+                self.stalled_at = now
+                logger.warning("Connection stalled (%s)", "no data for %.1f s" % (now - self.last_activity) if silent else "ICE failed")
+                self._task = None
+                self.on_stall(self)
+                return
+
+class CandidateBuffer:
+    """
+    Remote ICE candidates for the current negotiation. Candidates that arrive before the remote
+    description is set (the offer handler is still running) are held and applied right after it.
+    """
+    def __init__(self):
+        self.peer_connection = None
+        self._pending = []
+
+    def reset(self):
+        # New negotiation: hold candidates until its remote description is set, drop any held for the previous one
+        self.peer_connection = None
+        self._pending = []
+
+    async def add(self, candidate):
+        if self.peer_connection is None or self.peer_connection.remoteDescription is None:
+            self._pending.append(candidate)
+            return
+        await self.peer_connection.addIceCandidate(candidate)
+
+    async def flush(self, peer_connection):
+        """Apply the held candidates and pass new ones straight on, call once the remote description is set."""
+        self.peer_connection = peer_connection
+        pending, self._pending = self._pending, []
+        for candidate in pending:
+            await self.peer_connection.addIceCandidate(candidate)
+        if pending:
+            logger.debug("Applied %d early ICE candidates", len(pending))
+
+def decode_description(data):
+    """
+    Session description of a relayed offer or answer: a JSON string ({"sdp", "type"}, trickle mode), or in
+    compact mode the same JSON deflated (zlib) in a binary message, with every ICE candidate in the SDP.
+    Returns (description, compact).
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return json.loads(zlib.decompress(data)), True
+    return json.loads(data), False
+
+def encode_description(description, compact):
+    """The message for an RTCSessionDescription, in the format the peer used (see decode_description)."""
+    message = json.dumps({"sdp": description.sdp, "type": description.type})
+    return zlib.compress(message.encode(), COMPRESSION_LEVEL) if compact else message
+
+def parse_candidate(data):
+    """RTCIceCandidate from a trickled candidate, the JSON of the browser's RTCIceCandidate."""
+    from aiortc.sdp import candidate_from_sdp
+    candidate_data = json.loads(data)
+    # "candidate:<foundation> <component> <protocol> ...", the attribute as it appears in SDP
+    candidate = candidate_from_sdp(candidate_data["candidate"].split(":", 1)[1])
+    candidate.sdpMid = candidate_data.get("sdpMid")
+    candidate.sdpMLineIndex = candidate_data.get("sdpMLineIndex")
+    return candidate
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import struct
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+RING_SLOTS = 256 # Commands the WebRTC process may get ahead of the control process before the oldest are overwritten
+HEARTBEAT_INTERVAL = 0.05 # Seconds between heartbeats of the WebRTC process's event loop
+WATCHDOG_TIMEOUT = 0.5 # Seconds without a heartbeat before the control process stops the car, older commands are dropped
+STATS_INTERVAL = 1.0 # Seconds between the control process's stats updates (latency percentiles are over this window)
+STOP_TIMEOUT = 2 # Seconds the control process gets to stop the car and exit
+CONTROL_CPU = 3 # Core the control process is pinned to, None for any
+CONTROL_PRIORITY = 50 # SCHED_FIFO priority of the control process (needs CAP_SYS_NICE, else it runs at nice CONTROL_NICE)
+CONTROL_NICE = -10
+
+# Shared memory layout: producer fields (heartbeat f64 on the monotonic clock, stop requested u64), consumer
+# stats (own cache line), then the slots. The write index is handed over through a pipe instead (see CommandRing)
+HEARTBEAT_OFFSET = 0
+STOP_OFFSET = 8
+HEARTBEAT = struct.Struct("<d")
+FLAG = struct.Struct("<Q")
+STATS = struct.Struct("<5d6Q")
+STATS_FIELDS = ("updated", "last_apply_time", "latency_p50", "latency_p99", "latency_max",
+                "received", "lost", "stale", "inputs_total", "watchdog_trips", "failsafe_fired")
+STATS_OFFSET = 64
+SLOTS_OFFSET = 192
+SLOT = struct.Struct("<Qddffff") # index, pushed (monotonic), sender timestamp (ms), throttle, sterring, pan, tilt (NaN: none)
+INDEX = struct.Struct("<Q")
+INDEX_READ_SIZE = INDEX.size * 1024 # Pipe writes of INDEX.size are atomic, reads in multiples of it never split one
+
+# A command as the control process reads it, pushed on the WebRTC process's monotonic clock (system wide on Linux)
+Command = namedtuple("Command", "pushed timestamp throttle sterring pan tilt")
+
+def _none_if_nan(value):
+    return None if math.isnan(value) else value
+
+class CommandRing:
+    """
+    Single-producer single-consumer ring of control commands in shared memory: the WebRTC process writes
+    the slots, the control process only reads them and writes its stats block. A producer more than
+    `slots` ahead overwrites the oldest commands, the latest command always gets through.
+    Plain stores to shared memory are not ordered on the Pi's ARMv8, so the write index does not live in
+    it: after filling a slot the producer writes the new index to a pipe, and the consumer reads the pipe
+    before copying the slots. The pipe's lock in the kernel orders the slot stores before the index.
+    The consumer reads the pipe again after the copy, and drops the slots the producer may have been
+    overwriting meanwhile. Each slot also holds its index, checked on read.
+    The heartbeat, stop flag and stats are single values or advisory, read without ordering.
+    """
+    def __init__(self, shm, slots, owner, index_fd):
+        self.shm = shm
+        self.slots = slots
+        self.owner = owner
+        self.index_fd = index_fd # Write end in the producer, read end in the consumer
+        self._buffer = shm.buf
+        self._write_index = 0 # Producer: slots published. Consumer: the latest index read from the pipe
+        self._read_index = 0
+        self.lost = 0
+
+    @classmethod
+    def create(cls, slots=RING_SLOTS):
+        """The producer's ring, and the read end of the index pipe to hand to the consumer."""
+        shm = shared_memory.SharedMemory(create=True, size=SLOTS_OFFSET + slots * SLOT.size)
+        shm.buf[:SLOTS_OFFSET] = bytes(SLOTS_OFFSET)
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        return cls(shm, slots, owner=True, index_fd=write_fd), read_fd
+
+    @classmethod
+    def attach(cls, name, index_fd, slots=RING_SLOTS):
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the segment with this process's resource tracker, which
+            # would unlink it when this process exits
+            from multiprocessing import resource_tracker
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        os.set_blocking(index_fd, False)
+        return cls(shm, slots, owner=False, index_fd=index_fd)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Producer (WebRTC process)
+
+    def push(self, throttle, sterring, pan=None, tilt=None, timestamp=None):
+        index = self._write_index
+        SLOT.pack_into(self._buffer, SLOTS_OFFSET + index % self.slots * SLOT.size, index, time.monotonic(),
+                       math.nan if timestamp is None else timestamp,
+                       throttle, sterring, math.nan if pan is None else pan, math.nan if tilt is None else tilt)
+        try:
+            os.write(self.index_fd, INDEX.pack(index + 1))
+        except BlockingIOError:
+            # The control process stopped reading (its watchdog is what matters then). The slot is rewritten by
+            # the next push, so the producer is never more than one unpublished slot ahead
+            return
+        self._write_index = index + 1
+
+    def heartbeat(self):
+        HEARTBEAT.pack_into(self._buffer, HEARTBEAT_OFFSET, time.monotonic())
+
+    def request_stop(self):
+        FLAG.pack_into(self._buffer, STOP_OFFSET, 1)
+
+    def read_stats(self):
+        return dict(zip(STATS_FIELDS, STATS.unpack_from(self._buffer, STATS_OFFSET)))
+
+    # Consumer (control process)
+
+    def _read_write_index(self):
+        while True:
+            try:
+                data = os.read(self.index_fd, INDEX_READ_SIZE)
+            except BlockingIOError:
+                return
+            if not data:
+                return # The producer is gone
+            self._write_index = max(self._write_index, INDEX.unpack_from(data, len(data) - INDEX.size)[0])
+
+    def drain(self):
+        """Every command pushed since the last drain, oldest first."""
+        self._read_write_index()
+        write_index = self._write_index
+        first = max(self._read_index, write_index - self.slots)
+        self.lost += first - self._read_index
+        data = bytes(self._buffer[SLOTS_OFFSET:SLOTS_OFFSET + self.slots * SLOT.size]) if first < write_index else None
+        # Meanwhile the producer may have published more and be filling the slot after those, a lap ahead of what was copied
+        self._read_write_index()
+        oldest_intact = self._write_index + 1 - self.slots
+        commands = []
+        for index in range(first, write_index):
+            slot_index, pushed, timestamp, throttle, sterring, pan, tilt = SLOT.unpack_from(data, index % self.slots * SLOT.size)
+            if index < oldest_intact or slot_index != index:
+                self.lost += 1 # Overwritten by a producer a whole ring ahead
+                continue
+            commands.append(Command(pushed, _none_if_nan(timestamp), throttle, sterring, _none_if_nan(pan), _none_if_nan(tilt)))
+        self._read_index = write_index
+        return commands
+
+    def heartbeat_time(self):
+        return HEARTBEAT.unpack_from(self._buffer, HEARTBEAT_OFFSET)[0]
+
+    def stop_requested(self):
+        return FLAG.unpack_from(self._buffer, STOP_OFFSET)[0] != 0
+
+    def publish_stats(self, **stats):
+        STATS.pack_into(self._buffer, STATS_OFFSET, *(stats[field] for field in STATS_FIELDS))
+
+    def close(self):
+        self._buffer = None
+        self.shm.close()
+        os.close(self.index_fd)
+        if self.owner:
+            self.shm.unlink()
+
+class ControlProcess:
+    """
+    The control engine and actuator output in a separate process (`python control_process.py`, see run()),
+    pinned to its own core at real-time priority, so video and WebRTC work can't delay a steering update
+    or a failsafe. Stands in for the ActuationLoop in the WebRTC process: submit() only writes the command
+    into a CommandRing, which the control process drains on each actuation tick. A heartbeat task shows the
+    event loop is alive, the control process's watchdog stops the car when it isn't.
+    """
+    def __init__(self, backend="pigpio", rate_hz=100, jitter_buffer=False, calibration_path=None, pantilt=False,
+                 cpu=CONTROL_CPU, priority=CONTROL_PRIORITY, results_path=None):
+        self.options = ["--backend", backend, "--rate-hz", str(rate_hz), "--priority", str(priority)]
+        if cpu is not None:
+            self.options += ["--cpu", str(cpu)]
+        if jitter_buffer:
+            self.options.append("--jitter-buffer")
+        if calibration_path is not None:
+            self.options += ["--calibration", calibration_path]
+        if pantilt:
+            self.options.append("--pantilt")
+        if results_path is not None:
+            self.options += ["--results", results_path]
+        self.ring = None
+        self.process = None
+        self._heartbeat_task = None
+        self._final_stats = {} # Kept once the ring is closed
+
+    def start(self):
+        """Start the control process, from the event loop."""
+        if self.process is not None:
+            return
+        self.ring, index_fd = CommandRing.create()
+        self.ring.heartbeat()
+        try:
+            self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.ring.name, str(index_fd)] + self.options,
+                                            pass_fds=(index_fd,))
+        finally:
+            os.close(index_fd)
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+        logger.info("Started control process %d", self.process.pid)
+
+    async def _heartbeat(self):
+        while True:
+            self.ring.heartbeat()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def submit(self, throttle, sterring, pan=None, tilt=None, timestamp=None):
+        self.ring.push(throttle, sterring, pan, tilt, timestamp)
+
+    @property
+    def inputs_total(self):
+        return self.ring.read_stats()["inputs_total"]
+
+    @property
+    def last_apply_time(self):
+        return self.ring.read_stats()["last_apply_time"] or None
+
+    @property
+    def failsafe_fired(self):
+        return self.ring.read_stats()["failsafe_fired"]
+
+    @property
+    def watchdog_trips(self):
+        return self.ring.read_stats()["watchdog_trips"]
+
+    @property
+    def latency_p99(self):
+        return self.ring.read_stats()["latency_p99"]
+
+    def stats(self):
+        if self.ring is None:
+            return self._final_stats
+        stats = self.ring.read_stats()
+        return {
+            "pid": self.process.pid,
+            "alive": self.process.poll() is None,
+            "inputs_total": stats["inputs_total"],
+            "received": stats["received"],
+            "lost": stats["lost"],
+            "stale": stats["stale"],
+            "watchdog_trips": stats["watchdog_trips"],
+            "failsafe_fired": stats["failsafe_fired"],
+            # Push in this process to the actuator write in the control process, over the last STATS_INTERVAL
+            "latency_ms": {name: stats[f"latency_{name}"] * 1000 for name in ("p50", "p99", "max")},
+        }
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        self.ring.request_stop()
+        try:
+            self.process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.error("Control process did not stop, killing it")
+            self.process.kill()
+            self.process.wait()
+        self._final_stats = self.stats()
+        logger.info("Stopped control process: %s", self._final_stats)
+        self.ring.close()
+        self.ring = None
+        self.process = None
+
+def _set_realtime(cpu, priority):
+    # Before any thread starts, threads inherit the affinity and scheduling policy
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logger.warning("Could not pin the control process to CPU %d: %s", cpu, e)
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        logger.info("Control process on CPU %s at SCHED_FIFO priority %d", cpu, priority)
+    except (AttributeError, OSError):
+        try:
+            os.nice(CONTROL_NICE)
+            logger.info("Control process on CPU %s at nice %d (no permission for SCHED_FIFO)", cpu, CONTROL_NICE)
+        except OSError:
+            logger.warning("Control process at normal priority (no permission to raise it)")
+
+def run(args):
+    """The control process: drains the ring into the actuation loop at its tick rate, with the watchdog."""
+    _set_realtime(args.cpu, args.priority)
+    # Only stopped by the WebRTC process (or its watchdog), not by a Ctrl+C to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import engine
+    from actuation import ActuationLoop
+    from actuator_bus import FakeBackend
+    from calibration import calibration
+    from failsafe import scheduler
+    from jitter import JitterBuffer
+    from GPIO import bus, PAN_PIN, TILT_PIN
+    from profiling import Histogram
+
+    def stop_car():
+        # As the no-input failsafes firing now
+        scheduler.disarm("steering")
+        scheduler.disarm("throttle")
+        engine.servo_input_timeout()
+        engine.motor_input_timeout()
+
+    backend = FakeBackend() if args.backend == "fake" else args.backend
+    bus.set_backend(backend)
+    pantilt = None
+    if args.pantilt:
+        from pantilt import PanTilt
+        # As CarBrain/main.py sets it up
+        pantilt = PanTilt(
+            pan_pin=PAN_PIN,
+            tilt_pin=TILT_PIN,
+            invert_pan=True,
+            invert_tilt=False,
+            pan_min_norm=-1, pan_max_norm=1, pan_default_norm=0,
+            tilt_min_norm=-1, tilt_max_norm=1, tilt_default_norm=0
+        )
+    if args.calibration:
+        calibration.watch(args.calibration)
+    actuation = ActuationLoop(pantilt=pantilt, rate_hz=args.rate_hz, jitter_buffer=JitterBuffer() if args.jitter_buffer else None)
+    ring = CommandRing.attach(args.ring, args.index_fd)
+    signal.signal(signal.SIGTERM, lambda signum, frame: ring.request_stop())
+    parent = os.getppid()
+    logger.info("Control process ready at %s Hz", args.rate_hz)
+
+    latency = Histogram()
+    received = stale = trips = 0
+    tripped = False
+    published = time.monotonic()
+    next_tick = time.monotonic()
+    try:
+        while not ring.stop_requested():
+            now = time.monotonic()
+            orphaned = os.getppid() != parent
+            alive = now - ring.heartbeat_time() <= WATCHDOG_TIMEOUT and not orphaned
+            if not alive and not tripped:
+                tripped = True
+                trips += 1
+                logger.error("No heartbeat from the WebRTC process for %.0f ms, stopping the car", (now - ring.heartbeat_time()) * 1000)
+                stop_car()
+            elif alive and tripped:
+                tripped = False
+                logger.info("WebRTC process heartbeat is back")
+            if orphaned:
+                logger.error("WebRTC process is gone, exiting")
+                break
+
+            pushed = []
+            for command in ring.drain():
+                received += 1
+                # A command from before a hang is out of date by now
+                if tripped or now - command.pushed > WATCHDOG_TIMEOUT:
+                    stale += 1
+                    continue
+                actuation.submit(command.throttle, command.sterring, command.pan, command.tilt, command.timestamp)
+                pushed.append(command.pushed)
+            actuation.tick()
+            applied = time.monotonic()
+            for t in pushed:
+                latency.record(applied - t)
+
+            if applied - published >= STATS_INTERVAL:
+                ring.publish_stats(
+                    updated=applied, last_apply_time=actuation.last_apply_time or 0.0,
+                    latency_p50=latency.percentile(50) / 1000 if latency.count else 0.0,
+                    latency_p99=latency.percentile(99) / 1000 if latency.count else 0.0,
+                    latency_max=latency.max, received=received, lost=ring.lost, stale=stale,
+                    inputs_total=actuation.inputs_total, watchdog_trips=trips, failsafe_fired=scheduler.fired,
+                )
+                latency = Histogram()
+                published = applied
+
+            next_tick += actuation.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
+    finally:
+        stop_car()
+        logger.info("Control process stopped: %s, failsafe %s", actuation.stats(), scheduler.stats())
+        if args.results:
+            with open(args.results, "w") as f:
+                json.dump({
+                    "writes": list(backend.writes) if isinstance(backend, FakeBackend) else None,
+                    "batches": backend.batches if isinstance(backend, FakeBackend) else None,
+                    "actuation": actuation.stats(),
+                    "failsafe": scheduler.stats(),
+                    "received": received,
+                    "lost": ring.lost,
+                    "stale": stale,
+                    "watchdog_trips": trips,
+                }, f)
+        calibration.stop()
+        if pantilt is not None:
+            pantilt.cleanup()
+        bus.close()
+        ring.close()
+
+def main():
+    from log import setup_logging, shutdown_logging
+    parser = argparse.ArgumentParser(description="CarBrain control process, started by ControlProcess")
+    parser.add_argument("ring", help="shared memory name of the CommandRing")
+    parser.add_argument("index_fd", type=int, help="read end of the CommandRing's index pipe")
+    parser.add_argument("--backend", default="pigpio", help="actuator backend: pigpio, fake or null")
+    parser.add_argument("--rate-hz", type=float, default=100)
+    parser.add_argument("--jitter-buffer", action="store_true")
+    parser.add_argument("--calibration", default=None)
+    parser.add_argument("--pantilt", action="store_true")
+    parser.add_argument("--cpu", type=int, default=None)
+    parser.add_argument("--priority", type=int, default=CONTROL_PRIORITY)
+    parser.add_argument("--results", default=None, help="write the stats (and fake backend writes) here on exit")
+    args = parser.parse_args()
+    setup_logging()
+    try:
+        run(args)
+    finally:
+        shutdown_logging()
+
+if __name__ == "__main__":
+    main()
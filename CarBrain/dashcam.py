@@ -0,0 +1,367 @@
+import collections
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DASHCAM_DIR = "dashcam"
+SEGMENT_SIZE = 32 * 1024 * 1024 # Bytes preallocated per segment file, ~4 minutes at 1 Mbps
+SEGMENT_SECONDS = 60 # A new segment is started at the first keyframe after this
+MAX_BYTES = 2 * 1024 ** 3 # Ring of segments on the card, the oldest are deleted beyond this
+MIN_FREE_BYTES = 512 * 1024 ** 2 # Also deleted to keep this much free space on the card
+MAX_PENDING_RECORDS = 20000 # Records waiting for the writer thread, more are dropped (stalled SD card)
+MAX_PENDING_VIDEO_BYTES = 8 * 1024 * 1024
+WRITE_INTERVAL = 0.05 # Seconds between writer thread wakeups
+FLUSH_INTERVAL = 1.0 # Seconds between msyncs of the current segment
+SEGMENT_EXTENSION = ".dashcam"
+# <sequence>_<wall clock>.dashcam: the sequence carries on across runs and orders the segments, the clock is
+# only for people (the Pi has no RTC, it can be behind after a boot until NTP syncs)
+SEGMENT_NAME = re.compile(r"^(\d{10})_")
+
+# Segment file: header, then records until a zero record type (the preallocated rest of the file)
+MAGIC = b"CBDC"
+VERSION = 1
+SEGMENT_HEADER = struct.Struct("<4sHdd") # magic, version, wall clock and monotonic time at the start
+RECORD_HEADER = struct.Struct("<BBId") # record type, flags, payload length, monotonic time
+
+# Record types
+RECORD_VIDEO = 1 # payload: pts (i64, 90 kHz) + Annex B H264 access unit, flags: FLAG_KEYFRAME
+RECORD_CONTROL = 2 # payload: throttle, sterring, pan, tilt (f32, NaN without pan/tilt)
+RECORD_ACTUATION = 3 # payload: GPIO pin (u8), pulse width (u16)
+RECORD_MESSAGE = 4 # payload: the driver's data channel message as received (see protocol.py), flags: FLAG_TEXT
+RECORD_NAMES = {RECORD_VIDEO: "video", RECORD_CONTROL: "control", RECORD_ACTUATION: "actuation", RECORD_MESSAGE: "message"}
+FLAG_KEYFRAME = 1
+FLAG_TEXT = 2 # UTF-8 text message (legacy CSV, ping, profile command)
+VIDEO_PTS = struct.Struct("<q")
+CONTROL = struct.Struct("<ffff")
+ACTUATION = struct.Struct("<BH")
+
+class Segment:
+    """One preallocated, memory-mapped segment file. Writes are memory copies, made durable by flush()."""
+    def __init__(self, path, size):
+        self.path = path
+        self.started = time.monotonic()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                # Real blocks up front: no allocation while recording, and no surprise ENOSPC on a full card
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+        SEGMENT_HEADER.pack_into(self.map, 0, MAGIC, VERSION, time.time(), self.started)
+        self.offset = SEGMENT_HEADER.size
+
+    def write(self, kind, flags, timestamp, payload):
+        end = self.offset + RECORD_HEADER.size + len(payload)
+        if end > len(self.map):
+            return False
+        # Payload first, the header makes the record visible to a reader after a crash
+        self.map[self.offset + RECORD_HEADER.size:end] = payload
+        RECORD_HEADER.pack_into(self.map, self.offset, kind, flags, len(payload), timestamp)
+        self.offset = end
+        return True
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        # Trimmed to what was recorded, a segment left by a crash keeps its zero padding
+        self.map.flush()
+        self.map.close()
+        os.ftruncate(self.fd, self.offset)
+        os.close(self.fd)
+
+class Dashcam:
+    """
+    On-car recording of what the driver saw and sent: the encoded video packets as they go out (no second
+    encode), the control packets (decoded, and as received for replays) and every actuator write,
+    interleaved in one file per segment.
+    The hot paths only append a tuple to a queue, a writer thread copies them into the current segment
+    and msyncs it. Segments are preallocated and kept in a bounded ring (max_bytes, MIN_FREE_BYTES),
+    the oldest deleted first, so the card never fills up. Each segment starts at a keyframe.
+    """
+    def __init__(self):
+        self.recording = False
+        self.directory = DASHCAM_DIR
+        self.keyframe_callback = None # Asks the video encoder for a keyframe, to start a new segment on
+        self._pending = collections.deque()
+        self._queued_video_bytes = 0 # Written by the event loop only
+        self._written_video_bytes = 0 # Written by the writer thread only
+        self._video_gap = True # Video is only recorded from a keyframe on
+        self._segment = None
+        self._segment_needs_keyframe = True
+        self._keyframe_requested = False
+        self._sequence = 0 # Of the next segment
+        self._stop = threading.Event()
+        self._thread = None
+        self.max_bytes = MAX_BYTES
+        self.segment_size = SEGMENT_SIZE
+        self.segment_seconds = SEGMENT_SECONDS
+        # Stats
+        self.segments = 0
+        self.records = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.deleted_segments = 0
+
+    def start(self, directory=DASHCAM_DIR, max_bytes=MAX_BYTES, segment_size=SEGMENT_SIZE, segment_seconds=SEGMENT_SECONDS):
+        if self.recording:
+            return
+        if max_bytes < segment_size:
+            raise ValueError(f"Dashcam budget of {max_bytes} bytes is smaller than one segment")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._sequence = max((segment_sequence(name) for name in os.listdir(directory) if name.endswith(SEGMENT_EXTENSION)), default=-1) + 1
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.segment_seconds = segment_seconds
+        self._stop.clear()
+        self._pending.clear()
+        self._queued_video_bytes = self._written_video_bytes = 0
+        self._video_gap = True
+        self.recording = True
+        self._thread = threading.Thread(target=self._run, name="dashcam", daemon=True)
+        self._thread.start()
+        logger.info("Dashcam recording to %s, up to %d MB", directory, max_bytes // 1024 ** 2)
+
+    def stop(self):
+        if not self.recording:
+            return
+        self.recording = False
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        logger.info("Dashcam stopped: %s", self.stats())
+
+    def stats(self):
+        return {
+            "segments": self.segments,
+            "records": self.records,
+            "bytes_written": self.bytes_written,
+            "dropped": self.dropped,
+            "deleted_segments": self.deleted_segments,
+            "pending": len(self._pending),
+        }
+
+    # Hot paths: one check when not recording, a deque append (thread safe, never blocks) when recording
+
+    def record_video(self, packet, keyframe):
+        # packet: av.Packet or bytes. From the event loop only
+        if not self.recording:
+            return
+        if self._video_gap:
+            if not keyframe:
+                return
+            self._video_gap = False
+        # Copied now: the passthrough source reuses its packets on every loop and rewrites their pts
+        pts = getattr(packet, "pts", None) or 0
+        data = bytes(packet)
+        size = len(data)
+        if len(self._pending) >= MAX_PENDING_RECORDS \
+                or self._queued_video_bytes - self._written_video_bytes + size > MAX_PENDING_VIDEO_BYTES:
+            # The writer is behind, resume at the next keyframe so the recording stays decodable
+            self.dropped += 1
+            self._video_gap = True
+            return
+        self._queued_video_bytes += size
+        self._pending.append((RECORD_VIDEO, time.monotonic(), pts, data, keyframe))
+
+    def record_control(self, throttle, sterring, pan, tilt):
+        if not self.recording:
+            return
+        if len(self._pending) >= MAX_PENDING_RECORDS:
+            self.dropped += 1
+            return
+        self._pending.append((RECORD_CONTROL, time.monotonic(), throttle, sterring, pan, tilt))
+
+    def record_message(self, message):
+        if not self.recording:
+            return
+        if len(self._pending) >= MAX_PENDING_RECORDS:
+            self.dropped += 1
+            return
+        self._pending.append((RECORD_MESSAGE, time.monotonic(), message))
+
+    def record_actuation(self, pin, pulse_width):
+        if not self.recording:
+            return
+        if len(self._pending) >= MAX_PENDING_RECORDS:
+            self.dropped += 1
+            return
+        self._pending.append((RECORD_ACTUATION, time.monotonic(), pin, pulse_width))
+
+    # Writer thread
+
+    def _run(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                stopping = self._stop.wait(WRITE_INTERVAL)
+                self._drain()
+                if self._segment is not None and (stopping or time.monotonic() - last_flush >= FLUSH_INTERVAL):
+                    self._segment.flush()
+                    last_flush = time.monotonic()
+                if stopping:
+                    break
+        except Exception:
+            logger.exception("Dashcam stopped after an error")
+            self.recording = False
+        finally:
+            self._pending.clear()
+            if self._segment is not None:
+                try:
+                    self._segment.close()
+                except OSError as e:
+                    logger.error("Error closing dashcam segment: %s", e)
+                self._segment = None
+
+    def _drain(self):
+        while self._pending:
+            item = self._pending.popleft()
+            kind, timestamp = item[0], item[1]
+            flags = 0
+            if self._segment is None:
+                self._open_segment()
+            if kind == RECORD_VIDEO:
+                pts, data, keyframe = item[2], item[3], item[4]
+                self._written_video_bytes += len(data)
+                self._rotate_if_due(keyframe)
+                if self._segment_needs_keyframe:
+                    if not keyframe:
+                        continue
+                    self._segment_needs_keyframe = False
+                flags = FLAG_KEYFRAME if keyframe else 0
+                payload = VIDEO_PTS.pack(pts) + data
+            elif kind == RECORD_CONTROL:
+                throttle, sterring, pan, tilt = item[2:]
+                payload = CONTROL.pack(throttle, sterring, math.nan if pan is None else pan, math.nan if tilt is None else tilt)
+            elif kind == RECORD_MESSAGE:
+                message = item[2]
+                if isinstance(message, str):
+                    flags = FLAG_TEXT
+                    payload = message.encode()
+                else:
+                    payload = bytes(message)
+            else:
+                payload = ACTUATION.pack(item[2], max(0, min(int(item[3]), 0xffff)))
+            if not self._segment.write(kind, flags, timestamp, payload):
+                # Full before a keyframe came along: the next segment starts at one
+                self._open_segment()
+                if kind == RECORD_VIDEO and not flags & FLAG_KEYFRAME:
+                    self._segment_needs_keyframe = True
+                    continue
+                if not self._segment.write(kind, flags, timestamp, payload):
+                    self.dropped += 1
+                    continue
+            self.records += 1
+            self.bytes_written += RECORD_HEADER.size + len(payload)
+
+    def _rotate_if_due(self, keyframe):
+        segment = self._segment
+        if segment is None:
+            return
+        age = time.monotonic() - segment.started
+        if age < self.segment_seconds:
+            return
+        if keyframe:
+            self._open_segment()
+        elif self.keyframe_callback is not None and not self._keyframe_requested:
+            self._keyframe_requested = True
+            self.keyframe_callback()
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._make_room()
+        name = f"{self._sequence:010d}_{time.strftime('%Y%m%d-%H%M%S')}{SEGMENT_EXTENSION}"
+        self._segment = Segment(os.path.join(self.directory, name), self.segment_size)
+        self._sequence += 1
+        self._segment_needs_keyframe = True
+        self._keyframe_requested = False
+        self.segments += 1
+
+    def _make_room(self):
+        # Delete the oldest segments (of this or earlier runs) until a new one fits in the budget and the card's free space
+        segments = sorted((name for name in os.listdir(self.directory) if name.endswith(SEGMENT_EXTENSION)), key=segment_order)
+        sizes = {name: os.path.getsize(os.path.join(self.directory, name)) for name in segments}
+        used = sum(sizes.values())
+        free = shutil.disk_usage(self.directory).free
+        while segments and (used + self.segment_size > self.max_bytes or free - self.segment_size < MIN_FREE_BYTES):
+            name = segments.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            used -= sizes[name]
+            free += sizes[name]
+            self.deleted_segments += 1
+        if free - self.segment_size < MIN_FREE_BYTES:
+            raise OSError(f"Not enough space for a dashcam segment in {self.directory}")
+
+def segment_sequence(name):
+    """Sequence number of a segment file name, -1 for the clock-named segments of older versions."""
+    match = SEGMENT_NAME.match(name)
+    return int(match.group(1)) if match else -1
+
+def segment_order(name):
+    """Sort key of segment file names, oldest first."""
+    return segment_sequence(name), name
+
+def read_segment(path):
+    """Yield (record type, wall clock time, flags, payload) of every record in a segment file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, wall_start, monotonic_start = SEGMENT_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a dashcam segment")
+    offset = SEGMENT_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        kind, flags, length, timestamp = RECORD_HEADER.unpack_from(data, offset)
+        if kind == 0:
+            break
+        offset += RECORD_HEADER.size
+        payload = data[offset:offset + length]
+        offset += length
+        if kind == RECORD_VIDEO:
+            payload = (VIDEO_PTS.unpack_from(payload)[0], payload[VIDEO_PTS.size:])
+        elif kind == RECORD_CONTROL:
+            payload = CONTROL.unpack(payload)
+        elif kind == RECORD_ACTUATION:
+            payload = ACTUATION.unpack(payload)
+        elif kind == RECORD_MESSAGE and flags & FLAG_TEXT:
+            payload = payload.decode()
+        yield kind, wall_start + timestamp - monotonic_start, flags, payload
+
+def export(path, prefix):
+    """Write a segment's video as a raw H264 stream (<prefix>.h264, plays in ffplay/VLC) and its control and actuator records as CSV."""
+    with open(prefix + ".h264", "wb") as video, open(prefix + ".csv", "w") as events:
+        events.write("time,event,v0,v1,v2,v3\n")
+        for kind, wall_time, flags, payload in read_segment(path):
+            if kind == RECORD_VIDEO:
+                video.write(payload[1])
+                events.write(f"{wall_time:.6f},video,{payload[0]},{flags & FLAG_KEYFRAME},,\n")
+            elif kind == RECORD_MESSAGE:
+                # Text quoted (legacy CSV contains commas), binary as hex
+                events.write(f"{wall_time:.6f},message,\"{payload}\",,,\n" if flags & FLAG_TEXT else f"{wall_time:.6f},message,{payload.hex()},,,\n")
+            else:
+                values = ",".join(str(v) for v in payload)
+                events.write(f"{wall_time:.6f},{RECORD_NAMES.get(kind, kind)},{values}{',' * (4 - len(payload))}\n")
+
+# Shared instance
+dashcam = Dashcam()
+
+if __name__ == "__main__":
+    # python dashcam.py <segment file> [output prefix]
+    segment_path = sys.argv[1]
+    export(segment_path, sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(segment_path)[0])
@@ -1,12 +1,25 @@
+import logging
 import threading
 import time
-from GPIO import set_servo_pulsewidth, set_motor_pulsewidth, reset_servo_pulsewidth, reset_motor_pulsewidth, SERVO_CENTERED_PW, MOTOR_STOPPED_PW
+from GPIO import set_servo_pulsewidth, set_motor_pulsewidth, reset_servo_pulsewidth, reset_motor_pulsewidth, SERVO_CENTERED_PW, MOTOR_STOPPED_PW, SERVO_PIN, MOTOR_PIN
+from failsafe import scheduler
+from calibration import calibration, Curve
+
+logger = logging.getLogger(__name__)
 
 # Constants
 SERVO_NO_INPUT_STOP_DELAY = 0.2
 MOTOR_NO_INPUT_STOP_DELAY = 0.2
 STERRING_RANGE = 400
 THROTTLE_RANGE = 300
+STERRING_DEADBAND = 0.075 # Circumvents minimal stick drift
+THROTTLE_DEADBAND = 0.075 # Circumvents trigger noise around zero
+
+# Default curves, a calibration file can override any of their fields (see calibration.py)
+calibration.set_defaults(
+    steering=Curve(center=SERVO_CENTERED_PW, min=SERVO_CENTERED_PW - STERRING_RANGE, max=SERVO_CENTERED_PW + STERRING_RANGE, deadband=STERRING_DEADBAND),
+    throttle=Curve(center=MOTOR_STOPPED_PW, min=MOTOR_STOPPED_PW - THROTTLE_RANGE, max=MOTOR_STOPPED_PW + THROTTLE_RANGE, deadband=THROTTLE_DEADBAND),
+)
 
 # Variables
 servo_active = False
@@ -15,29 +28,31 @@ last_sterring_input_time = None
 last_throttle_input_time = None
 last_servo_pw = SERVO_CENTERED_PW
 last_motor_pw = MOTOR_STOPPED_PW
+# Held while the variables above are read or written: inputs come from the actuation thread, timeouts from the failsafe scheduler's
+_lock = threading.Lock()
 
+# Reset servo and motor when no input is received after a certain delay (fired by the shared failsafe scheduler)
+def servo_input_timeout():
+    global servo_active, last_servo_pw
 
-# Monitor last input time for servo and motor and stop if no input is received after a certain delay
-def servo_input_monitor_loop():
-    global last_sterring_input_time
-    global servo_active
-
-    while servo_active:
-        if last_sterring_input_time and time.time() - last_sterring_input_time > SERVO_NO_INPUT_STOP_DELAY:
-            servo_active = False
-            reset_servo_pulsewidth()
-        time.sleep(0.05)
-def motor_input_monitor_loop():
-    global last_throttle_input_time
-    global motor_active
+    with _lock:
+        # An input that came in while the failsafe fired re-armed it, and is newer than the timeout
+        if scheduler.is_armed("steering"):
+            return
+        servo_active = False
+        last_servo_pw = calibration.neutral("steering")
+        reset_servo_pulsewidth(last_servo_pw)
+def motor_input_timeout():
+    global motor_active, last_motor_pw
 
-    while motor_active:
-        if last_throttle_input_time and time.time() - last_throttle_input_time > MOTOR_NO_INPUT_STOP_DELAY:
-            motor_active = False
-            reset_motor_pulsewidth()
-        time.sleep(0.05)
+    with _lock:
+        if scheduler.is_armed("throttle"):
+            return
+        motor_active = False
+        last_motor_pw = calibration.neutral("throttle")
+        reset_motor_pulsewidth(last_motor_pw)
 
-# From controller input set servo and motor pulse width and start/stop input monitor threads
+# From controller input set servo and motor pulse width and arm the no-input failsafes
 def handle_controller_input(throttle: float, steering: float):
     global last_sterring_input_time, last_throttle_input_time
     global servo_active, motor_active
@@ -47,32 +62,32 @@ def handle_controller_input(throttle: float, steering: float):
 
     # Validate throttle and steering inputs
     if not -1 <= throttle <= 1 or not -1 <= steering <= 1:
-        print("Invalid throttle or steering value. Values must be between -1 and 1.")
+        logger.warning("Invalid throttle or steering value. Values must be between -1 and 1.")
         return
 
-    if steering != 0:
-        last_sterring_input_time = time.time()
-        if not servo_active:
+    with _lock:
+        # Stick drift and trigger noise inside the deadbands are no input: they don't re-arm the failsafes
+        if abs(steering) > calibration.curve("steering").deadband:
+            last_sterring_input_time = time.monotonic()
             servo_active = True
-            threading.Thread(target=servo_input_monitor_loop, daemon=True).start()
+            scheduler.arm("steering", SERVO_NO_INPUT_STOP_DELAY, servo_input_timeout, SERVO_PIN)
 
-    # Convert steering input to pulse width
-    servo_pw = int(SERVO_CENTERED_PW + (steering * STERRING_RANGE))
-    # Set steering pulse width if it has changed
-    if servo_pw != last_servo_pw:
-        set_servo_pulsewidth(servo_pw)
-        last_servo_pw = servo_pw
+        # Convert steering input to pulse width (calibrated lookup)
+        servo_pw = calibration.pulse("steering", steering)
+        # Set steering pulse width if it has changed
+        if servo_pw != last_servo_pw:
+            set_servo_pulsewidth(servo_pw)
+            last_servo_pw = servo_pw
 
-    if throttle != 0:
-        last_throttle_input_time = time.time()
-        if not motor_active:
+        if abs(throttle) > calibration.curve("throttle").deadband:
+            last_throttle_input_time = time.monotonic()
             motor_active = True
-            threading.Thread(target=motor_input_monitor_loop, daemon=True).start()
+            scheduler.arm("throttle", MOTOR_NO_INPUT_STOP_DELAY, motor_input_timeout, MOTOR_PIN)
 
-        # Convert throttle input to pulse width
-        motor_pw = int(MOTOR_STOPPED_PW + (throttle * THROTTLE_RANGE))
-        # Set motor pulse width if it has changed
-        if motor_pw != last_motor_pw:
-            set_motor_pulsewidth(motor_pw)
-            last_motor_pw = motor_pw
+            # Convert throttle input to pulse width (calibrated lookup)
+            motor_pw = calibration.pulse("throttle", throttle)
+            # Set motor pulse width if it has changed
+            if motor_pw != last_motor_pw:
+                set_motor_pulsewidth(motor_pw)
+                last_motor_pw = motor_pw
 
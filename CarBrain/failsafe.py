@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from log import flight_recorder
+
+logger = logging.getLogger(__name__)
+
+class FailsafeScheduler:
+    """
+    Single-thread deadline scheduler for the no-input failsafes (steering, throttle, pan/tilt).
+    Each channel is armed under a key with a delay; re-arming only moves its deadline, so
+    40+ messages per second cause no thread or timer churn. Uses monotonic time and records
+    how late every firing was. For replays on a virtual clock, set clock and manual: deadlines are then
+    fired by run_due() on the caller's thread instead of the scheduler thread.
+    """
+    def __init__(self):
+        self.clock = time.monotonic
+        self.manual = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._heap = []  # (deadline, seq, key)
+        self._seq = itertools.count()
+        self._pending = {}  # key -> (deadline, callback, channel)
+        self._queued = {}  # key -> deadline of the heap entry that is authoritative for key
+        self._thread = None
+        # Lateness stats (seconds)
+        self.fired = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def arm(self, key, delay, callback, channel=0):
+        # channel: GPIO pin the callback resets, recorded with the firing in the flight recorder (0 if not applicable)
+        deadline = self.clock() + delay
+        with self._lock:
+            self._pending[key] = (deadline, callback, channel)
+            queued = self._queued.get(key)
+            # An earlier heap entry for this key is simply pushed forward when it comes up,
+            # so the common case (deadline extended by a new input) is a dict update only
+            if queued is None or deadline < queued:
+                self._queued[key] = deadline
+                heapq.heappush(self._heap, (deadline, next(self._seq), key))
+                if self._heap[0][2] == key:
+                    self._wakeup.notify()
+            if self._thread is None and not self.manual:
+                self._thread = threading.Thread(target=self._run, name="failsafe", daemon=True)
+                self._thread.start()
+
+    def disarm(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def is_armed(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def next_deadline(self):
+        with self._lock:
+            return min((deadline for deadline, _, _ in self._pending.values()), default=None)
+
+    def run_due(self):
+        """Fire every callback that is due now, on the calling thread (manual mode)."""
+        while True:
+            with self._lock:
+                due = self._next_due(wait=False)
+                if due is None:
+                    return
+                self._count(due[3])
+            self._fire(*due)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "fired": self.fired,
+                "last_lateness_ms": self.last_lateness * 1000,
+                "max_lateness_ms": self.max_lateness * 1000,
+                "mean_lateness_ms": (self.total_lateness / self.fired * 1000) if self.fired else 0.0,
+            }
+
+    def _next_due(self, wait=True):
+        # Called with the lock held, returns (key, callback, channel, lateness) or None
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            now = self.clock()
+            if deadline > now:
+                if not wait:
+                    return None
+                self._wakeup.wait(deadline - now)
+                continue
+            heapq.heappop(self._heap)
+            if self._queued.get(key) != deadline:
+                continue  # Superseded by an earlier entry for the same key
+            del self._queued[key]
+            entry = self._pending.get(key)
+            if entry is None:
+                continue  # Disarmed
+            pending_deadline, callback, channel = entry
+            if pending_deadline > now:
+                # Deadline was extended since this entry was pushed
+                self._queued[key] = pending_deadline
+                heapq.heappush(self._heap, (pending_deadline, next(self._seq), key))
+                continue
+            del self._pending[key]
+            return key, callback, channel, now - pending_deadline
+        return None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                due = self._next_due()
+                while due is None:
+                    self._wakeup.wait()
+                    due = self._next_due()
+                self._count(due[3])
+            self._fire(*due)
+
+    def _count(self, lateness):
+        # Called with the lock held
+        self.fired += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+
+    def _fire(self, key, callback, channel, lateness):
+        flight_recorder.record_failsafe(channel, lateness)
+        logger.info("Failsafe %s fired %.2f ms after deadline", key, lateness * 1000)
+        try:
+            callback()
+        except Exception:
+            logger.exception("Error in failsafe callback for %s", key)
+
+# Shared instance used by engine.py and pantilt.py
+scheduler = FailsafeScheduler()
@@ -0,0 +1,373 @@
+import asyncio
+import fractions
+import logging
+import time
+from collections import deque
+
+import av
+from aiortc.mediastreams import MediaStreamTrack, MediaStreamError
+
+from profiling import profiler
+from dashcam import dashcam
+from rtp_sender import get_private, set_private, FORCE_KEYFRAME
+
+logger = logging.getLogger(__name__)
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+DEFAULT_BITRATE = 1_000_000
+MIN_BITRATE = 500_000 # Same range as aiortc's own H264 encoder
+MAX_BITRATE = 3_000_000
+BITRATE_CHANGE_THRESHOLD = 0.1 # libx264 can't change bitrate on the fly, the encoder is recreated above this relative change
+LORES_BITRATE = 300_000
+LORES_MIN_BITRATE = 100_000
+LORES_MAX_BITRATE = 1_000_000
+KEYFRAME_MIN_INTERVAL = 0.3 # Seconds between two requested keyframes of a layer, requests in between wait for the next one
+LAYER_MAIN = "main"
+LAYER_LORES = "lores"
+FANOUT_QUEUE_SIZE = 30 # Packets a viewer may lag behind before it is resynchronised at the next keyframe
+NAL_TYPE_IDR = 5
+NAL_TYPE_SPS = 7
+
+def _is_keyframe(data):
+    # Annex B: a keyframe access unit carries SPS or an IDR slice
+    offset = data.find(b"\x00\x00\x01")
+    while offset != -1 and offset + 3 < len(data):
+        if data[offset + 3] & 0x1f in (NAL_TYPE_IDR, NAL_TYPE_SPS):
+            return True
+        offset = data.find(b"\x00\x00\x01", offset + 3)
+    return False
+
+class Layer:
+    """
+    One resolution of a SharedEncoder's video, with its own H264 encoder, bitrate and keyframe requests.
+    size None is the source's own size, otherwise frames are taken from the source's low-resolution
+    output (last_lores_frame) or downscaled to it.
+    """
+    def __init__(self, name, size, bitrate, min_bitrate, max_bitrate):
+        self.name = name
+        self.size = size
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.target_bitrate = bitrate
+        self._codec = None
+        self._keyframe_requested = False
+        self._last_keyframe = None
+        # Stats
+        self.frames_encoded = 0
+        self.keyframes = 0
+        self.bytes_out = 0
+        self.encode_time_total = 0.0
+        self.encode_time_max = 0.0
+
+    @property
+    def target_bitrate(self):
+        return self._target_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate):
+        self._target_bitrate = max(self.min_bitrate, min(bitrate, self.max_bitrate))
+
+    def request_keyframe(self):
+        self._keyframe_requested = True
+
+    def stats(self):
+        encoded = self.frames_encoded or 1
+        return {
+            "target_bitrate": self._target_bitrate,
+            "frames_encoded": self.frames_encoded,
+            "keyframes": self.keyframes,
+            "bytes_out": self.bytes_out,
+            "encode_ms_avg": self.encode_time_total / encoded * 1000,
+            "encode_ms_max": self.encode_time_max * 1000,
+        }
+
+    def _create_codec(self, width, height):
+        # Same settings as aiortc's H264 encoder, on the 90 kHz clock of the frames so rate control sees real time
+        codec = av.CodecContext.create("libx264", "w")
+        codec.width = width
+        codec.height = height
+        codec.bit_rate = self._target_bitrate
+        codec.pix_fmt = "yuv420p"
+        codec.time_base = VIDEO_TIME_BASE
+        codec.framerate = fractions.Fraction(30, 1)
+        codec.options = {"profile": "baseline", "level": "31", "tune": "zerolatency"}
+        codec.open()
+        logger.info("Shared H264 encoder (%s layer) %sx%s at %d kbps", self.name, width, height, self._target_bitrate // 1000)
+        return codec
+
+    def encode(self, frame, lores_frame, pts):
+        # Runs in a worker thread. pts on the 90 kHz clock, the same for every layer of a frame
+        start = time.monotonic()
+        if self.size is not None:
+            if lores_frame is not None and (lores_frame.width, lores_frame.height) == self.size:
+                frame = lores_frame
+            elif (frame.width, frame.height) != self.size:
+                frame = frame.reformat(*self.size, interpolation="FAST_BILINEAR")
+        codec = self._codec
+        if codec is None or frame.width != codec.width or frame.height != codec.height \
+                or abs(self._target_bitrate - codec.bit_rate) / codec.bit_rate > BITRATE_CHANGE_THRESHOLD:
+            codec = self._codec = self._create_codec(frame.width, frame.height)
+        frame.pts = pts
+        frame.time_base = VIDEO_TIME_BASE
+        # Requests in quick succession (viewers switching layers, PLIs) share one keyframe
+        if self._keyframe_requested and (self._last_keyframe is None or start - self._last_keyframe >= KEYFRAME_MIN_INTERVAL):
+            frame.pict_type = av.video.frame.PictureType.I
+        else:
+            frame.pict_type = av.video.frame.PictureType.NONE
+        packets = []
+        for packet in codec.encode(frame):
+            packet.pts = pts
+            packet.time_base = VIDEO_TIME_BASE
+            packets.append((packet, packet.is_keyframe))
+            if packet.is_keyframe:
+                self._keyframe_requested = False
+                self._last_keyframe = start
+                self.keyframes += 1
+            self.bytes_out += packet.size
+        encode_time = time.monotonic() - start
+        self.frames_encoded += 1
+        self.encode_time_total += encode_time
+        self.encode_time_max = max(self.encode_time_max, encode_time)
+        return packets
+
+class SharedEncoder:
+    """
+    Encodes one source video track once to H264 and fans the packets out to every subscribed
+    FanoutTrack, so extra viewers cost no capture or encode time, only sending.
+    With lores_size it is a simulcast encoder: the same frames are also encoded at that size (the
+    LAYER_LORES layer) and each track receives one of the layers, switching at the next keyframe of
+    the other (FanoutTrack.select). A layer is only encoded while a track receives or switches to it.
+    Sources that already return encoded H264 packets (EncodedPlaceholderTrack) are passed through.
+    The source is only read while at least one track is subscribed.
+    """
+    def __init__(self, source, bitrate=DEFAULT_BITRATE, lores_size=None, lores_bitrate=LORES_BITRATE):
+        self.source = source
+        self.layers = {LAYER_MAIN: Layer(LAYER_MAIN, None, bitrate, MIN_BITRATE, MAX_BITRATE)}
+        if lores_size is not None:
+            self.layers[LAYER_LORES] = Layer(LAYER_LORES, tuple(lores_size), lores_bitrate, LORES_MIN_BITRATE, LORES_MAX_BITRATE)
+        self._subscribers = set()
+        self._active = asyncio.Event()
+        self._task = None
+        # Stats
+        self.frames_in = 0
+        self.bytes_out = 0
+        self.frames_encoded = 0
+        self.keyframes = 0
+        self.encode_time_total = 0.0
+        self.encode_time_max = 0.0
+
+    @property
+    def simulcast(self):
+        return LAYER_LORES in self.layers
+
+    @property
+    def target_bitrate(self):
+        return self.layers[LAYER_MAIN].target_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate):
+        self.layers[LAYER_MAIN].target_bitrate = bitrate
+
+    def layer_for(self, size):
+        """The layer to send for a capture size: the low-resolution one if it is at least as small."""
+        lores = self.layers.get(LAYER_LORES)
+        if lores is not None and size[0] <= lores.size[0] and size[1] <= lores.size[1]:
+            return LAYER_LORES
+        return LAYER_MAIN
+
+    def subscribe(self):
+        """New FanoutTrack for one peer connection. It starts receiving at the next keyframe once the sender reads it."""
+        return FanoutTrack(self)
+
+    def request_keyframe(self, layer=LAYER_MAIN):
+        self.layers[layer].request_keyframe()
+
+    def stats(self):
+        encoded = self.frames_encoded or 1
+        stats = {
+            "subscribers": len(self._subscribers),
+            "frames_encoded": self.frames_encoded,
+            "keyframes": self.keyframes,
+            "encode_ms_avg": self.encode_time_total / encoded * 1000,
+            "encode_ms_max": self.encode_time_max * 1000,
+        }
+        if self.simulcast:
+            stats["layers"] = {name: layer.stats() for name, layer in self.layers.items()}
+            stats["receiving"] = {name: sum(1 for track in self._subscribers if track.layer == name) for name in self.layers}
+        return stats
+
+    def _attach(self, track):
+        self._subscribers.add(track)
+        self.request_keyframe(track.layer)
+        self._active.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _detach(self, track):
+        self._subscribers.discard(track)
+        if not self._subscribers:
+            self._active.clear()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for track in list(self._subscribers):
+            track.stop()
+
+    def _active_layers(self):
+        # The main layer is also what the dashcam records
+        names = {LAYER_MAIN} if dashcam.recording else set()
+        for track in self._subscribers:
+            names.add(track.layer)
+            if track.pending_layer is not None:
+                names.add(track.pending_layer)
+        return [layer for name, layer in self.layers.items() if name in names]
+
+    def _encode(self, frame, lores_frame, layers):
+        # Runs in a worker thread, returns {layer name: [(packet, keyframe)]}
+        pts = int(frame.pts * frame.time_base * VIDEO_CLOCK_RATE)
+        return {layer.name: layer.encode(frame, lores_frame, pts) for layer in layers}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._subscribers:
+                await self._active.wait()
+            try:
+                recv_start = time.monotonic()
+                item = await self.source.recv()
+                if profiler.enabled:
+                    profiler.record("video_recv", time.monotonic() - recv_start)
+            except MediaStreamError:
+                logger.warning("Shared encoder source ended")
+                for track in list(self._subscribers):
+                    track.stop()
+                self._task = None
+                return
+            self.frames_in += 1
+            if isinstance(item, av.Packet):
+                # Encoded already, the same packets for every layer
+                encoded = {None: [(item, _is_keyframe(bytes(item)))]}
+            else:
+                # Camera's low-resolution output of the same capture, if it has one
+                lores_frame = getattr(self.source, "last_lores_frame", None)
+                start = time.monotonic()
+                encoded = await loop.run_in_executor(None, self._encode, item, lores_frame, self._active_layers())
+                encode_time = time.monotonic() - start
+                self.frames_encoded += 1
+                self.encode_time_total += encode_time
+                self.encode_time_max = max(self.encode_time_max, encode_time)
+                if profiler.enabled:
+                    profiler.record("video_encode", encode_time)
+            for name, packets in encoded.items():
+                for packet, keyframe in packets:
+                    self.keyframes += keyframe
+                    self.bytes_out += packet.size
+                    if name in (None, LAYER_MAIN):
+                        dashcam.record_video(packet, keyframe)
+            for track in list(self._subscribers):
+                track._deliver(encoded)
+
+class FanoutTrack(MediaStreamTrack):
+    """
+    One peer connection's view of a SharedEncoder. recv() returns the shared encoded packets, which
+    aiortc packetizes without encoding again. Needs H264 negotiated for the sender (see prefer_h264).
+    Keyframe requests (PLI) from the sender's peer are forwarded to the shared encoder.
+    Of a simulcast encoder it receives one layer, select() moves it to the other without renegotiation:
+    the current layer is sent until the other's next keyframe, and the stream continues from there.
+    """
+    kind = "video"
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.sender = None # RTCRtpSender, set once the track is added to a peer connection
+        self.timeline = None # latency.FrameTimeline of the source, only for the driver's track
+        self.layer = LAYER_MAIN
+        self.pending_layer = None # Switching to this layer at its next keyframe
+        self.layer_switches = 0
+        self.packets_dropped = 0
+        self._queue = deque()
+        self._event = asyncio.Event()
+        self._attached = False
+        self._need_keyframe = True
+        self._last_pts = None
+
+    def resync(self):
+        """Start over at the next keyframe, e.g. after moving to a new peer connection."""
+        self._queue.clear()
+        self._need_keyframe = True
+        self._last_pts = None
+        # Waiting for a keyframe anyway, a pending switch can take the next one
+        if self.pending_layer is not None:
+            self.layer, self.pending_layer = self.pending_layer, None
+        self.encoder.request_keyframe(self.layer)
+
+    def select(self, layer):
+        """Receive layer (LAYER_MAIN or LAYER_LORES) from its next keyframe on."""
+        if layer not in self.encoder.layers or layer == self.pending_layer:
+            return
+        if layer == self.layer:
+            self.pending_layer = None
+            return
+        self.pending_layer = layer
+        self.encoder.request_keyframe(layer)
+
+    def _deliver(self, encoded):
+        # encoded: the packets of one source frame per layer, under None for a passed through source
+        packets = encoded.get(None)
+        if packets is None:
+            switch = encoded.get(self.pending_layer)
+            if switch and switch[0][1]:
+                logger.debug("Track switched from the %s to the %s layer", self.layer, self.pending_layer)
+                self.layer, self.pending_layer = self.pending_layer, None
+                self.layer_switches += 1
+                packets = switch
+            else:
+                packets = encoded.get(self.layer, ())
+        for packet, keyframe in packets:
+            self._put(packet, keyframe)
+
+    def _put(self, packet, keyframe):
+        if self._need_keyframe:
+            if not keyframe:
+                return
+            self._need_keyframe = False
+        if len(self._queue) >= FANOUT_QUEUE_SIZE:
+            # This peer can't keep up, skip ahead to the next keyframe instead of building up delay
+            self.packets_dropped += len(self._queue) + 1
+            self.resync()
+            return
+        self._queue.append(packet)
+        self._event.set()
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if not self._attached:
+            self._attached = True
+            self.encoder._attach(self)
+
+        # aiortc's sender loop is sequential: being asked for the next packet means the previous one was sent
+        if self.timeline is not None and self._last_pts is not None:
+            self.timeline.on_sent(self._last_pts, time.monotonic(), self.sender)
+        if get_private(self.sender, FORCE_KEYFRAME, False):
+            set_private(self.sender, FORCE_KEYFRAME, False)
+            self.encoder.request_keyframe(self.layer)
+
+        while not self._queue:
+            self._event.clear()
+            await self._event.wait()
+            if self.readyState != "live":
+                raise MediaStreamError
+        packet = self._queue.popleft()
+        self._last_pts = packet.pts
+        self.emit("frame")
+        return packet
+
+    def stop(self):
+        super().stop()
+        self.encoder._detach(self)
+        self._event.set()
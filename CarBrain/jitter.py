@@ -0,0 +1,152 @@
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+MIN_PLAYOUT_DELAY = 0.0 # Seconds
+MAX_PLAYOUT_DELAY = 0.12 # Upper bound of the latency the buffer adds
+DELAY_PERCENTILE = 95 # Share of inputs (by their queueing delay over the window) that arrive in time for their playout
+JITTER_GAIN = 1 / 16 # Smoothing of the reported jitter (as RFC 3550)
+TRANSIT_WINDOW = 200 # Inputs over which the transit times are tracked, about 5 s at the 25 ms gamepad poll rate
+GAP_FACTOR = 1.5 # An input is missing once nothing was played for this many input intervals
+EXTRAPOLATION_HORIZON = 0.075 # Seconds the steering trend is continued into a gap
+HOLD_HORIZON = 0.15 # Seconds after the last input that it is held, then the failsafe takes over
+INTERVAL_SAMPLES = 200 # Intervals kept for the smoothing metrics
+
+def _stdev(values):
+    if len(values) < 2:
+        return None
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+class JitterBuffer:
+    """
+    Playout buffer for control inputs. Each input is applied at its sender timestamp plus a fixed offset
+    (minimum transit time seen plus a playout delay covering the queueing delay of DELAY_PERCENTILE of
+    recent inputs), so inputs that arrive bunched are replayed at their original spacing.
+    In a gap, the steering trend of the last two inputs is continued for EXTRAPOLATION_HORIZON, then the
+    last input is held until HOLD_HORIZON. After that nothing is applied and the no-input failsafe fires.
+    Not thread-safe, the actuation loop calls push() and sample() under its lock.
+    """
+    def __init__(self, min_delay=MIN_PLAYOUT_DELAY, max_delay=MAX_PLAYOUT_DELAY):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._queue = deque() # (playout time, send time, arrival time, values)
+        self._transits = deque(maxlen=TRANSIT_WINDOW)
+        self._last_transit = None
+        self._last_send = None
+        self._last_arrival = None
+        self.jitter = 0.0
+        self.interval = None # Smoothed interval between inputs (sender clock)
+        self.delay = min_delay
+        # Last two played inputs, (send time, values)
+        self._played = None
+        self._previous = None
+        self._last_playout = None
+        self._in_gap = False
+        # Stats
+        self.inputs = 0
+        self.late = 0
+        self.extrapolated_ticks = 0
+        self.held_ticks = 0
+        self.gaps = 0
+        self.handovers = 0
+        self.added_latency_total = 0.0
+        self.added_latency_max = 0.0
+        self.played = 0
+        self._arrival_intervals = deque(maxlen=INTERVAL_SAMPLES)
+        self._playout_intervals = deque(maxlen=INTERVAL_SAMPLES)
+
+    def push(self, send_time, values, now=None):
+        """Buffer an input, send_time in seconds on the sender's clock (any epoch), values a tuple of axes."""
+        now = time.monotonic() if now is None else now
+        self.inputs += 1
+        transit = now - send_time
+        if self._last_transit is not None:
+            self.jitter += (abs(transit - self._last_transit) - self.jitter) * JITTER_GAIN
+        self._last_transit = transit
+        self._transits.append(transit)
+        if self._last_send is not None and send_time > self._last_send:
+            interval = send_time - self._last_send
+            self.interval = interval if self.interval is None else self.interval + (interval - self.interval) * JITTER_GAIN
+        # Pauses in the input (longer than a bridged gap) aren't jitter, they are left out of the smoothing metrics
+        if self._last_arrival is not None and now - self._last_arrival <= HOLD_HORIZON:
+            self._arrival_intervals.append(now - self._last_arrival)
+        self._last_send = send_time
+        self._last_arrival = now
+
+        # Queueing delay of each recent input over the fastest one, the playout delay covers most of them
+        base = min(self._transits)
+        excess = sorted(t - base for t in self._transits)
+        self.delay = max(self.min_delay, min(excess[int(DELAY_PERCENTILE / 100 * (len(excess) - 1))], self.max_delay))
+        # Never hold an input longer than max_delay, e.g. after the sender's clock jumped
+        playout = min(send_time + base + self.delay, now + self.max_delay)
+        if playout < now:
+            self.late += 1
+            playout = now
+        self._queue.append((playout, send_time, now, values))
+
+    def sample(self, now=None):
+        """Values to apply at now: the newest input that is due, an extrapolated or held one in a gap, or None."""
+        now = time.monotonic() if now is None else now
+        due = None
+        while self._queue and self._queue[0][0] <= now:
+            due = self._queue.popleft()
+        if due is not None:
+            playout, send_time, arrival, values = due
+            added = playout - arrival
+            self.added_latency_total += added
+            self.added_latency_max = max(self.added_latency_max, added)
+            self.played += 1
+            if self._last_playout is not None and playout - self._last_playout <= HOLD_HORIZON:
+                self._playout_intervals.append(playout - self._last_playout)
+            self._previous, self._played = self._played, (send_time, values)
+            self._last_playout = playout
+            self._in_gap = False
+            return values
+
+        if self._played is None or self.interval is None:
+            return None
+        silence = now - self._last_playout
+        if silence < GAP_FACTOR * self.interval:
+            return None
+        if not self._in_gap:
+            self._in_gap = True
+            self.gaps += 1
+        if silence > HOLD_HORIZON:
+            if self._played is not None:
+                self.handovers += 1
+                self._played = None
+            return None
+
+        send_time, values = self._played
+        if silence <= EXTRAPOLATION_HORIZON and self._previous is not None and send_time > self._previous[0]:
+            # Dead reckoning: continue the steering trend, throttle and camera stay as they were
+            throttle, sterring, pan, tilt = values
+            rate = (sterring - self._previous[1][1]) / (send_time - self._previous[0])
+            self.extrapolated_ticks += 1
+            return throttle, max(-1.0, min(sterring + rate * silence, 1.0)), pan, tilt
+        self.held_ticks += 1
+        return values
+
+    def stats(self):
+        played = self.played or 1
+        arrival_jitter = _stdev(self._arrival_intervals)
+        playout_jitter = _stdev(self._playout_intervals)
+        return {
+            "inputs": self.inputs,
+            "late": self.late,
+            "jitter_ms": self.jitter * 1000,
+            "playout_delay_ms": self.delay * 1000,
+            "added_latency_ms_avg": self.added_latency_total / played * 1000,
+            "added_latency_ms_max": self.added_latency_max * 1000,
+            # Standard deviation of the intervals between inputs as they arrived and as they were applied
+            "arrival_interval_stdev_ms": arrival_jitter * 1000 if arrival_jitter is not None else None,
+            "playout_interval_stdev_ms": playout_jitter * 1000 if playout_jitter is not None else None,
+            "gaps": self.gaps,
+            "extrapolated_ticks": self.extrapolated_ticks,
+            "held_ticks": self.held_ticks,
+            "failsafe_handovers": self.handovers,
+        }
@@ -0,0 +1,120 @@
+import logging
+import time
+from collections import deque, OrderedDict
+
+from rtp_sender import get_private, RTP_TIMESTAMP, PACKET_COUNT
+
+logger = logging.getLogger(__name__)
+
+FRAMES_KEPT = 300 # Frame timelines kept for matching display reports
+SAMPLES_KEPT = 600 # Samples per metric for the rolling percentiles
+SUMMARY_INTERVAL = 10 # Seconds between logged latency summaries
+RTP_TIMESTAMP_MODULO = 1 << 32
+STAGES = ("capture", "conversion", "encode", "network", "render", "total")
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+class FrameTimeline:
+    """
+    Glass-to-glass latency of the outgoing video. The track records when each frame (by pts) was
+    captured, handed over, returned to aiortc and sent. The browser reports receive and display time
+    per RTP timestamp over the data channel, which is mapped back to the frame's pts.
+    Keeps rolling p50/p95/p99 for the total and each stage:
+    capture (sensor to buffer ready), conversion (copy), encode (handoff, encode and send),
+    network (send to browser receive) and render (receive to display).
+    """
+    def __init__(self):
+        self.sender = None # RTCRtpSender, set once the track is added to a peer connection
+        self._frames = OrderedDict() # pts -> [capture, published, copy time, returned, sent] (monotonic seconds)
+        self._last_pts = None
+        self._rtp_origin = None
+        self._origin_candidate = None
+        self._samples = {stage: deque(maxlen=SAMPLES_KEPT) for stage in STAGES}
+        self._last_summary = time.monotonic()
+        self.reports = 0
+        self.unmatched_reports = 0
+
+    def attach(self, sender):
+        """Follow a new RTCRtpSender (the track moved to a new peer connection), its RTP timestamps have a new origin."""
+        self.sender = sender
+        self._rtp_origin = None
+        self._origin_candidate = None
+
+    def on_recv(self, now):
+        # aiortc's sender loop is sequential: recv() being called again means the previous frame was encoded and sent.
+        # Only when the track feeds a sender directly, behind a SharedEncoder the fan-out track calls on_sent instead
+        if self._last_pts is None or self.sender is None:
+            return
+        self.on_sent(self._last_pts, now, self.sender)
+
+    def on_sent(self, pts, now, sender):
+        """The frame with this pts was sent by sender (the driver's, when the video is fanned out)."""
+        if sender is not self.sender:
+            self.attach(sender)
+        frame = self._frames.get(pts)
+        if frame is not None and frame[4] is None:
+            frame[4] = now
+        self._learn_rtp_origin(pts)
+
+    def on_frame(self, pts, capture_time, published_time, copy_time, returned_time):
+        self._frames[pts] = [capture_time, published_time, copy_time, returned_time, None]
+        if len(self._frames) > FRAMES_KEPT:
+            self._frames.popitem(last=False)
+        self._last_pts = pts
+
+    def _learn_rtp_origin(self, pts):
+        # aiortc adds a random offset to the pts for the RTP timestamp. Right after a frame was sent, the
+        # sender's last RTP timestamp belongs to that frame, so the offset is confirmed once two frames agree
+        rtp_timestamp = get_private(self.sender, RTP_TIMESTAMP)
+        if rtp_timestamp is None or not get_private(self.sender, PACKET_COUNT, 0):
+            return
+        origin = (rtp_timestamp - pts) % RTP_TIMESTAMP_MODULO
+        if origin == self._origin_candidate and origin != self._rtp_origin:
+            self._rtp_origin = origin
+            logger.debug("RTP timestamp origin %s", origin)
+        self._origin_candidate = origin
+
+    def on_report(self, rtp_timestamp, receive_time_ms, display_time_ms):
+        """Browser display report, times in ms since epoch on the car's clock."""
+        self.reports += 1
+        if self._rtp_origin is None:
+            self.unmatched_reports += 1
+            return
+        frame = self._frames.get((rtp_timestamp - self._rtp_origin) % RTP_TIMESTAMP_MODULO)
+        if frame is None or frame[4] is None:
+            self.unmatched_reports += 1
+            return
+
+        capture, published, copy_time, returned, sent = frame
+        # Browser times are on the wall clock, convert them to monotonic
+        clock_offset = time.time() - time.monotonic()
+        received = receive_time_ms / 1000 - clock_offset
+        displayed = display_time_ms / 1000 - clock_offset
+        samples = self._samples
+        samples["capture"].append(published - capture - copy_time)
+        samples["conversion"].append(copy_time)
+        samples["encode"].append(sent - published)
+        samples["network"].append(received - sent)
+        samples["render"].append(displayed - received)
+        samples["total"].append(displayed - capture)
+
+        now = time.monotonic()
+        if now - self._last_summary >= SUMMARY_INTERVAL:
+            self._last_summary = now
+            logger.info("Glass-to-glass latency (ms): %s", self.format_stats())
+
+    def stats(self):
+        """{stage: {"p50", "p95", "p99"}} in ms."""
+        result = {}
+        for stage, values in self._samples.items():
+            ordered = sorted(values)
+            result[stage] = {f"p{p}": percentile(ordered, p) * 1000 if ordered else None for p in (50, 95, 99)}
+        return result
+
+    def format_stats(self):
+        return " ".join(
+            f"{stage}={v['p50']:.1f}/{v['p95']:.1f}/{v['p99']:.1f}" for stage, v in self.stats().items() if v["p50"] is not None
+        ) + " (p50/p95/p99)"
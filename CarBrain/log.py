@@ -0,0 +1,165 @@
+import logging
+import logging.handlers
+import itertools
+import os
+import queue
+import signal
+import struct
+import sys
+import threading
+import time
+
+# Logging that is safe to use on the hot paths (control input, actuation):
+# records are filtered per call site and handed to a background writer thread, so the
+# caller never blocks on stdout/journald. Control and actuation events also go into an
+# in-memory flight recorder that can be dumped after a crash or on SIGUSR1.
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+RATE_LIMIT_INTERVAL = 1.0  # Seconds between records from the same call site
+FLIGHT_RECORDER_CAPACITY = 16384  # Events kept in memory
+FLIGHT_RECORDER_DUMP_SECONDS = 30
+FLIGHT_RECORDER_DIR = "."
+
+# Flight recorder event types
+EVENT_CONTROL = 1  # channel unused, values: throttle, sterring, pan, tilt quantised to int16
+EVENT_ACTUATION = 2  # channel: GPIO pin, values[0]: pulse width
+EVENT_FAILSAFE = 3  # channel: GPIO pin (0 if not applicable), values[0]: lateness in microseconds (saturated)
+EVENT_NAMES = {EVENT_CONTROL: "control", EVENT_ACTUATION: "actuation", EVENT_FAILSAFE: "failsafe"}
+
+_listener = None
+
+class RateLimitFilter(logging.Filter):
+    """Lets one record per call site (file, line) through per interval and counts the suppressed ones."""
+    def __init__(self, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._last_emit = {}
+        self._suppressed = {}
+
+    def filter(self, record):
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        last = self._last_emit.get(site)
+        if last is not None and now - last < self.interval:
+            self._suppressed[site] = self._suppressed.get(site, 0) + 1
+            return False
+        self._last_emit[site] = now
+        suppressed = self._suppressed.pop(site, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar suppressed)"
+        return True
+
+def _quantise(value):
+    # -1..1 to int16, clamped (NaN and None as 0) so a bad input can never make record() raise
+    if value is None or value != value:
+        return 0
+    return int(max(-1.0, min(1.0, value)) * 32767)
+
+class FlightRecorder:
+    """
+    Preallocated ring buffer of recent control and actuation events, stored as fixed-size
+    struct records (monotonic time f64, event u8, channel u8, 4x int16 values).
+    record() is a single pack_into and never allocates or blocks.
+    """
+    RECORD = struct.Struct("<dBBhhhh")
+
+    def __init__(self, capacity=FLIGHT_RECORDER_CAPACITY):
+        self.capacity = capacity
+        self._buffer = bytearray(self.RECORD.size * capacity)
+        self._counter = itertools.count()  # next() is atomic under the GIL
+        self._written = 0
+
+    def record(self, event, channel=0, a=0, b=0, c=0, d=0):
+        index = next(self._counter)
+        self.RECORD.pack_into(self._buffer, (index % self.capacity) * self.RECORD.size,
+                              time.monotonic(), event, channel, a, b, c, d)
+        self._written = index + 1
+
+    def record_control(self, throttle, sterring, pan, tilt):
+        self.record(EVENT_CONTROL, 0, _quantise(throttle), _quantise(sterring), _quantise(pan), _quantise(tilt))
+
+    def record_actuation(self, pin, pulse_width):
+        self.record(EVENT_ACTUATION, pin, int(pulse_width))
+
+    def record_failsafe(self, pin, lateness):
+        self.record(EVENT_FAILSAFE, pin, min(int(lateness * 1e6), 32767))
+
+    def events(self, seconds=None):
+        # Oldest first; a record being written concurrently may be torn, which is acceptable for a dump
+        written = self._written
+        start = max(0, written - self.capacity)
+        snapshot = bytes(self._buffer)
+        cutoff = time.monotonic() - seconds if seconds is not None else None
+        events = []
+        for index in range(start, written):
+            event = self.RECORD.unpack_from(snapshot, (index % self.capacity) * self.RECORD.size)
+            if cutoff is None or event[0] >= cutoff:
+                events.append(event)
+        return events
+
+    def dump(self, seconds=FLIGHT_RECORDER_DUMP_SECONDS, directory=FLIGHT_RECORDER_DIR):
+        """Write the last `seconds` of events to a CSV file and return its path."""
+        events = self.events(seconds)
+        path = os.path.join(directory, f"flight_{time.strftime('%Y%m%d-%H%M%S')}.csv")
+        now = time.monotonic()
+        with open(path, "w") as f:
+            f.write("age_s,event,channel,v0,v1,v2,v3\n")
+            for t, event, channel, a, b, c, d in events:
+                f.write(f"{now - t:.6f},{EVENT_NAMES.get(event, event)},{channel},{a},{b},{c},{d}\n")
+        return path
+
+    def dump_in_background(self, seconds=FLIGHT_RECORDER_DUMP_SECONDS):
+        def write():
+            path = self.dump(seconds)
+            logging.getLogger(__name__).warning("Flight recorder dumped to %s", path)
+        threading.Thread(target=write, name="flight-dump", daemon=True).start()
+
+# Shared instance
+flight_recorder = FlightRecorder()
+
+def setup_logging(level=logging.INFO, rate_limit_interval=RATE_LIMIT_INTERVAL):
+    """
+    Route all logging through a queue to a background writer thread, with per call site rate limiting.
+    Also installs flight recorder dumps on SIGUSR1 and on uncaught exceptions.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit_interval))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    # Dump the flight recorder on demand and after crashes
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: flight_recorder.dump_in_background())
+
+    previous_excepthook = sys.excepthook
+    def excepthook(exc_type, exc, tb):
+        if not issubclass(exc_type, KeyboardInterrupt):
+            print(f"Flight recorder dumped to {flight_recorder.dump()}")
+        previous_excepthook(exc_type, exc, tb)
+    sys.excepthook = excepthook
+
+    previous_thread_excepthook = threading.excepthook
+    def thread_excepthook(args):
+        flight_recorder.dump_in_background()
+        previous_thread_excepthook(args)
+    threading.excepthook = thread_excepthook
+
+def shutdown_logging():
+    # Flush pending records
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,180 +1,159 @@
 import time
-import json
 import asyncio
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer, RTCIceCandidate, VideoStreamTrack
-import socketio
-from av import VideoFrame
-import cv2
-from engine import handle_controller_input
+import importlib
+import logging
+import signal
+from startup import profile
+from actuation import ActuationLoop
+from jitter import JitterBuffer
+from calibration import calibration
+from dashcam import dashcam
+from telemetry import Telemetry
+from profiling import profiler
+from failsafe import scheduler
+from GPIO import bus
+from log import setup_logging, shutdown_logging
+from control_process import ControlProcess
+from signaling import CarSignaling
+# aiortc and PyAV (fanout, placeholder) are heavy, they are imported on first use on a worker thread
+# while the car connects to the signaling server (see start_video)
 
 from config import SIGNALING_SERVER_URL, SIGNALING_SERVER_TOKEN
 
+CAR_ID = "default" # Signaling session of this car, the browser joins it with ?car=<id>
 VIDEO_FILE_PATH = 'video_placeholder.mp4'
-
-sio = None
-peer_connection = None
-
-class PlaceholderVideoTrack(VideoStreamTrack):
-    def __init__(self, video_file):
-        super().__init__()
-        self.cap = cv2.VideoCapture(video_file)
-        self.running = True
-
-    async def recv(self):
-        while self.running:
-            ret, frame = self.cap.read()
-            if not ret:
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Loop back to the start
-                ret, frame = self.cap.read()  # Read the first frame
-                if not ret:
-                    print("Failed to loop the video")
-                    self.running = False
-                    continue
-
-            # Convert the frame to the correct format
-            av_frame = VideoFrame.from_ndarray(frame, format="bgr24")
-            av_frame.pts, av_frame.time_base = await self.next_timestamp()
-
-            return av_frame
-
-    @property
-    def kind(self):
-        return "video"
-
-    def __del__(self):
-        self.cap.release()
-
-async def create_peer_connection():
-    global peer_connection
-    if peer_connection is not None:
-        await peer_connection.close()
-    peer_connection = RTCPeerConnection(configuration=RTCConfiguration([RTCIceServer("stun:fr-turn1.xirsys.com")]))
-
-    # Add video track from the placeholder video
-    video_track = PlaceholderVideoTrack(VIDEO_FILE_PATH)
-    peer_connection.addTrack(video_track)
+PLACEHOLDER_MODE = "passthrough" # passthrough (loop encoded file, no decode/encode) or pattern (synthetic test pattern)
+PLACEHOLDER_SIZE = (640, 480) # Test pattern only
+PLACEHOLDER_FPS = 30 # Test pattern only
+SIMULCAST = True # Test pattern only: also encode a downscaled layer that peers on a poor link switch to
+LORES_SIZE = (320, 240)
+MAX_VIEWERS = 3 # Peers watching the video besides the driver, more are refused (as are any on a saturated CPU or uplink)
+ACTUATION_RATE_HZ = 100
+JITTER_BUFFER = False # Replay control inputs at their original spacing and bridge short gaps (adds up to jitter.MAX_PLAYOUT_DELAY latency), for bursty links like 4G
+ACTUATOR_BACKEND = "pigpio" # pigpio, fake or null
+CONTROL_PROCESS = False # Run the control engine and actuator output in their own real-time process, fed through shared memory (see control_process.py)
+CONTROL_RESULTS_PATH = None # The control process writes its stats (and a fake backend's writes) to this file when it exits
+LOG_LEVEL = logging.INFO
+STARTUP_PROFILE_PATH = None # Also write the startup profile as JSON to this file
+TELEMETRY_RATE_HZ = 5 # Snapshots per second on the telemetry data channel
+METRICS_HOST = "127.0.0.1" # The endpoint has no authentication: "0.0.0.0" (or one interface's address) to let a scraper on the network reach it
+METRICS_PORT = 9108 # Prometheus endpoint (http://127.0.0.1:9108/metrics), None disables it
+CALIBRATION_PATH = "calibration.json" # Steering, throttle, pan and tilt curves (see calibration.py), reloaded when the file changes
+DASHCAM_DIR = None # Record the outgoing video, control inputs and actuator writes here (see dashcam.py), e.g. "dashcam". Keeps the main video layer encoded while recording
+DASHCAM_MAX_BYTES = 2 * 1024 ** 3 # The oldest recordings are deleted beyond this
+VIDEO_MODULES = ("aiortc", "fanout", "placeholder")
+
+logger = logging.getLogger(__name__)
+
+signaling = None # The signaling session, offers and the peers' data channels (see signaling.py)
+actuation = None
+telemetry = None
+
+def import_video_modules():
+    for name in VIDEO_MODULES:
+        importlib.import_module(name)
+
+# Video pipeline, set up in parallel with the signaling connection: the heavy modules load and the
+# placeholder is prepared on worker threads, then the shared encoder and the first prewarmed peer connection are built
+async def start_video():
+    await asyncio.to_thread(import_video_modules)
+    profile.mark("video_modules_imported")
+
+    # Placeholder video, encoded once and fanned out to the driver and any viewers
+    from placeholder import create_placeholder_track
+    video_source = await asyncio.to_thread(create_placeholder_track, PLACEHOLDER_MODE, VIDEO_FILE_PATH, PLACEHOLDER_SIZE, PLACEHOLDER_FPS)
+    await signaling.attach_video(video_source, lores_size=LORES_SIZE if SIMULCAST and PLACEHOLDER_MODE == "pattern" else None)
 
 async def main():
-    global peer_connection
-    global sio
+    global signaling
+    global actuation
+    global telemetry
 
+    profile.mark("main")
+    setup_logging(LOG_LEVEL)
     try:
-        # Socket.IO client
-        sio = socketio.AsyncClient()
-
-        @sio.event
-        async def connect():
-            print("Connected to the signaling server")
+        # Single actuator bus connection for servo, motor, pan and tilt, unless the control process owns them
+        bus.set_backend("null" if CONTROL_PROCESS else ACTUATOR_BACKEND)
 
-        @sio.event
-        async def disconnect():
-            print("Disconnected from the server")
-            await peer_connection.close()
+        # Input to pulse width curves, edited while the car runs
+        calibration.watch(CALIBRATION_PATH)
 
-        @sio.on('offer')
-        async def handle_offer(offer_json):
+        # Dashcam of what the driver saw and sent, in a bounded ring of segments
+        if DASHCAM_DIR is not None:
             try:
-                print('Received offer from Peer A')
-                
-                # Create peer connection
-                await create_peer_connection()
-                
-                offer = json.loads(offer_json)
-
-                # Send candidate to Peer A over signaling channel
-                @peer_connection.on("ice_candidate")
-                async def on_icecandidate(candidate):
-                    await sio.emit('ice_candidate', json.dumps({
-                        "candidate": candidate.candidate,
-                        "sdpMid": candidate.sdpMid,
-                        "sdpMLineIndex": candidate.sdpMLineIndex
-                    }))
-
-                # Handle Data Channel
-                @peer_connection.on("datachannel")
-                def on_data_channel(channel):
-                    @channel.on("message")
-                    def on_message(message):
-                        # Received controller input from Peer A | Format: throttle,sterring (-1 to 1)
-                        if "," in message:
-                            throttle, sterring = message.split(",")
-                            handle_controller_input(float(throttle), float(sterring))
-
-                        # Send timestamp to Peer A
-                        if "," not in message:
-                            channel.send(str(int(time.time() * 1000)))
-                            print(f"Recieved {message} and sent timestamp to Peer A")
-
-                    @channel.on("open")
-                    def on_open():
-                        print("dataChannel opened")
-
-                    @channel.on("close")
-                    def on_close():
-                        print("dataChannel closed")
-
-                # Set remote description from Peer A
-                try:
-                    await peer_connection.setRemoteDescription(RTCSessionDescription(sdp=offer["sdp"], type=offer["type"]))
-                except Exception as e:
-                    print(f"Error setting remote description: {e}")
-
-                # Create and set local answer
-                try:
-                    local_answer = await peer_connection.createAnswer()
-                    await peer_connection.setLocalDescription(local_answer)
-                except Exception as e:
-                    print(f"Error creating or setting local answer: {e}")
-
-                await sio.emit('answer', json.dumps({"sdp": peer_connection.localDescription.sdp, "type": peer_connection.localDescription.type}))
-            except Exception as e:
-                print(f"Error handling offer: {e}")
-            
-        # Handle ICE candidate messages
-        @sio.on('ice_candidate')
-        async def handle_icecandidate(data):
+                dashcam.start(DASHCAM_DIR, DASHCAM_MAX_BYTES)
+            except OSError as e:
+                logger.error("Error starting dashcam: %s", e)
+
+        # Profiling mode on demand: kill -USR2 toggles it with the sampling profiler, "profile" on the data channel
+        # with or without it. SIGUSR1 stays the flight recorder dump (see log.py)
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR2, profiler.toggle, True)
+
+        if CONTROL_PROCESS:
+            # The same actuation loop in a process pinned to its own core, with a watchdog on this one's event loop
+            actuation = ControlProcess(ACTUATOR_BACKEND, ACTUATION_RATE_HZ, JITTER_BUFFER, CALIBRATION_PATH, results_path=CONTROL_RESULTS_PATH)
+        else:
+            # Fixed-rate actuation loop, decoupled from the data channel message rate
+            actuation = ActuationLoop(rate_hz=ACTUATION_RATE_HZ, jitter_buffer=JitterBuffer() if JITTER_BUFFER else None)
+        actuation.start()
+        profile.mark("actuation_ready")
+
+        # Telemetry for the peers and the local metrics endpoint, read from the components' own counters
+        telemetry = Telemetry(TELEMETRY_RATE_HZ)
+        telemetry.source("video_frames", lambda: signaling.encoder.frames_in)
+        telemetry.source("video_bytes", lambda: signaling.encoder.bytes_out)
+        telemetry.source("video_target_bitrate_bps", lambda: signaling.encoder.target_bitrate)
+        telemetry.source("control_inputs", lambda: actuation.inputs_total)
+        telemetry.source("command_age_seconds", lambda: time.monotonic() - actuation.last_apply_time)
+        if CONTROL_PROCESS:
+            telemetry.source("failsafe_fired", lambda: actuation.failsafe_fired)
+            telemetry.source("control_latency_seconds", lambda: actuation.latency_p99)
+            telemetry.source("watchdog_trips", lambda: actuation.watchdog_trips)
+        else:
+            telemetry.source("failsafe_fired", lambda: scheduler.fired)
+        telemetry.source("peers", lambda: len(signaling.peers.peers))
+        telemetry.start()
+        if METRICS_PORT is not None:
             try:
-                print('Received ICE candidate from Peer A:', data)
-                candidate_data = json.loads(data)
-
-                # Parse the ICE candidate string
-                parts = candidate_data['candidate'].split()
-
-                # Create an RTCIceCandidate object
-                ice_candidate = RTCIceCandidate(
-                    foundation=parts[0],
-                    component=int(parts[1]),
-                    protocol=parts[2].lower(),
-                    priority=int(parts[3]),
-                    ip=parts[4],
-                    port=int(parts[5]),
-                    type=parts[7],
-                    sdpMid=candidate_data.get('sdpMid'),
-                    sdpMLineIndex=candidate_data.get('sdpMLineIndex')
-                )
-
-                await peer_connection.addIceCandidate(ice_candidate)
-                print("Added ICE candidate")
-            except Exception as e:
-                print(f"Error handling ICE candidate: {e}")
-
-        # Connect to signaling server
+                await telemetry.serve(METRICS_HOST, METRICS_PORT)
+            except OSError as e:
+                logger.error("Error starting metrics endpoint: %s", e)
+
+        # Video setup, while connecting to the signaling server
+        signaling = CarSignaling(CAR_ID, actuation, telemetry, MAX_VIEWERS)
+        signaling.prepare_video(start_video())
+        try:
+            await signaling.connect(SIGNALING_SERVER_URL, SIGNALING_SERVER_TOKEN)
+            profile.mark("signaling_connected")
+        except Exception as e:
+            logger.error("Error connecting to signaling server: %s", e)
+            return
+
         try:
-            await sio.connect(f"{SIGNALING_SERVER_URL}/?token={SIGNALING_SERVER_TOKEN}")
+            await signaling.video_ready
         except Exception as e:
-            print(f"Error connecting to signaling server: {e}")
+            logger.error("Error setting up video: %s", e)
             return
+        profile.mark("ready")
+        profile.report(STARTUP_PROFILE_PATH)
 
         # Keep application running
-        await sio.wait()
+        await signaling.sio.wait()
     finally:
-        if sio is not None:
-            await sio.disconnect()
-            print("Disconnected from signaling server")
-        if peer_connection is not None:
-            await peer_connection.close()
-            print("Closed peer connection")
-        print("Graceful shutdown complete")
+        if signaling is not None:
+            await signaling.close()
+        if actuation is not None:
+            actuation.stop()
+            logger.info("Stopped actuation loop: %s", actuation.stats())
+        calibration.stop()
+        dashcam.stop()
+        profiler.stop()
+        if telemetry is not None:
+            telemetry.stop()
+        bus.close()
+        logger.info("Graceful shutdown complete")
+        shutdown_logging()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -1,17 +1,23 @@
-import pigpio
-import threading
-import time
+import GPIO
+from failsafe import scheduler
+from calibration import calibration, Curve
+
+# Seconds without input before pan/tilt returns to default
+RESET_DELAY = 0.2
+DEADBAND = 0.075 # Circumvents minimal stick drift
 
 class PanTilt:
     """
-    Simple pan-tilt servo controller using pigpio, with auto-reset and calibration support.
+    Simple pan-tilt servo controller on the shared actuator bus, with auto-reset and calibration support.
     set_angles, set_pan, set_tilt, and calibration now use normalized values in the range -1..1.
     min_norm, max_norm, default_norm for both pan and tilt are in -1..1 and mapped to hardware pulsewidths internally.
+    They define the default "pan" and "tilt" curves of the shared calibration, a calibration file can override them.
     """
     def __init__(self, pan_pin, tilt_pin, invert_pan=False, invert_tilt=False,
                  pan_min_norm=-1, pan_max_norm=1, tilt_min_norm=-1, tilt_max_norm=1,
                  pan_default_norm=0, tilt_default_norm=0,
-                 pan_hw_min_pulse=500, pan_hw_max_pulse=2500, tilt_hw_min_pulse=500, tilt_hw_max_pulse=2500):
+                 pan_hw_min_pulse=500, pan_hw_max_pulse=2500, tilt_hw_min_pulse=500, tilt_hw_max_pulse=2500,
+                 bus=None):
         self.pan_pin = pan_pin
         self.tilt_pin = tilt_pin
         self.invert_pan = invert_pan
@@ -28,43 +34,39 @@ class PanTilt:
         self.pan_hw_max_pulse = pan_hw_max_pulse
         self.tilt_hw_min_pulse = tilt_hw_min_pulse
         self.tilt_hw_max_pulse = tilt_hw_max_pulse
-        self.pi = pigpio.pi()
-        if not self.pi.connected:
-            raise RuntimeError("Could not connect to pigpio daemon. Is it running?")
+        self.bus = bus if bus is not None else GPIO.bus
         self.pan_norm = self.pan_default_norm
         self.tilt_norm = self.tilt_default_norm
-        self._reset_timer = None
+        self._reset_key = ("pantilt", pan_pin, tilt_pin)
+        self._set_default_curves()
         self.set_angles(self.pan_default_norm, self.tilt_default_norm)
 
-    def _norm_to_pulse(self, value, min_norm, max_norm, hw_min, hw_max):
-        """Map value in min_norm..max_norm to hw_min..hw_max pulsewidth."""
-        value = max(min_norm, min(max_norm, value))
-        if max_norm != min_norm:
-            norm = (value - min_norm) / (max_norm - min_norm)
-        else:
-            norm = 0.5
-        return int(hw_min + norm * (hw_max - hw_min))
+    def _set_default_curves(self):
+        calibration.set_defaults(
+            pan=Curve.from_normalized(self.pan_min_norm, self.pan_max_norm, self.pan_hw_min_pulse, self.pan_hw_max_pulse,
+                                      invert=self.invert_pan, deadband=DEADBAND),
+            tilt=Curve.from_normalized(self.tilt_min_norm, self.tilt_max_norm, self.tilt_hw_min_pulse, self.tilt_hw_max_pulse,
+                                       invert=self.invert_tilt, deadband=DEADBAND),
+        )
 
     def _start_reset_timer(self):
-        if self._reset_timer:
-            self._reset_timer.cancel()
-        self._reset_timer = threading.Timer(0.2, self._reset_to_default)
-        self._reset_timer.daemon = True
-        self._reset_timer.start()
+        # Re-arm the shared failsafe deadline instead of creating a timer thread per message (recorded under the pan pin, it resets both)
+        scheduler.arm(self._reset_key, RESET_DELAY, self._reset_to_default, self.pan_pin)
 
     def _reset_to_default(self):
         self.set_angles(self.pan_default_norm, self.tilt_default_norm, start_timer=False)
 
-    def set_angles(self, pan, tilt, start_timer=True):
-        # Accept -1..1, map to calibrated range
-        pan_to_set = -pan if self.invert_pan else pan
-        tilt_to_set = -tilt if self.invert_tilt else tilt
-        
-        pan_pulse = self._norm_to_pulse(pan_to_set, self.pan_min_norm, self.pan_max_norm, self.pan_hw_min_pulse, self.pan_hw_max_pulse)
-        tilt_pulse = self._norm_to_pulse(tilt_to_set, self.tilt_min_norm, self.tilt_max_norm, self.tilt_hw_min_pulse, self.tilt_hw_max_pulse)
+    def set_angles(self, pan, tilt, start_timer=True, flush=True):
+        # flush=False only stages the pulsewidths, for callers that flush the bus themselves (actuation loop)
+        # Accept -1..1, map to calibrated range (inversion is part of the curves)
+        pan_pulse = calibration.pulse("pan", pan)
+        tilt_pulse = calibration.pulse("tilt", tilt)
         
-        self.pi.set_servo_pulsewidth(self.pan_pin, pan_pulse)
-        self.pi.set_servo_pulsewidth(self.tilt_pin, tilt_pulse)
+        # The bus only writes pins whose pulsewidth changed
+        self.bus.set(self.pan_pin, pan_pulse)
+        self.bus.set(self.tilt_pin, tilt_pulse)
+        if flush:
+            self.bus.flush((self.pan_pin, self.tilt_pin))
         
         self.pan_norm = pan
         self.tilt_norm = tilt
@@ -72,6 +74,10 @@ class PanTilt:
         if start_timer:
             self._start_reset_timer()
 
+    def keep_alive(self):
+        """Re-arm the reset timer without writing pulsewidths (input received but unchanged)."""
+        self._start_reset_timer()
+
     def set_pan(self, value):
         self.set_angles(value, self.tilt_norm)
 
@@ -92,10 +98,10 @@ class PanTilt:
             self.pan_default_norm = pan_default_norm
         if tilt_default_norm is not None:
             self.tilt_default_norm = tilt_default_norm
+        self._set_default_curves()
 
     def cleanup(self):
-        if self._reset_timer:
-            self._reset_timer.cancel()
-        self.pi.set_servo_pulsewidth(self.pan_pin, 0)
-        self.pi.set_servo_pulsewidth(self.tilt_pin, 0)
-        self.pi.stop()
\ No newline at end of file
+        scheduler.disarm(self._reset_key)
+        self.bus.set(self.pan_pin, 0)
+        self.bus.set(self.tilt_pin, 0)
+        self.bus.flush((self.pan_pin, self.tilt_pin))
\ No newline at end of file
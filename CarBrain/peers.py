@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+
+from adaptive import AdaptiveVideoController, LAYER_LADDER
+from connection import CandidateBuffer
+
+logger = logging.getLogger(__name__)
+
+ROLE_DRIVER = "driver"
+ROLE_VIEWER = "viewer"
+MAX_VIEWERS = 3 # Viewers besides the driver
+CPU_LOAD_LIMIT = 0.85 # 1 minute load average per core above which new viewers are refused
+UPLINK_BUDGET = 6_000_000 # bps available for video, each peer receives its own copy of the stream
+
+class Peer:
+    """One remote peer (the driver or a viewer) with its own peer connection."""
+    def __init__(self, peer_id, role):
+        self.peer_id = peer_id
+        self.role = role
+        self.peer_connection = None
+        self.video_sender = None
+        self.candidates = CandidateBuffer()
+        self.setup = None # connection.SetupTimeline of the latest connection
+        self.stall_detector = None
+        self.stalled_at = None # When the current connection was detected as stalled, until the peer reconnects
+        self.layer_selector = None # AdaptiveVideoController picking the simulcast layer for this peer's link
+        self.rejected_controls = 0
+
+    @property
+    def is_driver(self):
+        return self.role == ROLE_DRIVER
+
+    def stop_stall_detector(self):
+        if self.stall_detector is not None:
+            self.stall_detector.stop()
+            self.stall_detector = None
+
+    def stop_layer_selector(self):
+        if self.layer_selector is not None:
+            self.layer_selector.stop()
+            self.layer_selector = None
+
+class PeerManager:
+    """
+    Peer connections of the driver and any viewers, keyed by the signaling server's peer id.
+    All of them get the same encoded video (a FanoutTrack of one SharedEncoder) and only the driver's
+    control input is applied. New viewers are refused over max_viewers, on a saturated CPU or when
+    one more copy of the stream would exceed the uplink budget. The driver is always admitted.
+    With a simulcast encoder, each peer receives the layer its own link carries (see adapt_layers).
+    """
+    def __init__(self, prewarmed, encoder, timeline=None, max_viewers=MAX_VIEWERS, uplink_budget=UPLINK_BUDGET):
+        self.prewarmed = prewarmed
+        self.encoder = encoder
+        self.timeline = timeline # latency.FrameTimeline of the camera, follows the driver
+        self.max_viewers = max_viewers
+        self.uplink_budget = uplink_budget
+        self.peers = {}
+        self.refused = 0
+
+    def get(self, peer_id):
+        return self.peers.get(peer_id)
+
+    @property
+    def driver(self):
+        return next((peer for peer in self.peers.values() if peer.is_driver), None)
+
+    def viewers(self):
+        return [peer for peer in self.peers.values() if not peer.is_driver]
+
+    def admission(self, peer_id, role):
+        """None if the peer may connect, otherwise the reason it is refused."""
+        if role == ROLE_DRIVER or peer_id in self.peers:
+            return None
+        if len(self.viewers()) >= self.max_viewers:
+            return f"viewer limit ({self.max_viewers}) reached"
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load > CPU_LOAD_LIMIT:
+            return f"CPU saturated (load {load:.2f} per core)"
+        streams = len(self.peers) + 1
+        if streams * self.encoder.target_bitrate > self.uplink_budget:
+            return f"uplink budget exceeded ({streams} x {self.encoder.target_bitrate // 1000} kbps)"
+        return None
+
+    def join(self, peer_id, role):
+        """The peer for a new offer, created on its first one. Its connection is set up by connect()."""
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            peer = self.peers[peer_id] = Peer(peer_id, None)
+        self.set_role(peer_id, role)
+        return peer
+
+    async def connect(self, peer):
+        """
+        Give the peer a new connection from the prewarmed one, replacing its previous connection if any.
+        A reconnecting peer keeps its video track, which resumes at the next keyframe.
+        """
+        peer.stop_stall_detector()
+        video_track = None
+        if peer.video_sender is not None and peer.video_sender.track is not None and peer.video_sender.track.readyState == "live":
+            video_track = peer.video_sender.track
+            # Detached first, as closing a connection stops its senders' tracks
+            peer.video_sender.replaceTrack(None)
+            video_track.resync()
+        if peer.peer_connection is not None:
+            asyncio.ensure_future(peer.peer_connection.close())
+        peer.peer_connection, peer.video_sender = await self.prewarmed.take(video_track)
+        peer.video_sender.track.sender = peer.video_sender
+        self._update_timeline()
+
+    def set_role(self, peer_id, role):
+        """Hand the driver role to a peer (the previous driver becomes a viewer) or take it away."""
+        peer = self.peers.get(peer_id)
+        if peer is None or peer.role == role:
+            return
+        if role == ROLE_DRIVER:
+            self._demote_driver(except_peer=peer)
+        peer.role = role
+        logger.info("Peer %s is now %s", peer_id, role)
+        self._update_timeline()
+
+    def _demote_driver(self, except_peer):
+        for peer in self.peers.values():
+            if peer is not except_peer and peer.is_driver:
+                peer.role = ROLE_VIEWER
+                logger.info("Peer %s is now %s", peer.peer_id, ROLE_VIEWER)
+
+    def _update_timeline(self):
+        # Glass-to-glass latency is measured on the driver's stream only
+        for peer in self.peers.values():
+            if peer.video_sender is not None and peer.video_sender.track is not None:
+                peer.video_sender.track.timeline = self.timeline if peer.is_driver else None
+
+    def adapt_layers(self, include_driver=True):
+        """
+        Give each connected peer a layer selector for its current connection (a stalled one has none),
+        or stop it. Called whenever a connection or the driver changes. Without include_driver the
+        driver's layer is left to its own adaptive controller.
+        """
+        for peer in self.peers.values():
+            sender = peer.video_sender
+            if not self.encoder.simulcast or sender is None or peer.stall_detector is None or (peer.is_driver and not include_driver):
+                peer.stop_layer_selector()
+            elif peer.layer_selector is None or peer.layer_selector.sender is not sender:
+                peer.stop_layer_selector()
+                peer.layer_selector = AdaptiveVideoController(sender, ladder=LAYER_LADDER, start_rung=len(LAYER_LADDER) - 1, track=sender.track)
+                peer.layer_selector.start()
+
+    async def remove(self, peer_id):
+        peer = self.peers.pop(peer_id, None)
+        if peer is None:
+            return
+        peer.stop_stall_detector()
+        peer.stop_layer_selector()
+        if peer.peer_connection is not None:
+            await peer.peer_connection.close()
+        logger.info("Removed %s %s", peer.role, peer_id)
+
+    async def close(self):
+        for peer_id in list(self.peers):
+            await self.remove(peer_id)
+
+    def stats(self):
+        driver = self.driver
+        return {
+            "driver": driver.peer_id if driver else None,
+            "viewers": len(self.viewers()),
+            "refused": self.refused,
+            "layers": {peer.peer_id: peer.video_sender.track.layer for peer in self.peers.values()
+                       if peer.video_sender is not None and peer.video_sender.track is not None},
+            "encoder": self.encoder.stats(),
+        }
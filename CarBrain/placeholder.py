@@ -0,0 +1,174 @@
+import asyncio
+import fractions
+import logging
+import time
+
+import av
+import numpy as np
+from aiortc.mediastreams import MediaStreamTrack, MediaStreamError
+from av import VideoFrame
+
+logger = logging.getLogger(__name__)
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+ANNEXB_START_CODE = b"\x00\x00\x00\x01"
+ONE_TIME_ENCODE_BITRATE = 1_000_000 # Used only when the file has to be re-encoded once at load
+
+# Encoded H264 packets per video file, so reconnects and extra viewers never demux the file again
+_packet_cache = {}
+
+def _avcc_parameter_sets(extradata):
+    # avcC box: lengthSizeMinusOne in byte 4, then SPS and PPS lists (u16 length prefixed)
+    length_size = (extradata[4] & 0x03) + 1
+    offset = 5
+    parameter_sets = []
+    for count_mask in (0x1f, 0xff):
+        count = extradata[offset] & count_mask
+        offset += 1
+        for _ in range(count):
+            size = int.from_bytes(extradata[offset:offset + 2], "big")
+            parameter_sets.append(extradata[offset + 2:offset + 2 + size])
+            offset += 2 + size
+    return length_size, parameter_sets
+
+def _avcc_to_annexb(data, length_size):
+    nal_units = []
+    offset = 0
+    while offset + length_size <= len(data):
+        size = int.from_bytes(data[offset:offset + length_size], "big")
+        offset += length_size
+        nal_units.append(ANNEXB_START_CODE + data[offset:offset + size])
+        offset += size
+    return b"".join(nal_units)
+
+def _demux_passthrough(stream, container):
+    # Keep the packets as they are, converted from MP4 (AVCC) to the Annex B format aiortc packetizes
+    length_size, parameter_sets = _avcc_parameter_sets(bytes(stream.codec_context.extradata))
+    parameter_sets = b"".join(ANNEXB_START_CODE + ps for ps in parameter_sets)
+    packets = []
+    for packet in container.demux(stream):
+        if packet.size == 0:
+            continue
+        data = _avcc_to_annexb(bytes(packet), length_size)
+        # Repeat SPS/PPS on keyframes so a viewer can start decoding at any loop
+        packets.append(parameter_sets + data if packet.is_keyframe else data)
+    return packets
+
+def _encode_once(stream, container):
+    # WebRTC receivers can't reorder B-frames, so such files are re-encoded once at load to
+    # constrained baseline with a keyframe at the start of every loop
+    encoder = av.CodecContext.create("libx264", "w")
+    encoder.width = stream.codec_context.width
+    encoder.height = stream.codec_context.height
+    encoder.pix_fmt = "yuv420p"
+    encoder.time_base = 1 / stream.average_rate
+    encoder.framerate = stream.average_rate
+    encoder.bit_rate = ONE_TIME_ENCODE_BITRATE
+    encoder.options = {"profile": "baseline", "bf": "0", "g": "100000", "tune": "zerolatency"}
+    packets = []
+    for index, frame in enumerate(container.decode(stream)):
+        frame = frame.reformat(format="yuv420p")
+        frame.pts = index
+        frame.pict_type = av.video.frame.PictureType.I if index == 0 else av.video.frame.PictureType.NONE
+        packets.extend(bytes(packet) for packet in encoder.encode(frame))
+    packets.extend(bytes(packet) for packet in encoder.encode(None))
+    return packets
+
+def load_encoded_packets(video_file):
+    """Return (Annex B H264 packets in decode order, frame rate) for a video file, demuxed once per process."""
+    if video_file not in _packet_cache:
+        start = time.monotonic()
+        with av.open(video_file) as container:
+            stream = container.streams.video[0]
+            fps = float(stream.average_rate or 30)
+            if stream.codec_context.name == "h264" and not stream.codec_context.has_b_frames:
+                packets = _demux_passthrough(stream, container)
+            else:
+                packets = _encode_once(stream, container)
+        _packet_cache[video_file] = (packets, fps)
+        logger.info("Loaded %d encoded placeholder packets from %s in %.0f ms",
+                    len(packets), video_file, (time.monotonic() - start) * 1000)
+    return _packet_cache[video_file]
+
+class _PacedTrack(MediaStreamTrack):
+    # Paces recv() to a fixed frame rate and timestamps on the 90 kHz video clock. Emits "frame" for every
+    # frame the sender asks for, the first one once the connection is up
+    kind = "video"
+
+    def __init__(self, fps):
+        super().__init__()
+        self.fps = fps
+        self._index = 0
+        self._start = None
+
+    async def _next_pts(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._start is None:
+            self._start = time.monotonic()
+        else:
+            delay = self._start + self._index / self.fps - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        pts = int(self._index * VIDEO_CLOCK_RATE / self.fps)
+        self._index += 1
+        self.emit("frame")
+        return pts
+
+class EncodedPlaceholderTrack(_PacedTrack):
+    """
+    Loops the encoded H264 packets of a video file to the peer with rewritten timestamps.
+    recv() returns av.Packet, which aiortc packetizes without decoding or encoding.
+    Needs H264 negotiated for the sender (see prefer_h264). Keyframe requests (PLI) can't be
+    honoured, a new viewer starts decoding at the next loop.
+    """
+    def __init__(self, video_file):
+        packets, fps = load_encoded_packets(video_file)
+        super().__init__(fps)
+        self._packets = packets
+
+    async def recv(self):
+        pts = await self._next_pts()
+        # A new packet each loop: the previous loop's can still be queued (FanoutTrack, dashcam) with its own pts
+        packet = av.Packet(self._packets[(self._index - 1) % len(self._packets)])
+        packet.pts = pts
+        packet.time_base = VIDEO_TIME_BASE
+        return packet
+
+class TestPatternTrack(_PacedTrack):
+    """Synthetic test pattern (colour bars with a moving bar) at a configurable size and frame rate, generated once."""
+    def __init__(self, size=(640, 480), fps=30, frames=60):
+        super().__init__(fps)
+        width, height = size
+        self._frames = []
+        bars = np.repeat(np.linspace(16, 235, 8, dtype=np.uint8), width // 8 + 1)[:width]
+        for i in range(frames):
+            y = np.tile(bars, (height, 1))
+            x = i * width // frames
+            y[:, x:x + width // 32] = 235
+            yuv = np.vstack([y, np.full((height // 2, width), 128, np.uint8)])
+            self._frames.append(VideoFrame.from_ndarray(yuv, format="yuv420p"))
+
+    async def recv(self):
+        pts = await self._next_pts()
+        frame = self._frames[(self._index - 1) % len(self._frames)]
+        frame.pts = pts
+        frame.time_base = VIDEO_TIME_BASE
+        return frame
+
+def prefer_h264(peer_connection, sender):
+    """Restrict the sender's transceiver to H264, required for encoded passthrough."""
+    from aiortc import RTCRtpSender
+    codecs = [c for c in RTCRtpSender.getCapabilities("video").codecs if c.mimeType in ("video/H264", "video/rtx")]
+    for transceiver in peer_connection.getTransceivers():
+        if transceiver.sender is sender:
+            transceiver.setCodecPreferences(codecs)
+
+def create_placeholder_track(mode, video_file, size=(640, 480), fps=30):
+    # mode: "passthrough" loops the file's encoded packets, "pattern" generates a test pattern
+    if mode == "passthrough":
+        return EncodedPlaceholderTrack(video_file)
+    if mode == "pattern":
+        return TestPatternTrack(size, fps)
+    raise ValueError(f"Unknown placeholder mode: {mode}")
@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_WINDOW = 30 # Seconds a profiling run lasts unless given
+PROFILE_DIR = "profiles" # Results are written here as profile-<time>.json (+ .folded with the sampling profiler)
+LAG_PROBE_INTERVAL = 0.01 # Seconds between event loop lag probes
+SAMPLE_INTERVAL = 0.005 # Seconds between stack samples of the sampling profiler
+SUB_BUCKET_BITS = 5 # Histogram precision: 2**5 buckets per power of two, values kept to within ~3%
+PERCENTILES = (50, 90, 99, 99.9)
+
+class Histogram:
+    """
+    Log-linear histogram of durations (as HdrHistogram): SUB_BUCKET_BITS linear buckets per power of two
+    microseconds, so any range is kept at the same relative precision in a few hundred counters.
+    """
+    def __init__(self):
+        self.counts = {} # Bucket lower bound in µs -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = max(0, int(seconds * 1_000_000))
+        shift = max(0, us.bit_length() - SUB_BUCKET_BITS - 1)
+        bucket = us >> shift << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile, in ms
+        target = percent / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                width = 1 << max(0, bucket.bit_length() - SUB_BUCKET_BITS - 1)
+                return min((bucket + width) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        summary = {"count": self.count, "min_ms": self.min * 1000, "mean_ms": self.total / self.count * 1000, "max_ms": self.max * 1000}
+        for percent in PERCENTILES:
+            summary[f"p{percent:g}_ms"] = self.percentile(percent)
+        summary["buckets_us"] = {bucket: self.counts[bucket] for bucket in sorted(self.counts)}
+        return summary
+
+class StackSampler:
+    """
+    Sampling profiler: a thread that records the stack of every other thread each SAMPLE_INTERVAL.
+    Stacks are counted in the folded format of flamegraph.pl / speedscope, rooted at the thread name.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def top(self, count=20):
+        """Functions on top of the most samples, as (function, share of samples)."""
+        leaves = {}
+        for stack, samples in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + samples
+        total = sum(leaves.values()) or 1
+        return [(leaf, samples / total) for leaf, samples in sorted(leaves.items(), key=lambda item: -item[1])[:count]]
+
+class Profiler:
+    """
+    On-demand profiling mode. While enabled it probes the event loop lag, instrumented stages record
+    their durations into histograms and optionally a sampling profiler runs. A run ends after its
+    window (or stop()) and is written to PROFILE_DIR. Disabled, instrumented code pays one attribute
+    check (`if profiler.enabled:`).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.directory = PROFILE_DIR
+        self.last_result = None
+        self.last_path = None
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._started = None
+        self._sampler = None
+        self._tasks = []
+
+    def record(self, stage, seconds):
+        # Callers check enabled first, so the disabled path doesn't even compute the duration
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.record(seconds)
+
+    def timed(self, stage):
+        """Decorator recording the duration of each call (of a function or coroutine function) while enabled."""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    start = time.monotonic()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.record(stage, time.monotonic() - start)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    start = time.monotonic()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self.record(stage, time.monotonic() - start)
+            return wrapper
+        return decorator
+
+    def start(self, window=PROFILE_WINDOW, sample=False):
+        """Start a profiling run of window seconds, from the event loop."""
+        if self.enabled:
+            logger.info("Profiling already running")
+            return
+        with self._lock:
+            self._histograms = {}
+        self._started = time.time()
+        self._sampler = StackSampler() if sample else None
+        if self._sampler is not None:
+            self._sampler.start()
+        self.enabled = True
+        self._tasks = [asyncio.ensure_future(self._probe_lag()), asyncio.ensure_future(self._stop_after(window))]
+        logger.info("Profiling for %s s%s", window, " with the sampling profiler" if sample else "")
+
+    def toggle(self, sample=False):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start(sample=sample)
+
+    def stop(self):
+        """End the run and write its results, returns their path (without extension)."""
+        if not self.enabled:
+            return None
+        self.enabled = False
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+        sampler, self._sampler = self._sampler, None
+        if sampler is not None:
+            sampler.stop()
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        result = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self._started)),
+            "duration_s": time.time() - self._started,
+            "stages": {stage: histogram.summary() for stage, histogram in sorted(histograms.items())},
+        }
+        if sampler is not None:
+            result["sampling"] = {"interval_ms": sampler.interval * 1000, "samples": sampler.samples, "top": sampler.top()}
+        self.last_result = result
+        self.last_path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self._started)))
+        # Written off the event loop, the thread isn't a daemon so a run stopped on shutdown is still written
+        threading.Thread(target=self._write, args=(self.last_path, result, sampler), name="profile-writer").start()
+        logger.info("Profiling stopped, p99 ms: %s", {stage: summary.get("p99_ms") for stage, summary in result["stages"].items()})
+        return self.last_path
+
+    def _write(self, path, result, sampler):
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path + ".json", "w") as f:
+                json.dump(result, f, indent=2)
+            if sampler is not None:
+                with open(path + ".folded", "w") as f:
+                    for stack, samples in sorted(sampler.stacks.items()):
+                        f.write(f"{stack} {samples}\n")
+            logger.info("Profile written to %s.json", path)
+        except OSError as e:
+            logger.error("Error writing profile: %s", e)
+
+    async def _probe_lag(self):
+        loop = asyncio.get_running_loop()
+        while self.enabled:
+            expected = loop.time() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self.record("event_loop_lag", max(0.0, loop.time() - expected))
+
+    async def _stop_after(self, window):
+        await asyncio.sleep(window)
+        self.stop()
+
+# Shared instance
+profiler = Profiler()
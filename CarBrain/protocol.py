@@ -0,0 +1,116 @@
+import math
+import struct
+from collections import namedtuple
+
+# Binary packet sent on the controllerInput data channel (little-endian, 22 bytes):
+# version u8 | type u8 | sequence u32 | sender timestamp f64 (ms since epoch) | throttle, sterring, pan, tilt int16
+# Axes are quantised from -1..1 to -32767..32767. Keep in sync with WebControlCenter/protocol.js
+PACKET_VERSION = 1
+PACKET_CONTROL = 1
+PACKET_PING = 2
+PACKET_FRAME_REPORT = 3
+PACKET_STRUCT = struct.Struct("<BBIdhhhh")
+# Frame display report (browser -> car, 22 bytes), used for glass-to-glass latency:
+# version u8 | type u8 | RTP timestamp u32 | receive time f64 | display time f64 (ms since epoch, converted to the car's clock)
+FRAME_REPORT_STRUCT = struct.Struct("<BBIdd")
+# Telemetry snapshot (car -> browser) on the telemetry data channel:
+# version u8 | type u8 | sequence u32 | car timestamp f64 (ms since epoch) | one f32 per telemetry.METRICS entry, in that order
+# Counters are sent as per-second rates, unavailable values as NaN
+PACKET_TELEMETRY = 4
+# Profiling command (browser -> car), text: "profile <seconds> [sample]" starts a run, "profile stop" ends it (see profiling.py)
+PACKET_PROFILE = 5
+TELEMETRY_HEADER_STRUCT = struct.Struct("<BBId")
+AXIS_SCALE = 32767
+SEQUENCE_MODULO = 1 << 32
+
+ControlPacket = namedtuple("ControlPacket", "type seq timestamp throttle sterring pan tilt")
+FrameReport = namedtuple("FrameReport", "type rtp_timestamp receive_time display_time")
+TelemetrySnapshot = namedtuple("TelemetrySnapshot", "seq timestamp values")
+ProfileCommand = namedtuple("ProfileCommand", "type window sample")
+
+def encode_packet(packet_type, seq, timestamp, throttle=0.0, sterring=0.0, pan=0.0, tilt=0.0):
+    return PACKET_STRUCT.pack(
+        PACKET_VERSION, packet_type, seq % SEQUENCE_MODULO, timestamp,
+        round(throttle * AXIS_SCALE), round(sterring * AXIS_SCALE), round(pan * AXIS_SCALE), round(tilt * AXIS_SCALE)
+    )
+
+def encode_telemetry(seq, timestamp, values):
+    return TELEMETRY_HEADER_STRUCT.pack(PACKET_VERSION, PACKET_TELEMETRY, seq % SEQUENCE_MODULO, timestamp) \
+        + struct.pack(f"<{len(values)}f", *(float("nan") if v is None else v for v in values))
+
+def decode_telemetry(message):
+    """TelemetrySnapshot from a telemetry message (values as a tuple of floats), or None if it is malformed."""
+    size = len(message) - TELEMETRY_HEADER_STRUCT.size
+    if size < 0 or size % 4 or message[0] != PACKET_VERSION or message[1] != PACKET_TELEMETRY:
+        return None
+    _, _, seq, timestamp = TELEMETRY_HEADER_STRUCT.unpack_from(message)
+    return TelemetrySnapshot(seq, timestamp, struct.unpack_from(f"<{size // 4}f", message, TELEMETRY_HEADER_STRUCT.size))
+
+def _control_packet(seq, timestamp, throttle, sterring, pan, tilt):
+    # None (malformed) unless every axis is a number in -1..1, pan and tilt may be absent
+    for value in (throttle, sterring, pan, tilt):
+        if value is not None and not (math.isfinite(value) and -1 <= value <= 1):
+            return None
+    return ControlPacket(PACKET_CONTROL, seq, timestamp, throttle, sterring, pan, tilt)
+
+def decode_packet(message):
+    """
+    Decode a data channel message into a ControlPacket or FrameReport, or None if it is malformed
+    (control axes outside -1..1 or not finite included).
+    Binary messages use the struct formats above; text messages are the legacy CSV format
+    (throttle,sterring[,pan,tilt]) or a ping timestamp, and carry no sequence number, or a ProfileCommand
+    (window 0 to stop).
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        if len(message) != PACKET_STRUCT.size or message[0] != PACKET_VERSION:
+            return None
+        if message[1] == PACKET_FRAME_REPORT:
+            _, packet_type, rtp_timestamp, receive_time, display_time = FRAME_REPORT_STRUCT.unpack(message)
+            return FrameReport(packet_type, rtp_timestamp, receive_time, display_time)
+        _, packet_type, seq, timestamp, throttle, sterring, pan, tilt = PACKET_STRUCT.unpack(message)
+        if packet_type == PACKET_CONTROL:
+            return _control_packet(seq, timestamp, throttle / AXIS_SCALE, sterring / AXIS_SCALE, pan / AXIS_SCALE, tilt / AXIS_SCALE)
+        return ControlPacket(packet_type, seq, timestamp,
+                             throttle / AXIS_SCALE, sterring / AXIS_SCALE, pan / AXIS_SCALE, tilt / AXIS_SCALE)
+
+    if message.startswith("profile"):
+        parts = message.split()
+        try:
+            if len(parts) >= 2 and parts[1] == "stop":
+                return ProfileCommand(PACKET_PROFILE, 0, False)
+            return ProfileCommand(PACKET_PROFILE, float(parts[1]) if len(parts) >= 2 else None, "sample" in parts[2:])
+        except ValueError:
+            return None
+
+    # Legacy CSV format, kept while browsers migrate to the binary format
+    try:
+        if "," not in message:
+            return ControlPacket(PACKET_PING, None, float(message), 0.0, 0.0, 0.0, 0.0)
+        parts = message.split(",")
+        if len(parts) == 2:
+            throttle, sterring = parts
+            return _control_packet(None, None, float(throttle), float(sterring), None, None)
+        if len(parts) == 4:
+            throttle, sterring, pan, tilt = parts
+            return _control_packet(None, None, float(throttle), float(sterring), float(pan), float(tilt))
+    except ValueError:
+        pass
+    return None
+
+class SequenceFilter:
+    """Drops stale and out-of-order packets using wrapping (serial number) comparison of sequence numbers."""
+    def __init__(self):
+        self.last_seq = None
+        self.dropped = 0
+
+    def accept(self, seq):
+        # Legacy CSV packets have no sequence number
+        if seq is None:
+            return True
+        if self.last_seq is not None:
+            delta = (seq - self.last_seq) % SEQUENCE_MODULO
+            if delta == 0 or delta >= SEQUENCE_MODULO // 2:
+                self.dropped += 1
+                return False
+        self.last_seq = seq
+        return True
@@ -0,0 +1,37 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# aiortc keeps some RTCRtpSender state private (name-mangled attributes), which the ABR (its encoder), the
+# latency timeline (last RTP timestamp, packet count) and the fanout (keyframe requests) read. They are the
+# attributes of the aiortc version pinned in requirements.txt, all set in RTCRtpSender.__init__. If an upgrade
+# renames one, the feature using it degrades with one warning instead of raising in the media path.
+ENCODER = "_RTCRtpSender__encoder"
+RTP_TIMESTAMP = "_RTCRtpSender__rtp_timestamp"
+PACKET_COUNT = "_RTCRtpSender__packet_count"
+FORCE_KEYFRAME = "_RTCRtpSender__force_keyframe"
+
+_missing = set()
+
+def _warn_missing(name):
+    if name not in _missing:
+        _missing.add(name)
+        logger.warning("RTCRtpSender has no %s (not the pinned aiortc version?), the features using it are off", name)
+
+def get_private(sender, name, default=None):
+    """A private attribute of an RTCRtpSender, default if there is no sender or it lacks the attribute."""
+    if sender is None:
+        return default
+    try:
+        return getattr(sender, name)
+    except AttributeError:
+        _warn_missing(name)
+        return default
+
+def set_private(sender, name, value):
+    if sender is None:
+        return
+    if not hasattr(sender, name):
+        _warn_missing(name)
+        return
+    setattr(sender, name, value)
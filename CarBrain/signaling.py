@@ -0,0 +1,311 @@
+import time
+import json
+import asyncio
+import logging
+import socketio
+
+from startup import profile
+from actuation import ControlInput
+from adaptive import AdaptiveVideoController
+from dashcam import dashcam
+from profiling import profiler, PROFILE_WINDOW
+from protocol import decode_packet, PACKET_CONTROL, PACKET_PING, PACKET_FRAME_REPORT, PACKET_PROFILE
+from connection import PrewarmedPeerConnection, SetupTimeline, StallDetector, decode_description, encode_description, parse_candidate
+from peers import PeerManager
+# aiortc and PyAV (fanout, placeholder) are imported on first use, see the entry points' start_video
+
+STUN_SERVER = "stun:fr-turn1.xirsys.com"
+
+logger = logging.getLogger(__name__)
+
+class CarSignaling:
+    """
+    The car's side of the signaling session, shared by main.py and main_with_placeholder_video.py, which only
+    differ in the video source they attach: answers each peer's offer with a prewarmed peer connection to the
+    shared encoded video, applies the driver's input from its data channel, asks peers on a stalled connection
+    to reconnect and adapts the video to the driver's link.
+    """
+    def __init__(self, car_id, actuation, telemetry, max_viewers):
+        self.car_id = car_id
+        self.actuation = actuation
+        self.telemetry = telemetry
+        self.max_viewers = max_viewers
+        self.capture_worker = None
+        self.encoder = None
+        self.prewarmed = None
+        self.peers = None
+        self.abr_controller = None
+        self.video_ready = None # Task completing once the video pipeline and the first prewarmed peer connection are set up
+        self.setup_timeline = None # Of the driver's latest connection
+        self.restart_pending = set() # Peers to ask to reconnect once the signaling connection is back
+
+        self.sio = socketio.AsyncClient()
+        self.sio.on('connect', self.handle_connect)
+        self.sio.on('disconnect', self.handle_disconnect)
+        self.sio.on('role', self.handle_role)
+        self.sio.on('peer_left', self.handle_peer_left)
+        self.sio.on('offer', self.handle_offer)
+        self.sio.on('ice_candidate', self.handle_icecandidate)
+
+    def prepare_video(self, setup):
+        """Run setup (the entry point's video source, ending in attach_video) while connecting, offers wait for it."""
+        self.video_ready = asyncio.ensure_future(setup)
+
+    async def attach_video(self, source, capture_worker=None, timeline=None, lores_size=None):
+        """Encode source once for all peers and build the first peer connection, ready for the first offer."""
+        from fanout import SharedEncoder
+        self.capture_worker = capture_worker
+        self.encoder = SharedEncoder(source, lores_size=lores_size)
+        dashcam.keyframe_callback = self.encoder.request_keyframe
+
+        self.prewarmed = PrewarmedPeerConnection(self._build_peer_connection)
+        self.prewarmed.prepare()
+        self.peers = PeerManager(self.prewarmed, self.encoder, timeline, max_viewers=self.max_viewers)
+        await self.prewarmed.ready()
+        profile.mark("video_ready")
+
+    async def connect(self, url, token):
+        await self.sio.connect(f"{url}/?token={token}&car_id={self.car_id}&role=car")
+
+    async def close(self):
+        if self.video_ready is not None and not self.video_ready.done():
+            self.video_ready.cancel()
+        if self.abr_controller is not None:
+            self.abr_controller.stop()
+        try:
+            await self.sio.disconnect()
+        except asyncio.CancelledError:
+            # Cancelling sio.wait() cancelled the read loop that disconnect() waits for, the rest must still run
+            pass
+        logger.info("Disconnected from signaling server")
+        if self.peers is not None:
+            await self.peers.close()
+            logger.info("Closed peer connections: %s", self.peers.stats())
+        if self.prewarmed is not None:
+            await self.prewarmed.close()
+        if self.encoder is not None:
+            self.encoder.stop()
+
+    # New peer connection with its own view of the shared encoded video, ICE candidates gathered before any offer arrives
+    async def _build_peer_connection(self):
+        from aiortc import RTCPeerConnection, RTCConfiguration, RTCIceServer
+        from placeholder import prefer_h264
+        peer_connection = RTCPeerConnection(configuration=RTCConfiguration([RTCIceServer(STUN_SERVER)]))
+
+        # Add video track, captured and encoded once for all peers
+        video_sender = peer_connection.addTrack(self.encoder.subscribe())
+        prefer_h264(peer_connection, video_sender)
+
+        # Browsers put the video m-line first, so with BUNDLE this transport ends up carrying the whole session
+        await video_sender.transport.transport.iceGatherer.gather()
+        return peer_connection, video_sender
+
+    # Adapt bitrate, resolution (or simulcast layer) and frame rate to the driver's link, restarted whenever the driver
+    # or its connection changes. Viewers only pick their simulcast layer
+    def restart_abr(self):
+        if self.abr_controller is not None:
+            self.abr_controller.stop()
+            self.abr_controller = None
+        if self.peers is None:
+            return
+        self.peers.adapt_layers(include_driver=False)
+        driver = self.peers.driver
+        if driver is not None and driver.video_sender is not None and driver.stall_detector is not None:
+            self.abr_controller = AdaptiveVideoController(driver.video_sender, self.capture_worker, encoder=self.encoder, track=driver.video_sender.track)
+            self.abr_controller.start()
+
+    # Ask a peer to reconnect, once the signaling connection is back if it dropped as well
+    async def request_restart(self, peer_id):
+        if self.sio.connected:
+            try:
+                await self.sio.emit('restart', (None, peer_id))
+                logger.info("Requested reconnect from peer %s", peer_id)
+                return
+            except Exception as e:
+                logger.error("Error requesting reconnect: %s", e)
+        self.restart_pending.add(peer_id)
+
+    def on_stall(self, detector):
+        peer = next((peer for peer in self.peers.peers.values() if peer.stall_detector is detector), None)
+        if peer is None:
+            return
+        peer.stall_detector = None
+        peer.stalled_at = detector.stalled_at
+        asyncio.ensure_future(self.request_restart(peer.peer_id))
+
+    async def handle_connect(self):
+        logger.info("Connected to the signaling server")
+        for peer_id in list(self.restart_pending):
+            self.restart_pending.discard(peer_id)
+            await self.request_restart(peer_id)
+
+    async def handle_disconnect(self):
+        logger.info("Disconnected from the server")
+        if self.peers is not None:
+            await self.peers.close()
+        self.restart_abr()
+
+    # The driver role moved (peer_id, role), see the signaling server's request_driver and release_driver
+    @profiler.timed("signaling_role")
+    async def handle_role(self, peer_id, role):
+        await self.video_ready
+        self.peers.set_role(peer_id, role)
+        self.restart_abr()
+
+    @profiler.timed("signaling_peer_left")
+    async def handle_peer_left(self, peer_id):
+        await self.video_ready
+        await self.peers.remove(peer_id)
+        self.restart_abr()
+
+    @profiler.timed("signaling_offer")
+    async def handle_offer(self, offer_json, peer_id=None, role="driver"):
+        from aiortc import RTCSessionDescription
+        sio = self.sio
+        # An offer can arrive (e.g. queued by the server) before the video is set up
+        await self.video_ready
+        peers = self.peers
+        reason = peers.admission(peer_id, role)
+        if reason is not None:
+            peers.refused += 1
+            logger.warning("Refused %s %s: %s", role, peer_id, reason)
+            await sio.emit('refused', (reason, peer_id))
+            return
+
+        peer = peers.join(peer_id, role)
+        # Candidates for this offer can arrive while it is being handled, hold them from here on
+        peer.candidates.reset()
+        setup = peer.setup = SetupTimeline(peer.stalled_at)
+        peer.stalled_at = None
+        if peer.is_driver:
+            self.setup_timeline = setup
+        try:
+            logger.info("Received offer from %s %s", role, peer_id)
+            setup.mark("offer_received")
+
+            # Take the prewarmed peer connection
+            await peers.connect(peer)
+            if peer.is_driver:
+                self.restart_abr()
+            peer_connection = peer.peer_connection
+            peer.video_sender.track.once("frame", lambda: setup.mark("first_frame"))
+            detector = StallDetector(peer_connection, self.on_stall)
+
+            # Compact (deflated, candidates in the SDP) or trickle mode, the answer goes back the same way
+            offer, compact = decode_description(offer_json)
+
+            @peer_connection.on("iceconnectionstatechange")
+            def on_iceconnectionstatechange():
+                if peer_connection.iceConnectionState == "completed":
+                    setup.mark("ice_connected")
+
+            # Send candidate to the peer over signaling channel
+            @peer_connection.on("ice_candidate")
+            async def on_icecandidate(candidate):
+                await sio.emit('ice_candidate', (json.dumps({
+                    "candidate": candidate.candidate,
+                    "sdpMid": candidate.sdpMid,
+                    "sdpMLineIndex": candidate.sdpMLineIndex
+                }), peer_id))
+
+            # Handle Data Channel
+            @peer_connection.on("datachannel")
+            def on_data_channel(channel):
+                # Car to peer only, snapshots are sent by the telemetry task
+                if channel.label == "telemetry":
+                    self.telemetry.add_channel(channel)
+                    return
+                control = ControlInput(self.actuation)
+
+                @channel.on("message")
+                @profiler.timed("data_channel_message")
+                def on_message(message):
+                    # Received controller input from Peer A | Binary packet (see protocol.py) or legacy CSV: throttle,sterring,pan,tilt (-1 to 1)
+                    detector.touch()
+                    # Raw, for replays of the session (Benchmark/replay.py)
+                    if peer.is_driver:
+                        dashcam.record_message(message)
+                    packet = decode_packet(message)
+                    if packet is None:
+                        logger.warning("Dropped malformed message: %r", message)
+                        return
+
+                    if packet.type == PACKET_CONTROL:
+                        # Only the driver steers and moves the camera, viewers' input is ignored
+                        if not peer.is_driver:
+                            peer.rejected_controls += 1
+                            return
+                        if control.apply(packet):
+                            setup.mark("first_control")
+
+                    # Send timestamp to Peer A
+                    elif packet.type == PACKET_PING:
+                        channel.send(str(int(time.time() * 1000)))
+                        logger.debug("Recieved ping %s and sent timestamp to Peer A", packet.timestamp)
+
+                    # Profiling run requested by the driver, results are written on the car (see profiling.py)
+                    elif packet.type == PACKET_PROFILE:
+                        if not peer.is_driver:
+                            return
+                        if packet.window == 0:
+                            profiler.stop()
+                        else:
+                            profiler.start(packet.window or PROFILE_WINDOW, packet.sample)
+
+                    # Frame displayed by Peer A, for glass-to-glass latency
+                    elif packet.type == PACKET_FRAME_REPORT:
+                        if peer.is_driver and peers.timeline is not None:
+                            peers.timeline.on_report(packet.rtp_timestamp, packet.receive_time, packet.display_time)
+
+                @channel.on("open")
+                def on_open():
+                    logger.info("dataChannel opened")
+
+                @channel.on("close")
+                def on_close():
+                    logger.info("dataChannel closed")
+
+            # Set remote description from Peer A
+            try:
+                await peer_connection.setRemoteDescription(RTCSessionDescription(sdp=offer["sdp"], type=offer["type"]))
+                setup.mark("remote_description_set")
+                await peer.candidates.flush(peer_connection)
+            except Exception as e:
+                logger.error("Error setting remote description: %s", e)
+
+            # Create and set local answer
+            try:
+                local_answer = await peer_connection.createAnswer()
+                await peer_connection.setLocalDescription(local_answer)
+            except Exception as e:
+                logger.error("Error creating or setting local answer: %s", e)
+
+            # aiortc gathers all candidates before setLocalDescription returns, so the answer always carries them
+            await sio.emit('answer', (encode_description(peer_connection.localDescription, compact), peer_id))
+            setup.mark("answer_sent")
+
+            # Watch for a stalled connection (network change), the peer is then asked to reconnect
+            peer.stall_detector = detector
+            detector.start()
+            if peer.is_driver:
+                self.restart_abr()
+            else:
+                # Each viewer's simulcast layer follows its own link
+                peers.adapt_layers(include_driver=False)
+        except Exception as e:
+            logger.error("Error handling offer: %s", e)
+
+    # Handle ICE candidate messages
+    @profiler.timed("signaling_ice_candidate")
+    async def handle_icecandidate(self, data, peer_id=None, role="driver"):
+        try:
+            await self.video_ready
+            logger.debug("Received ICE candidate from %s %s: %s", role, peer_id, data)
+            peer = self.peers.get(peer_id)
+            if peer is None:
+                return
+            # Trickle mode, or candidates the browser found after sending a compact offer
+            await peer.candidates.add(parse_candidate(data))
+            logger.debug("Added ICE candidate")
+        except Exception as e:
+            logger.error("Error handling ICE candidate: %s", e)
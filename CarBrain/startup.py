@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def _process_start():
+    # Process start in the time.monotonic() domain, from /proc (Linux) when available
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        since_boot = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / CLOCK_TICKS
+        return time.monotonic() - since_boot
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def _boot_time():
+    # Kernel boot in the time.monotonic() domain, so the profile shows boot-to-ready after a reboot
+    if hasattr(time, "CLOCK_BOOTTIME"):
+        return time.monotonic() - time.clock_gettime(time.CLOCK_BOOTTIME)
+    return None
+
+class StartupProfile:
+    """
+    Timestamped startup phases, from process start to the car being ready to drive.
+    Phases can be marked from any thread. Reported once with report(): logged, and written as
+    JSON if a path is given.
+    """
+    def __init__(self):
+        self.process_start = _process_start()
+        self.start = self.process_start if self.process_start is not None else time.monotonic()
+        self.boot = _boot_time()
+        self.marks = {}
+
+    def mark(self, phase):
+        if phase not in self.marks:
+            self.marks[phase] = time.monotonic()
+            logger.debug("Startup phase %s at +%.0f ms", phase, (self.marks[phase] - self.start) * 1000)
+
+    def durations(self):
+        """{phase: ms since process start} in the order reached."""
+        return {phase: round((t - self.start) * 1000, 1) for phase, t in sorted(self.marks.items(), key=lambda item: item[1])}
+
+    def report(self, path=None):
+        durations = self.durations()
+        since_boot = (self.start - self.boot) if self.boot is not None else None
+        logger.info("Startup profile (ms since process start%s): %s",
+                    f", which was {since_boot:.1f} s after boot" if since_boot is not None else "", durations)
+        if path:
+            try:
+                with open(path, "w") as f:
+                    json.dump({"process_start_after_boot_s": since_boot, "phases_ms": durations}, f, indent=2)
+            except OSError as e:
+                logger.error("Error writing startup profile: %s", e)
+
+profile = StartupProfile()
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from protocol import encode_telemetry
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_RATE_HZ = 5 # Snapshots per second on the telemetry data channel
+LAG_WINDOW = 10 # Seconds over which the largest event loop lag is kept
+HTTP_TIMEOUT = 5 # Seconds a metrics client may take to send its request
+METRICS_PREFIX = "carbrain_"
+THERMAL_ZONE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled" # Raspberry Pi kernels only
+GAUGE = "gauge"
+COUNTER = "counter"
+
+# Name, type and help of every metric. Also the field order of the binary snapshot (see protocol.py),
+# keep in sync with WebControlCenter/protocol.js
+METRICS = (
+    ("cpu_temperature_celsius", GAUGE, "SoC temperature"),
+    ("throttled_flags", GAUGE, "Firmware throttling flags, as vcgencmd get_throttled"),
+    ("load_per_core", GAUGE, "1 minute load average per CPU core"),
+    ("process_cpu_seconds", COUNTER, "CPU time used by CarBrain"),
+    ("event_loop_lag_seconds", GAUGE, "How late the telemetry task last woke up"),
+    ("event_loop_lag_max_seconds", GAUGE, f"Largest event loop lag over the last {LAG_WINDOW} s"),
+    ("capture_frames", COUNTER, "Frames captured by the camera"),
+    ("video_frames", COUNTER, "Frames fed to the shared video encoder"),
+    ("video_bytes", COUNTER, "Encoded video bytes"),
+    ("video_target_bitrate_bps", GAUGE, "Target bitrate of the video encoder"),
+    ("control_inputs", COUNTER, "Control inputs applied by the actuation loop"),
+    ("command_age_seconds", GAUGE, "Time since a control input was last applied"),
+    ("failsafe_fired", COUNTER, "No-input failsafes fired"),
+    ("peers", GAUGE, "Connected peers, driver and viewers"),
+    ("control_latency_seconds", GAUGE, "99th percentile of the WebRTC to control process command latency (control process only)"),
+    ("watchdog_trips", COUNTER, "Times the control process stopped the car as the WebRTC process hung"),
+)
+METRIC_NAMES = {name for name, _, _ in METRICS}
+
+def _read_sys(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cpu_temperature():
+    value = _read_sys(THERMAL_ZONE_PATH)
+    return int(value) / 1000 if value is not None else None
+
+def _throttled():
+    value = _read_sys(THROTTLED_PATH)
+    return int(value, 16) if value is not None else None
+
+def _load_per_core():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+class Telemetry:
+    """
+    Car metrics for the driver (telemetry data channel) and bench rigs (Prometheus endpoint).
+    Nothing is collected on the hot paths: sources are callables reading counters the components keep
+    anyway, evaluated only when a snapshot is taken. The streaming task sends one snapshot to every open
+    channel per period, and measures the event loop lag from its own wakeups.
+    """
+    def __init__(self, rate_hz=TELEMETRY_RATE_HZ):
+        self.period = 1.0 / rate_hz
+        self.channels = set()
+        self.loop_lag = None
+        self._lags = deque(maxlen=max(1, round(LAG_WINDOW * rate_hz)))
+        self._sources = {
+            "cpu_temperature_celsius": _cpu_temperature,
+            "throttled_flags": _throttled,
+            "load_per_core": _load_per_core,
+            "process_cpu_seconds": time.process_time,
+            "event_loop_lag_seconds": lambda: self.loop_lag,
+            "event_loop_lag_max_seconds": lambda: max(self._lags, default=None),
+        }
+        self._previous = None # (time, values) of the last snapshot sent, counters are sent as rates since then
+        self._seq = 0
+        self._task = None
+        self._server = None
+        self.snapshots_sent = 0
+
+    def source(self, name, getter):
+        if name not in METRIC_NAMES:
+            raise ValueError(f"Unknown metric {name}")
+        self._sources[name] = getter
+
+    def add_channel(self, channel):
+        self.channels.add(channel)
+        channel.on("close", lambda: self.channels.discard(channel))
+
+    def snapshot(self):
+        """{metric name: current value, None if unavailable}"""
+        values = {}
+        for name, _, _ in METRICS:
+            getter = self._sources.get(name)
+            try:
+                values[name] = getter() if getter is not None else None
+            except Exception:
+                # The component isn't set up (yet), e.g. no camera or no control input so far
+                values[name] = None
+        return values
+
+    def encode(self, now, values):
+        previous, self._previous = self._previous, (now, values)
+        fields = []
+        for name, kind, _ in METRICS:
+            value = values[name]
+            if kind == COUNTER:
+                before = previous[1][name] if previous is not None else None
+                if value is None or before is None or now <= previous[0]:
+                    value = None
+                else:
+                    value = (value - before) / (now - previous[0])
+            fields.append(value)
+        self._seq += 1
+        return encode_telemetry(self._seq, time.time() * 1000, fields)
+
+    def exposition(self):
+        """The current values in the Prometheus text format."""
+        values = self.snapshot()
+        lines = []
+        for name, kind, description in METRICS:
+            metric = METRICS_PREFIX + name + ("_total" if kind == COUNTER else "")
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            if values[name] is not None:
+                lines.append(f"{metric} {values[name]}")
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def serve(self, host, port):
+        """Serve the metrics on http://host:port/metrics for Prometheus to scrape."""
+        self._server = await asyncio.start_server(self._handle_http, host, port)
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _run(self):
+        next_tick = time.monotonic() + self.period
+        while True:
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            now = time.monotonic()
+            self.loop_lag = max(0.0, now - next_tick)
+            self._lags.append(self.loop_lag)
+            next_tick += self.period
+            if next_tick < now:
+                # Fell behind (blocked event loop), don't send a burst of snapshots
+                next_tick = now + self.period
+
+            channels = [channel for channel in self.channels if channel.readyState == "open"]
+            if not channels:
+                self._previous = None
+                continue
+            message = self.encode(now, self.snapshot())
+            for channel in channels:
+                channel.send(message)
+            self.snapshots_sent += 1
+
+    async def _handle_http(self, reader, writer):
+        # Just enough HTTP/1.1 for a scraper: GET /metrics, one request per connection
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_TIMEOUT)
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.exposition().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+            logger.debug("Bad metrics request: %s", e)
+        finally:
+            writer.close()
@@ -0,0 +1,51 @@
+# Malformed control messages must be dropped, not raise out of on_message (which closes the peer connection).
+# Usage: python -m pytest test_control_input.py, or python -m unittest test_control_input (from CarBrain)
+
+import unittest
+
+from actuation import ControlInput
+from log import flight_recorder
+from protocol import decode_packet, encode_packet, ControlPacket, PACKET_CONTROL
+
+class RecordingActuation:
+    """Stands in for the ActuationLoop, keeps what was submitted."""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, throttle, sterring, pan=None, tilt=None, timestamp=None):
+        self.submitted.append((throttle, sterring, pan, tilt))
+
+class ControlInputTest(unittest.TestCase):
+    def setUp(self):
+        self.actuation = RecordingActuation()
+        self.control = ControlInput(self.actuation)
+
+    def deliver(self, message):
+        # What on_message does: malformed messages are dropped before ControlInput
+        packet = decode_packet(message)
+        return packet is not None and self.control.apply(packet)
+
+    def test_out_of_range_csv_is_dropped(self):
+        self.assertIsNone(decode_packet("5,0,0,0"))
+        self.assertFalse(self.deliver("5,0,0,0"))
+        self.assertEqual(self.actuation.submitted, [])
+
+    def test_nan_csv_is_dropped(self):
+        self.assertIsNone(decode_packet("nan,0,0,0"))
+        self.assertIsNone(decode_packet("0,inf"))
+        self.assertFalse(self.deliver("nan,0,0,0"))
+        self.assertEqual(self.actuation.submitted, [])
+
+    def test_valid_messages_still_apply(self):
+        self.assertTrue(self.deliver("0.5,-0.25,0,0"))
+        self.assertTrue(self.deliver(encode_packet(PACKET_CONTROL, 1, 0.0, 1.0, -1.0)))
+        self.assertEqual(len(self.actuation.submitted), 2)
+
+    def test_bad_axes_past_the_decoder_do_not_raise(self):
+        # Packets built elsewhere (replays, future formats) are clamped by the flight recorder instead
+        for value in (5.0, -5.0, float("nan"), float("inf")):
+            self.assertTrue(self.control.apply(ControlPacket(PACKET_CONTROL, None, None, value, 0.0, value, None)))
+        flight_recorder.record_control(float("nan"), 7.0, None, -7.0)
+
+if __name__ == "__main__":
+    unittest.main()
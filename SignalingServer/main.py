@@ -1,49 +1,271 @@
-from flask import Flask, request, render_template, render_template_string
-from flask_socketio import SocketIO
+import importlib.util
+import os
+
+# Serving mode (Flask-SocketIO async_mode): gevent serves hundreds of cars and browsers on one thread and
+# has to patch the standard library before anything else is imported. threading (a thread per client on
+# Werkzeug) is the fallback when gevent isn't installed
+ASYNC_MODE = os.environ.get("SIGNALING_ASYNC_MODE")
+if ASYNC_MODE is None:
+    ASYNC_MODE = "gevent" if importlib.util.find_spec("gevent") else "threading"
+if ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+import resource
+import threading
+import time
+from collections import deque
+
+from flask import Flask, request, render_template, render_template_string, jsonify
+from flask_socketio import SocketIO, join_room, leave_room
 from flask_cors import CORS
 
 from config import SIGNALING_SERVER_TOKEN
 
 PORT = 8080
+DEFAULT_CAR_ID = "default" # Session for clients that don't send a car_id
+ROLES = ("car", "driver", "viewer")
+# Events relayed from the car to one of its peers, and from a peer (driver or viewer) to the car
+CAR_EVENTS = ("answer", "ice_candidate", "restart", "refused")
+PEER_EVENTS = ("offer", "ice_candidate")
+SETUP_TIMES_KEPT = 100
 
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins='*')
+socketio = SocketIO(app, cors_allowed_origins='*', async_mode=ASYNC_MODE)
+
+class Session:
+    """
+    Signaling state of one car: a room with at most one car and one driver, plus any number of viewers
+    (the car decides how many it admits). Only the driver's control input is applied by the car.
+    """
+    def __init__(self, car_id):
+        self.car_id = car_id
+        self.peers = {} # role -> sid, for the car and the driver
+        self.viewers = set() # sids
+        self.pending = [] # (event, args) for the car, sent before it connected
+        self.created = time.time()
+        self.relayed = {} # event -> count
+        self.relayed_bytes = {} # event -> bytes, offers and answers are binary (deflated) in compact mode
+        self.dropped = {} # event -> count, sent by the car to a peer that already left
+        self.offer_times = {} # sid -> time of its last offer
+        self.setup_times = deque(maxlen=SETUP_TIMES_KEPT) # Seconds from offer to answer
+
+    def role_of(self, sid):
+        if sid in self.viewers:
+            return "viewer"
+        return next((role for role, peer in self.peers.items() if peer == sid), None)
+
+    def set_role(self, sid, role):
+        # Move a peer between the driver seat and the viewers
+        self.viewers.discard(sid)
+        if self.peers.get("driver") == sid:
+            del self.peers["driver"]
+        if role == "viewer":
+            self.viewers.add(sid)
+        elif role is not None:
+            self.peers[role] = sid
+
+    def stats(self):
+        return {
+            "peers": sorted(self.peers),
+            "viewers": len(self.viewers),
+            "relayed": self.relayed,
+            "relayed_bytes": self.relayed_bytes,
+            "dropped": self.dropped,
+            "pending": len(self.pending),
+            "setups": len(self.setup_times),
+            "last_setup_ms": self.setup_times[-1] * 1000 if self.setup_times else None,
+            "mean_setup_ms": sum(self.setup_times) / len(self.setup_times) * 1000 if self.setup_times else None,
+        }
+
+sessions = {} # car_id -> Session
+clients = {} # sid -> (car_id, role)
+sessions_lock = threading.Lock()
+relayed_total = 0
 
 # Serve index to show server is running
 @app.route('/')
 def index():
     return render_template_string('Websocket server is running')
 
+def rss_bytes():
+    # Current resident memory, from /proc on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+# Per-session counters and setup times, plus the server's own CPU time and memory for load tests
+@app.route('/stats')
+def stats():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with sessions_lock:
+        return jsonify({
+            "async_mode": socketio.async_mode,
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            "rss_bytes": rss_bytes(),
+            "clients": len(clients),
+            "relayed": relayed_total,
+            "sessions": {car_id: session.stats() for car_id, session in sessions.items()},
+        })
+
 @socketio.on('connect')
 def handle_connect():
     # Authenticate client
-    print("TOKEN FROM CLIENT:", request.args.get('token'))
     token = request.args.get('token')
     if token != SIGNALING_SERVER_TOKEN:
         print('Authentication failed: Invalid token')
         return False # Reject client connection
-    print('Client connected with valid token')
+
+    car_id = request.args.get('car_id') or DEFAULT_CAR_ID
+    role = request.args.get('role', 'driver')
+    if role not in ROLES:
+        print(f'Rejected client with unknown role {role}')
+        return False
+    with sessions_lock:
+        session = sessions.setdefault(car_id, Session(car_id))
+        if role == "car" and "car" in session.peers:
+            print(f'Rejected car for car {car_id}: session already has one')
+            return False
+        if role == "driver" and "driver" in session.peers:
+            # Someone else is driving, join as a viewer (see request_driver)
+            role = "viewer"
+        session.set_role(request.sid, role)
+        clients[request.sid] = (car_id, role)
+        pending, session.pending = (session.pending, []) if role == "car" else ([], session.pending)
+    join_room(car_id)
+    print(f'{role} connected to car {car_id}')
+
+    if role != "car":
+        socketio.emit('role', role, to=request.sid)
+    # Deliver what the peers sent while the car was offline
+    for event, args in pending:
+        socketio.emit(event, args, to=request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected')
+    with sessions_lock:
+        car_id, role = clients.pop(request.sid, (None, None))
+        car = None
+        session = sessions.get(car_id)
+        if session is not None:
+            session.set_role(request.sid, None)
+            if role == "car":
+                session.peers.pop("car", None)
+            else:
+                car = session.peers.get("car")
+            session.offer_times.pop(request.sid, None)
+            # Anything still queued from this peer is stale
+            session.pending = [(event, args) for event, args in session.pending if args[1] != request.sid]
+            if not session.peers and not session.viewers:
+                del sessions[car_id]
+    if car_id is not None:
+        leave_room(car_id)
+    if car is not None:
+        socketio.emit('peer_left', request.sid, to=car)
+    print(f'{role} disconnected from car {car_id}')
+
+def relay(event, data, peer_id=None):
+    # Peers only talk to the car of their session, the car addresses one peer by its sid.
+    # The car gets (data, peer id, role), a car that doesn't name a peer talks to the driver, one that names a
+    # peer that is gone talks to nobody
+    global relayed_total
+    with sessions_lock:
+        car_id, role = clients.get(request.sid, (None, None))
+        session = sessions.get(car_id)
+        if session is None:
+            return
+        if role == "car":
+            if event not in CAR_EVENTS:
+                print(f'Ignoring {event} from car {car_id}')
+                return
+            if peer_id is None:
+                target = session.peers.get("driver")
+            elif session.role_of(peer_id) in (None, "car"):
+                # The peer left (or is the car itself): an answer, candidate, restart or refusal meant for it must
+                # not reach the driver's negotiation instead
+                session.dropped[event] = session.dropped.get(event, 0) + 1
+                return
+            else:
+                target = peer_id
+            args = data
+        else:
+            if event not in PEER_EVENTS:
+                print(f'Ignoring {event} from {role} of car {car_id}')
+                return
+            target = session.peers.get("car")
+            args = (data, request.sid, role)
+        session.relayed[event] = session.relayed.get(event, 0) + 1
+        if isinstance(data, (str, bytes)):
+            session.relayed_bytes[event] = session.relayed_bytes.get(event, 0) + len(data)
+        relayed_total += 1
+        if event == "offer":
+            # A new offer starts a new negotiation, anything this peer still has queued for the car is stale
+            session.pending = [(queued, queued_args) for queued, queued_args in session.pending if queued_args[1] != request.sid]
+            session.offer_times[request.sid] = time.monotonic()
+        elif event == "answer" and target in session.offer_times:
+            session.setup_times.append(time.monotonic() - session.offer_times.pop(target))
+        if target is None:
+            if role != "car":
+                session.pending.append((event, args))
+            return
+    socketio.emit(event, args, to=target)
+
+def change_role(role):
+    # Move the requesting peer to role and tell it and the car. Returns (changed, the peer's role), both
+    # decided under the lock, so two peers asking for a free seat at once can't both get it
+    with sessions_lock:
+        car_id, current = clients.get(request.sid, (None, None))
+        session = sessions.get(car_id)
+        if session is None or current in (None, "car"):
+            return False, current
+        if role == "driver" and session.peers.get("driver") not in (None, request.sid):
+            return False, current
+        session.set_role(request.sid, role)
+        clients[request.sid] = (car_id, role)
+        car = session.peers.get("car")
+    print(f'{current} of car {car_id} is now {role}')
+    socketio.emit('role', role, to=request.sid)
+    if car is not None:
+        socketio.emit('role', (request.sid, role), to=car)
+    return True, role
 
 @socketio.on('offer')
 def handle_offer(data):
-    print('Relaying offer')
-    socketio.emit('offer', data, include_self=False)
+    relay('offer', data)
 
 @socketio.on('answer')
-def handle_answer(data):
-    print('Relaying answer')
-    socketio.emit('answer', data,  include_self=False)
+def handle_answer(data, peer_id=None):
+    relay('answer', data, peer_id)
 
 @socketio.on('ice_candidate')
-def handle_ice_candidate(data):
-    print('Relaying ICE candidate')
-    socketio.emit('ice_candidate', data, include_self=False)
+def handle_ice_candidate(data, peer_id=None):
+    relay('ice_candidate', data, peer_id)
+
+# The car detected a stalled connection and asks the peer to reconnect
+@socketio.on('restart')
+def handle_restart(data=None, peer_id=None):
+    relay('restart', data, peer_id)
+
+# The car turned a viewer away (viewer limit, CPU or uplink saturated)
+@socketio.on('refused')
+def handle_refused(data, peer_id=None):
+    relay('refused', data, peer_id)
+
+# A viewer takes the free driver seat
+@socketio.on('request_driver')
+def handle_request_driver(data=None):
+    changed, role = change_role("driver")
+    if not changed:
+        socketio.emit('role', role, to=request.sid)
+
+# The driver hands over: it becomes a viewer and the seat is free for the next request_driver
+@socketio.on('release_driver')
+def handle_release_driver(data=None):
+    change_role("viewer")
 
 if __name__ == '__main__':
-    print(f'Running on http://0.0.0.0:{PORT}')
-    socketio.run(app, host='0.0.0.0', port=PORT)
\ No newline at end of file
+    print(f'Running on http://0.0.0.0:{PORT} ({ASYNC_MODE})')
+    socketio.run(app, host='0.0.0.0', port=PORT)
@@ -0,0 +1,29 @@
+/*  Reports when each video frame is displayed back to the car over the data channel,
+    so the car can measure glass-to-glass latency. Frames are identified by their RTP timestamp,
+    times are converted to the car's clock with the offset estimated from the ping. */
+
+import { encodeFrameReport } from "./protocol.js";
+
+export default function startFrameReporting(video, sendData, getClockOffset, isConnected) {
+    // requestVideoFrameCallback is needed for per-frame RTP timestamps (Chromium)
+    if (!("requestVideoFrameCallback" in HTMLVideoElement.prototype)) {
+        console.warn("requestVideoFrameCallback not supported, glass-to-glass latency is not reported");
+        return;
+    }
+
+    function onFrame(now, metadata) {
+        const clockOffset = getClockOffset();
+        if (isConnected() && clockOffset !== null && metadata.rtpTimestamp !== undefined) {
+            // Performance clock to epoch ms, then to the car's clock
+            const toCarClock = (t) => performance.timeOrigin + t + clockOffset;
+            const receiveTime = metadata.receiveTime !== undefined ? metadata.receiveTime : now;
+            try {
+                sendData(encodeFrameReport(metadata.rtpTimestamp, toCarClock(receiveTime), toCarClock(metadata.expectedDisplayTime)));
+            } catch (e) {
+                // Data channel closed, ignore
+            }
+        }
+        video.requestVideoFrameCallback(onFrame);
+    }
+    video.requestVideoFrameCallback(onFrame);
+}
@@ -1,73 +1,100 @@
 import startGamepad from "./gamepad.js";
 import startWebRTCConnection from "./webrtc.js";
-
-const { localConnection, dataChannel, sendData } = startWebRTCConnection();
+import startFrameReporting from "./latency.js";
+import { encodePacket, decodeTelemetry, PACKET_CONTROL, PACKET_PING } from "./protocol.js";
 
 const gamepadPollInterval = 25;
 const forwardMarginIfAlsoReverse = 0.25;
 
-// Helper to round to max. two decimal places
-function roundToTwo(num) {
-    return Math.round(num * 100) / 100;
-}
-
 // Run every time a gamepad input is detected
 function gamepadInputCallback(gamepad) {
     // Forward and reverse format: 0-1
     const forwardValue = gamepad.buttons[7].value; // Right trigger
     const reverseValue = gamepad.buttons[6].value; // Left trigger
     // Sterring format: -1 to 1
-    let sterringValue = gamepad.axes[0]; // Left stick horizontal axis
+    // Sent raw, the car applies deadband, expo and endpoints from its calibration (calibration.py)
+    const sterringValue = gamepad.axes[0]; // Left stick horizontal axis
     // Pan and tilt format: -1 to 1
-    let panValue = gamepad.axes[2]; // Right stick horizontal axis
-    let tiltValue = gamepad.axes[3]; // Right stick vertical axis
-
-    // Circumvent minimal stick drift
-    if (sterringValue > -0.075 && sterringValue < 0.075) {
-        sterringValue = 0;
-    }
-    if (panValue > -0.075 && panValue < 0.075) {
-        panValue = 0;
-    }
-    if (tiltValue > -0.075 && tiltValue < 0.075) {
-        tiltValue = 0;
-    }
+    const panValue = gamepad.axes[2]; // Right stick horizontal axis
+    const tiltValue = gamepad.axes[3]; // Right stick vertical axis
 
     // Calculate throttle control (smooth forward and reverse simontaneously)
     const forwardLessIfBackwards = reverseValue > 0 ? forwardValue - forwardMarginIfAlsoReverse : forwardValue;
-    const throttleValue = roundToTwo(forwardLessIfBackwards - reverseValue);
+    const throttleValue = forwardLessIfBackwards - reverseValue;
     const throttleValueMinMax = Math.min(1, Math.max(-1, throttleValue));
 
-    // Format: throttle,sterring,pan,tilt
-    const dataString = `${throttleValueMinMax},${roundToTwo(sterringValue)},${roundToTwo(panValue)},${roundToTwo(tiltValue)}`;
+    // Binary control packet (see protocol.js), axes in -1 to 1
+    const packet = encodePacket(PACKET_CONTROL, Date.now(), throttleValueMinMax, sterringValue, panValue, tiltValue);
 
-    // Send data if connected
-    if (localConnection.connectionState === "connected") {
-        console.log(dataString);
-        sendData(dataString);
+    // Send data if connected and driving
+    if (isConnected() && isDriver()) {
+        sendData(packet);
     }
 }
 startGamepad(gamepadPollInterval, gamepadInputCallback);
 
-// Ping/pong to calculate latency
+// Ping/pong to calculate latency and the offset between the car's clock and ours. The car also uses the
+// pings to detect a stalled connection, so they are sent every second
+const pingInterval = 1000;
 let latestPing = null;
-setInterval(() => {
-    if (localConnection.connectionState !== "connected") return;
-
-    // Return if a ping is already in flight
-    if (latestPing) {
-        return;
-    }
+let clockOffset = null;
 
-    latestPing = Date.now();
-    sendData(latestPing);
-}, 5000);
-
-dataChannel.onmessage = (event) => {
+function handleMessage(event) {
     const pong = parseInt(event.data);
+    const now = Date.now();
 
     // Calculate latency
     const latency = pong - latestPing;
     document.getElementById("dataLatency").textContent = `${latency}ms`;
+
+    // Car's clock minus ours, assuming a symmetric path
+    clockOffset = pong - (latestPing + now) / 2;
     latestPing = null;
+}
+
+// Car status, streamed by the car a few times per second
+function handleTelemetry(data) {
+    const t = decodeTelemetry(data);
+    if (!t) return;
+    const parts = [];
+    if (t.cpuTemperature !== null) parts.push(`${t.cpuTemperature.toFixed(1)}°C`);
+    if (t.throttled) parts.push(`throttled 0x${t.throttled.toString(16)}`);
+    if (t.cpuSeconds !== null) parts.push(`CPU ${Math.round(t.cpuSeconds * 100)}%`);
+    if (t.loopLagMax !== null) parts.push(`loop lag ${(t.loopLagMax * 1000).toFixed(1)}ms`);
+    if (t.captureFps !== null) parts.push(`capture ${t.captureFps.toFixed(1)}fps`);
+    if (t.videoFps !== null) parts.push(`video ${t.videoFps.toFixed(1)}fps`);
+    if (t.videoBytesPerSecond !== null) parts.push(`${Math.round(t.videoBytesPerSecond * 8 / 1000)}kbps`);
+    if (t.commandAge !== null) parts.push(`last command ${Math.round(t.commandAge * 1000)}ms ago`);
+    if (t.controlLatency !== null) parts.push(`control p99 ${(t.controlLatency * 1000).toFixed(1)}ms`);
+    document.getElementById("telemetry").textContent = parts.join(", ");
+}
+
+const { sendData, isConnected, isDriver, requestDriver, releaseDriver } = startWebRTCConnection(handleMessage, handleTelemetry);
+document.getElementById("takeControl").onclick = requestDriver;
+document.getElementById("handOver").onclick = releaseDriver;
+
+// Profiling run on the car, from the browser console: profileCar(30) or profileCar(30, true) with the sampling
+// profiler, profileCar(0) stops it. Results are written on the car (CarBrain/profiles)
+window.profileCar = (seconds = 30, sample = false) => {
+    sendData(seconds === 0 ? "profile stop" : `profile ${seconds}${sample ? " sample" : ""}`);
 };
+
+setInterval(() => {
+    if (!isConnected()) return;
+
+    // Return if a ping is already in flight, unless it was lost (e.g. on a reconnect)
+    if (latestPing && Date.now() - latestPing < 5 * pingInterval) {
+        return;
+    }
+
+    latestPing = Date.now();
+    sendData(encodePacket(PACKET_PING, latestPing));
+}, pingInterval);
+
+// Report displayed frames for glass-to-glass latency, measured on the driver's stream only
+startFrameReporting(
+    document.getElementById("remoteVideo"),
+    sendData,
+    () => clockOffset,
+    () => isConnected() && isDriver()
+);
@@ -0,0 +1,70 @@
+/*  Binary packet format for the controllerInput data channel.
+    Keep in sync with CarBrain/protocol.py (little-endian, 22 bytes):
+    version u8 | type u8 | sequence u32 | sender timestamp f64 (ms since epoch) | throttle, sterring, pan, tilt int16
+    Frame display reports (22 bytes) are:
+    version u8 | type u8 | RTP timestamp u32 | receive time f64 | display time f64 (ms since epoch, car's clock)
+    Telemetry snapshots (car -> browser, telemetry data channel) are:
+    version u8 | type u8 | sequence u32 | car timestamp f64 | one f32 per TELEMETRY_FIELDS entry (NaN if unavailable) */
+
+export const PACKET_VERSION = 1;
+export const PACKET_CONTROL = 1;
+export const PACKET_PING = 2;
+export const PACKET_FRAME_REPORT = 3;
+export const PACKET_TELEMETRY = 4;
+const PACKET_SIZE = 22;
+const AXIS_SCALE = 32767;
+const TELEMETRY_HEADER_SIZE = 14;
+// Same order as METRICS in CarBrain/telemetry.py, counters arrive as per-second rates
+export const TELEMETRY_FIELDS = [
+    "cpuTemperature", "throttled", "loadPerCore", "cpuSeconds", "loopLag", "loopLagMax",
+    "captureFps", "videoFps", "videoBytesPerSecond", "targetBitrate", "controlInputsPerSecond",
+    "commandAge", "failsafesPerSecond", "peers", "controlLatency", "watchdogTripsPerSecond",
+];
+
+let sequence = 0;
+
+// Quantise -1..1 to int16
+function quantise(value) {
+    return Math.round(Math.min(1, Math.max(-1, value)) * AXIS_SCALE);
+}
+
+export function encodePacket(type, timestamp, throttle = 0, sterring = 0, pan = 0, tilt = 0) {
+    const buffer = new ArrayBuffer(PACKET_SIZE);
+    const view = new DataView(buffer);
+    view.setUint8(0, PACKET_VERSION);
+    view.setUint8(1, type);
+    view.setUint32(2, sequence, true);
+    view.setFloat64(6, timestamp, true);
+    view.setInt16(14, quantise(throttle), true);
+    view.setInt16(16, quantise(sterring), true);
+    view.setInt16(18, quantise(pan), true);
+    view.setInt16(20, quantise(tilt), true);
+    sequence = (sequence + 1) >>> 0;
+    return buffer;
+}
+
+export function encodeFrameReport(rtpTimestamp, receiveTime, displayTime) {
+    const buffer = new ArrayBuffer(PACKET_SIZE);
+    const view = new DataView(buffer);
+    view.setUint8(0, PACKET_VERSION);
+    view.setUint8(1, PACKET_FRAME_REPORT);
+    view.setUint32(2, rtpTimestamp >>> 0, true);
+    view.setFloat64(6, receiveTime, true);
+    view.setFloat64(14, displayTime, true);
+    return buffer;
+}
+
+// Telemetry snapshot as { seq, timestamp, <field>: value or null }, or null if malformed
+export function decodeTelemetry(buffer) {
+    const view = new DataView(buffer);
+    if (buffer.byteLength < TELEMETRY_HEADER_SIZE || view.getUint8(0) !== PACKET_VERSION || view.getUint8(1) !== PACKET_TELEMETRY) {
+        return null;
+    }
+    const snapshot = { seq: view.getUint32(2, true), timestamp: view.getFloat64(6, true) };
+    TELEMETRY_FIELDS.forEach((field, index) => {
+        const offset = TELEMETRY_HEADER_SIZE + index * 4;
+        const value = offset + 4 <= buffer.byteLength ? view.getFloat32(offset, true) : NaN;
+        snapshot[field] = Number.isNaN(value) ? null : value;
+    });
+    return snapshot;
+}
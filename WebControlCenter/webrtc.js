@@ -1,12 +1,57 @@
 import { SIGNALING_SERVER_URL, SIGNALING_SERVER_TOKEN } from "./config.js";
 
-export default function startWebRTCConnection() {
-    // Connect to signaling server
+// Reconnect if ICE stays "disconnected" this long (it usually recovers by itself from short blips)
+const DISCONNECTED_GRACE_MS = 1500;
+// Allow a new reconnect if one didn't complete within this time
+const RECONNECT_TIMEOUT_MS = 10000;
+// Compact signaling: longest wait for ICE gathering before the offer is sent with the candidates found so far
+const GATHER_TIMEOUT_MS = 1000;
+
+// ICE gathering complete, or the timeout passed
+function waitForGathering(connection, timeout) {
+    return new Promise((resolve) => {
+        if (connection.iceGatheringState === "complete") {
+            resolve();
+            return;
+        }
+        const timer = setTimeout(resolve, timeout);
+        connection.addEventListener("icegatheringstatechange", () => {
+            if (connection.iceGatheringState === "complete") {
+                clearTimeout(timer);
+                resolve();
+            }
+        });
+    });
+}
+
+// zlib (RFC 1950) as the car's connection.encode_description / decode_description
+async function deflate(text) {
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream("deflate"));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+async function inflate(data) {
+    const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return await new Response(stream).text();
+}
+
+export default function startWebRTCConnection(onMessage, onTelemetry) {
+    // Connect to signaling server, joining the session of the car given by ?car=<id>. Joins as the driver
+    // unless ?role=viewer, or someone else is already driving
+    const params = new URLSearchParams(window.location.search);
+    const carId = params.get("car") || "default";
     const socket = io(SIGNALING_SERVER_URL, {
         query: {
             token: SIGNALING_SERVER_TOKEN,
+            car_id: carId,
+            role: params.get("role") === "viewer" ? "viewer" : "driver",
         },
     });
+    let role = null;
+    // Signaling mode. compact: one deflated offer carrying the ICE candidates gathered within GATHER_TIMEOUT_MS,
+    // so setup is one relay each way (later candidates are still trickled). trickle: the offer at once, then
+    // one relay per candidate. ?signaling=trickle, or a browser without CompressionStream, uses trickle
+    const signalingMode = params.get("signaling") === "trickle" || typeof CompressionStream === "undefined" ? "trickle" : "compact";
 
     // ICE configuration
     const iceConfiguration = {};
@@ -22,68 +67,131 @@ export default function startWebRTCConnection() {
         urls: "stun:fr-turn1.xirsys.com",
     });
 
-    const localConnection = new RTCPeerConnection(iceConfiguration);
+    let localConnection = null;
+    let dataChannel = null;
+    let reconnectStarted = null;
+    let disconnectedTimer = null;
 
-    // Create a data channel
-    const dataChannel = localConnection.createDataChannel("controllerInput");
+    // The car can't renegotiate ICE on a running connection, so a network change is handled with a fresh
+    // connection. The car keeps its camera pipeline and video track, only the transport is rebuilt
+    function connect() {
+        if (localConnection) {
+            localConnection.close();
+        }
+        const connection = new RTCPeerConnection(iceConfiguration);
+        localConnection = connection;
+        // Compact mode: candidates found while the offer is compressed are sent right after it
+        let offerTaken = false;
+        let offerSent = false;
+        const heldCandidates = [];
 
-    // Handle data channel events
-    dataChannel.onopen = () => {
-        document.getElementById("dataStatus").textContent = "Opened";
-        console.log("Data channel is open");
-    };
+        // Create a data channel
+        dataChannel = connection.createDataChannel("controllerInput");
 
-    dataChannel.onerror = (error) => {
-        document.getElementById("dataStatus").textContent = "Error";
-        console.error("Data Channel Error:", error);
-    };
+        // Handle data channel events
+        dataChannel.onopen = () => {
+            document.getElementById("dataStatus").textContent = "Opened";
+            console.log("Data channel is open");
+            if (reconnectStarted !== null) {
+                const reconnectTime = Math.round(performance.now() - reconnectStarted);
+                document.getElementById("webrtcStatus").textContent = `Reconnected in ${reconnectTime}ms`;
+                console.log(`Reconnected in ${reconnectTime}ms`);
+                reconnectStarted = null;
+            }
+        };
 
-    dataChannel.onclose = () => {
-        document.getElementById("dataStatus").textContent = "Closed";
-    };
+        dataChannel.onerror = (error) => {
+            document.getElementById("dataStatus").textContent = "Error";
+            console.error("Data Channel Error:", error);
+        };
 
-    localConnection.onicecandidate = (event) => {
-        if (event.candidate && event.candidate.candidate !== "") {
-            console.log("New ICE candidate");
-            console.log(JSON.stringify(event.candidate, null, 2));
-            socket.emit("ice_candidate", JSON.stringify(event.candidate));
-        } else {
-            console.log("All current ICE candidates have been gathered.");
-        }
-    };
-
-    // Handle incoming media tracks
-    localConnection.ontrack = (event) => {
-        console.log("Received new track", event.track.kind);
-        document.getElementById("webrtcStatus").textContent = "Established";
-        document.getElementById("remoteVideo").srcObject = event.streams[0];
-        console.log(event.streams);
-
-        document.getElementById("remoteVideo").srcObject = event.streams[0];
-        console.log(document.getElementById("remoteVideo").srcObject);
-        console.log(event.track.readyState); // should be "live"
-    };
-
-    // Handle connection state change
-    localConnection.oniceconnectionstatechange = (event) => {
-        if (localConnection.iceConnectionState === "disconnected") {
-            console.log("Disconnected");
-            document.getElementById("webrtcStatus").textContent = "Disconnected";
+        dataChannel.onclose = () => {
             document.getElementById("dataStatus").textContent = "Closed";
-        }
-    };
+        };
 
-    localConnection.addTransceiver('video', { direction: 'recvonly' });
-    // Use the above instead of localConnection.createOffer({ offerToReceiveVideo: true }) as that doesn't work in Safari
+        dataChannel.onmessage = onMessage;
 
-    localConnection.createOffer().then((offer) => {
-        localConnection.setLocalDescription(offer);
-        // Send offer to peer B
-        socket.emit("offer", JSON.stringify(offer));
-    });
+        // Car status snapshots, a late one is useless so it isn't retransmitted
+        const telemetryChannel = connection.createDataChannel("telemetry", { ordered: false, maxRetransmits: 0 });
+        telemetryChannel.binaryType = "arraybuffer";
+        telemetryChannel.onmessage = (event) => onTelemetry && onTelemetry(event.data);
+
+        connection.onicecandidate = (event) => {
+            if (event.candidate && event.candidate.candidate !== "") {
+                // In compact mode the offer carries the candidates found before it was taken
+                if (signalingMode === "compact" && !offerSent) {
+                    if (offerTaken) heldCandidates.push(event.candidate);
+                    return;
+                }
+                console.log("New ICE candidate");
+                socket.emit("ice_candidate", JSON.stringify(event.candidate));
+            } else {
+                console.log("All current ICE candidates have been gathered.");
+            }
+        };
+
+        // Handle incoming media tracks
+        connection.ontrack = (event) => {
+            console.log("Received new track", event.track.kind);
+            document.getElementById("webrtcStatus").textContent = "Established";
+            document.getElementById("remoteVideo").srcObject = event.streams[0];
+        };
+
+        // Handle connection state change, reconnect on failure
+        connection.oniceconnectionstatechange = () => {
+            if (connection !== localConnection) return;
+            clearTimeout(disconnectedTimer);
+            if (connection.iceConnectionState === "disconnected") {
+                console.log("Disconnected");
+                document.getElementById("webrtcStatus").textContent = "Disconnected";
+                document.getElementById("dataStatus").textContent = "Closed";
+                disconnectedTimer = setTimeout(() => reconnect("ICE disconnected"), DISCONNECTED_GRACE_MS);
+            } else if (connection.iceConnectionState === "failed") {
+                reconnect("ICE failed");
+            }
+        };
+
+        connection.addTransceiver('video', { direction: 'recvonly' });
+        // Use the above instead of connection.createOffer({ offerToReceiveVideo: true }) as that doesn't work in Safari
+
+        connection.createOffer().then(async (offer) => {
+            await connection.setLocalDescription(offer);
+            if (signalingMode === "compact") {
+                const started = performance.now();
+                await waitForGathering(connection, GATHER_TIMEOUT_MS);
+                if (connection !== localConnection) return;
+                // Send offer to peer B, with the candidates gathered so far
+                const description = JSON.stringify(connection.localDescription);
+                offerTaken = true;
+                const message = await deflate(description);
+                if (connection !== localConnection) return;
+                socket.emit("offer", message);
+                offerSent = true;
+                heldCandidates.forEach((candidate) => socket.emit("ice_candidate", JSON.stringify(candidate)));
+                console.log(`Sent compact offer (${message.length} bytes) after ${Math.round(performance.now() - started)}ms of ICE gathering`);
+            } else {
+                // Send offer to peer B
+                offerSent = true;
+                socket.emit("offer", JSON.stringify(offer));
+            }
+        });
+    }
 
-    function setRemoteDescription(answer) {
-        localConnection.setRemoteDescription(JSON.parse(answer)).then((a) => console.log("Set remote SDP"));
+    function reconnect(reason) {
+        if (reconnectStarted !== null && performance.now() - reconnectStarted < RECONNECT_TIMEOUT_MS) {
+            return;
+        }
+        console.log("Reconnecting:", reason);
+        document.getElementById("webrtcStatus").textContent = "Reconnecting...";
+        reconnectStarted = performance.now();
+        connect();
+    }
+
+    async function setRemoteDescription(answer) {
+        // A compact offer is answered in binary (deflated) as well
+        const description = JSON.parse(typeof answer === "string" ? answer : await inflate(answer));
+        await localConnection.setRemoteDescription(description);
+        console.log("Set remote SDP");
     }
 
     function sendData(data) {
@@ -95,6 +203,23 @@ export default function startWebRTCConnection() {
         }
     }
 
+    function isConnected() {
+        return localConnection.connectionState === "connected";
+    }
+
+    // Only the driver's control input is applied by the car
+    function isDriver() {
+        return role === "driver";
+    }
+
+    function requestDriver() {
+        socket.emit("request_driver");
+    }
+
+    function releaseDriver() {
+        socket.emit("release_driver");
+    }
+
     // SIGNALING
     const signalingStatusEl = document.getElementById("signalingStatus");
 
@@ -125,5 +250,25 @@ export default function startWebRTCConnection() {
             .catch((e) => console.error(e));
     });
 
-    return { localConnection, dataChannel, sendData };
+    // The car detected a stalled connection
+    socket.on("restart", function () {
+        reconnect("requested by car");
+    });
+
+    // Our role in the session changed (joined, took or handed over control)
+    socket.on("role", function (newRole) {
+        role = newRole;
+        document.getElementById("roleStatus").textContent = role === "driver" ? "Driver" : "Viewer";
+        console.log("Role:", role);
+    });
+
+    // The car has no room for another viewer
+    socket.on("refused", function (reason) {
+        document.getElementById("webrtcStatus").textContent = `Refused: ${reason}`;
+        console.log("Refused by car:", reason);
+    });
+
+    connect();
+
+    return { sendData, isConnected, isDriver, requestDriver, releaseDriver };
 }